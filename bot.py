@@ -4,18 +4,38 @@ import sqlite3
 import sys
 import os
 import json
+import hmac
+import secrets
+import signal
+import csv
+import re
+import tempfile
+import gzip
+import shutil
 from pathlib import Path
 import psutil
 import aiohttp
+from aiohttp import web
 import time
+import math
 import random
+import functools
+import heapq
+import itertools
+import threading
+import contextvars
+import html
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, time as dt_time, timedelta, timezone
 from aiogram import Bot, Dispatcher, types
 from aiogram import exceptions
 from aiogram.types import Update
+from aiogram.methods import GetUpdates
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.client.default import DefaultBotProperties
 from aiogram.filters import Command, CommandObject
-from aiogram.types import Message, CallbackQuery, InputFile, BufferedInputFile
+from aiogram.types import Message, CallbackQuery, InputFile, BufferedInputFile, FSInputFile
 from aiogram.fsm.storage import memory
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
@@ -38,6 +58,9 @@ TEST_MODE = "--test" in sys.argv
 if TEST_MODE:
     logger.warning("⚠️ Бот запущен в ТЕСТОВОМ РЕЖИМЕ! Все ограничения отключены.")
 
+# Проверка миграций без записи в базу
+MIGRATE_DRY_RUN = "--migrate-dry-run" in sys.argv
+
 # Загрузка переменных окружения
 load_dotenv()
 
@@ -49,10 +72,26 @@ CRYPTOBOT_TOKEN = os.getenv("CRYPTOBOT_TOKEN")
 CRYPTOBOT_ASSET = "USDT"
 CRYPTOBOT_URL = "https://pay.crypt.bot/"
 DATABASE = "multi_service_bot.db"
+DATABASE_URL = os.getenv("DATABASE_URL", "")  # postgresql://... — PostgreSQL вместо файла SQLite
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))  # Соединений в пуле PostgreSQL на процесс
 EXCHANGE_RATE = 90  # Курс доллара к рублю
 REFERRAL_BONUS = 0.1  # 0.1$ за приглашение
 PROCESSING_DELAY = 3600  # 1 час для автоподтверждения заявок
 MAX_CHECKS_PER_BATCH = 50  # Максимум чеков за одну обработку
+BACKUP_DIR = Path(os.getenv("BACKUP_DIR", "backups"))
+BACKUP_INTERVAL_HOURS = int(os.getenv("BACKUP_INTERVAL_HOURS", "6"))  # 0 — без резервных копий
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))  # Сколько последних копий хранить, 0 — все
+BACKUP_COMPRESS = os.getenv("BACKUP_COMPRESS", "1") == "1"  # Сжимать копии gzip
+SLOW_QUERY_MS = int(os.getenv("SLOW_QUERY_MS", "200"))  # Запросы дольше порога пишутся в лог с планом
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))  # Возраст завершенной работы для архива, 0 — не архивировать
+WEBHOOK_MODE = os.getenv("BOT_MODE", "polling") == "webhook"  # webhook — обновления через встроенный HTTP-сервер
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Внешний https-адрес прокси; пусто — webhook не регистрируется
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Секрет заголовка X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "32"))  # Обновлений в обработке одновременно
+TELEGRAM_RATE_LIMIT = float(os.getenv("TELEGRAM_RATE_LIMIT", "30"))  # Потолок запросов к Bot API в секунду
 
 # Тарифы
 WHATSAPP_RATES = {1: 8.0, 2: 10.0, 3: 12.0}  # 1 час - 8$, 2 часа - 10$, 3 часа - 12$
@@ -94,6 +133,1216 @@ bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTM
 storage = memory.MemoryStorage()
 dp = Dispatcher(storage=storage)
 
+# Асинхронный слой доступа к базе данных
+DB_READERS = 4  # Долгоживущих соединений на чтение
+DB_CACHE_SIZE_KB = 32 * 1024  # Кэш страниц на одно соединение
+DB_MMAP_SIZE = 256 * 1024 * 1024  # Размер отображения файла БД в память
+DB_BUSY_TIMEOUT_MS = 30000
+GROUP_COMMIT_WINDOW_MS = 5  # Сколько ждать попутчиков для общей транзакции
+GROUP_COMMIT_MAX_OPS = 64  # Операций в одной общей транзакции
+BACKUP_PAGES_PER_STEP = 1024  # Страниц за шаг резервного копирования (4 МБ при странице 4 КБ)
+BACKUP_STEP_PAUSE = 0.01  # Пауза между шагами копирования, секунд
+
+class SqlExpr(str):
+    """SQL-выражение, которое подставляется в запрос как есть, а не параметром"""
+
+SQL_NOW = SqlExpr("datetime('now')")
+
+def build_transition(table: str, from_states, to_state=None, fields=None, match=None,
+                     returning=("user_id", "phone")):
+    """Собирает UPDATE ... WHERE id = ? AND status IN (...) RETURNING ...
+
+    Возвращает текст запроса и параметры без id строки (он идет первым в WHERE).
+    """
+    assignments, params = [], []
+    if to_state is not None:
+        assignments.append("status = ?")
+        params.append(to_state)
+    for column, value in (fields or {}).items():
+        if isinstance(value, SqlExpr):
+            assignments.append(f"{column} = {value}")
+        else:
+            assignments.append(f"{column} = ?")
+            params.append(value)
+    conditions = [f"status IN ({', '.join('?' * len(from_states))})"]
+    where_params = list(from_states)
+    for column, value in (match or {}).items():
+        conditions.append(f"{column} = ?")
+        where_params.append(value)
+    sql = (
+        f"UPDATE {table} SET {', '.join(assignments)} "
+        f"WHERE id = ? AND {' AND '.join(conditions)} "
+        f"RETURNING {', '.join(returning)}"
+    )
+    return sql, params, where_params
+
+def build_guarded_delete(table: str, from_states, match=None, returning=("user_id", "phone")):
+    """Собирает DELETE ... WHERE id = ? AND status IN (...) RETURNING ...
+
+    Возвращает текст запроса и параметры без id строки (он идет первым в WHERE).
+    """
+    conditions = [f"status IN ({', '.join('?' * len(from_states))})"]
+    where_params = list(from_states)
+    for column, value in (match or {}).items():
+        conditions.append(f"{column} = ?")
+        where_params.append(value)
+    sql = (
+        f"DELETE FROM {table} "
+        f"WHERE id = ? AND {' AND '.join(conditions)} "
+        f"RETURNING {', '.join(returning)}"
+    )
+    return sql, where_params
+
+# Замеры времени запросов
+QUERY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)  # Верхние границы корзин
+SLOW_QUERY_LOG_SIZE = 100  # Сколько последних медленных запросов хранить
+
+# Имя обработчика, в котором выполняется запрос; ставится middleware
+current_handler = contextvars.ContextVar("current_handler", default=None)
+
+def query_caller() -> str:
+    name = current_handler.get()
+    if name:
+        return name
+    # Фоновые задачи запускаются с именем, по нему и отличаются
+    task = asyncio.current_task()
+    return task.get_name() if task else "-"
+
+@functools.lru_cache(maxsize=1024)
+def query_name(sql: str) -> str:
+    """Текст запроса в одну строку: по нему запросы группируются в статистике"""
+    return " ".join(sql.split())
+
+class QueryTiming:
+    """Гистограмма времени одного запроса и число возвращенных или измененных строк"""
+    __slots__ = ("count", "total_ms", "max_ms", "rows", "buckets", "callers")
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.buckets = [0] * (len(QUERY_BUCKETS_MS) + 1)
+        self.callers = {}
+
+    def add(self, elapsed_ms: float, rows: int, caller: str):
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.rows += rows
+        index = 0
+        while index < len(QUERY_BUCKETS_MS) and elapsed_ms > QUERY_BUCKETS_MS[index]:
+            index += 1
+        self.buckets[index] += 1
+        self.callers[caller] = self.callers.get(caller, 0) + 1
+
+    def percentile(self, fraction: float) -> float:
+        """Верхняя граница корзины, в которую попадает доля fraction замеров"""
+        threshold = self.count * fraction
+        seen = 0
+        for index, bucket in enumerate(self.buckets):
+            seen += bucket
+            if seen >= threshold:
+                return QUERY_BUCKETS_MS[index] if index < len(QUERY_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+class QueryStats:
+    """Время всех запросов слоя данных по тексту запроса.
+
+    Запросы дольше SLOW_QUERY_MS дополнительно пишутся в лог вместе с планом
+    и обработчиком; план запрашивается в фоне, чтобы не задерживать ответ.
+    """
+    def __init__(self):
+        self.timings = {}
+        self.slow = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+        self._explain_tasks = set()
+
+    def record(self, database, sql: str, params, elapsed_ms: float, rows: int):
+        name = query_name(sql)
+        caller = query_caller()
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = self.timings[name] = QueryTiming()
+        timing.add(elapsed_ms, rows, caller)
+        
+        if elapsed_ms >= SLOW_QUERY_MS:
+            task = asyncio.create_task(self._log_slow(database, sql, params, elapsed_ms, caller))
+            self._explain_tasks.add(task)
+            task.add_done_callback(self._explain_tasks.discard)
+
+    async def _log_slow(self, database, sql: str, params, elapsed_ms: float, caller: str):
+        try:
+            plan = await database.explain(sql, params)
+        except Exception as e:
+            plan = [f"план недоступен: {e}"]
+        self.slow.append((time.time(), elapsed_ms, caller, query_name(sql), plan))
+        logger.warning(f"Slow query {elapsed_ms:.0f} ms in {caller}: {query_name(sql)}\n"
+                       f"    plan: {' | '.join(plan) or '-'}")
+
+    def top(self, limit: int) -> list:
+        """Самые медленные в среднем запросы: [(текст, QueryTiming)]"""
+        return sorted(self.timings.items(), key=lambda item: item[1].total_ms / item[1].count,
+                      reverse=True)[:limit]
+
+query_stats = QueryStats()
+
+@dp.message.middleware()
+@dp.callback_query.middleware()
+async def track_handler_name(handler, event, data):
+    """Запоминает имя обработчика для статистики запросов"""
+    current_handler.set(data["handler"].callback.__name__)
+    return await handler(event, data)
+
+def timed_query(method):
+    """Замеряет метод fetchone/fetchall/execute/insert/executemany слоя данных"""
+    name = method.__name__
+    
+    @functools.wraps(method)
+    async def wrapper(self, sql: str, params=()):
+        started = time.perf_counter()
+        result = await method(self, sql, params)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if name == "fetchall":
+            rows = len(result)
+        elif name == "fetchone":
+            rows = 0 if result is None else 1
+        elif name == "insert":
+            rows = 1
+        else:
+            rows = max(result, 0)
+        # Для executemany план строится по первой строке параметров
+        if name == "executemany":
+            params = params[0] if isinstance(params, (list, tuple)) and params else [None] * sql.count("?")
+        query_stats.record(getattr(self, "_db", self), sql, params, elapsed_ms, rows)
+        return result
+    return wrapper
+
+class BaseTransaction:
+    """Методы транзакции, выраженные через fetchone; общие для SQLite и PostgreSQL"""
+    def _track(self, sql: str):
+        pass
+
+    async def fetchval(self, sql: str, params=(), default=None):
+        row = await self.fetchone(sql, params)
+        return row[0] if row and row[0] is not None else default
+
+    async def transition(self, table: str, row_id: int, from_states, to_state=None,
+                         fields=None, match=None, returning=("user_id", "phone")):
+        """Переводит строку из одного из статусов from_states в to_state.
+
+        Проверка статуса, обновление и чтение нужных полей идут одним запросом,
+        поэтому из двух одновременных нажатий выигрывает только одно.
+        Возвращает поля returning или None, если переход не состоялся.
+        """
+        sql, params, where_params = build_transition(
+            table, from_states, to_state, fields, match, returning
+        )
+        self._track(sql)
+        return await self.fetchone(sql, (*params, row_id, *where_params))
+
+    async def delete_in_states(self, table: str, row_id: int, from_states, match=None,
+                               returning=("user_id", "phone")):
+        """Удаляет строку, только если она в одном из статусов from_states.
+
+        Как и transition, возвращает поля returning или None, если строку
+        уже удалили или перевели в другой статус.
+        """
+        sql, where_params = build_guarded_delete(table, from_states, match, returning)
+        self._track(sql)
+        return await self.fetchone(sql, (row_id, *where_params))
+
+    async def lock_rows(self, table: str, column: str, values) -> list:
+        """Блокирует строки до конца транзакции перед проверкой «прочитать и записать».
+
+        В SQLite транзакция записи и так единственная (BEGIN IMMEDIATE), поэтому
+        значения возвращаются как есть. Возвращает значения строк, которые
+        еще существуют.
+        """
+        return list(values)
+
+    async def lock_table(self, table: str):
+        """Ждет завершения чужих записей в таблицу и не дает начать новые до конца транзакции.
+
+        В SQLite ничего не делает по той же причине, что и lock_rows.
+        """
+
+class GroupCommit:
+    """Очередь коротких операций записи, которые фиксируются общей транзакцией.
+
+    Операции, поступившие за GROUP_COMMIT_WINDOW_MS (или пока их не наберется
+    GROUP_COMMIT_MAX_OPS), выполняются подряд в одной транзакции: вместо
+    фиксации на каждое нажатие — одна на всю пачку. Каждая операция идет
+    под своей точкой сохранения, поэтому ошибка одной откатывает только ее.
+    Ожидание вызывающего завершается только после фиксации всей пачки.
+    """
+    def __init__(self, db, window_ms: int = GROUP_COMMIT_WINDOW_MS,
+                 max_ops: int = GROUP_COMMIT_MAX_OPS):
+        self._db = db
+        self.window = window_ms / 1000
+        self.max_ops = max_ops
+        self._pending = []
+        self._full = None
+        self._task = None
+
+    async def submit(self, work, *args):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((work, args, future))
+        if self._full is None:
+            self._full = asyncio.Event()
+        if len(self._pending) >= self.max_ops:
+            self._full.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="group_commit")
+        return await future
+
+    async def _run(self):
+        # Ждем попутчиков только перед первой пачкой: пока фиксируется
+        # предыдущая, следующая уже набирается
+        try:
+            await asyncio.wait_for(self._full.wait(), self.window)
+        except asyncio.TimeoutError:
+            pass
+        while self._pending:
+            self._full.clear()
+            batch = self._pending[:self.max_ops]
+            del self._pending[:self.max_ops]
+            await self._commit(batch)
+
+    async def _commit(self, batch):
+        results = []
+        try:
+            async with self._db.transaction() as tx:
+                for work, args, future in batch:
+                    if future.cancelled():
+                        results.append(None)
+                        continue
+                    await tx.execute("SAVEPOINT group_op")
+                    try:
+                        results.append((True, await work(tx, *args)))
+                    except Exception as e:
+                        await tx.execute("ROLLBACK TO SAVEPOINT group_op")
+                        results.append((False, e))
+                    await tx.execute("RELEASE SAVEPOINT group_op")
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        for result, (_, _, future) in zip(results, batch):
+            if result is None or future.done():
+                continue
+            ok, value = result
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    async def drain(self):
+        """Дожидается фиксации всего, что уже в очереди"""
+        while self._task is not None and not self._task.done():
+            await self._task
+
+class BaseDatabase:
+    """Общая часть интерфейса хранилища: запись одним запросом через транзакцию"""
+    def __init__(self):
+        self._commit_hooks = []
+        self._group_commit = GroupCommit(self)
+
+    def on_commit(self, tables, hook):
+        """Регистрирует async hook(reader), вызываемый после фиксации транзакции,
+        которая писала в одну из таблиц tables; reader умеет fetchall/fetchone"""
+        self._commit_hooks.append((tuple(tables), hook))
+
+    async def fetchval(self, sql: str, params=(), default=None):
+        """Возвращает первое поле первой строки или default"""
+        row = await self.fetchone(sql, params)
+        return row[0] if row and row[0] is not None else default
+
+    async def execute(self, sql: str, params=()) -> int:
+        async with self.transaction() as tx:
+            return await tx.execute(sql, params)
+
+    async def insert(self, sql: str, params=()) -> int:
+        async with self.transaction() as tx:
+            return await tx.insert(sql, params)
+
+    async def transition(self, table: str, row_id: int, from_states, to_state=None,
+                         fields=None, match=None, returning=("user_id", "phone")):
+        async with self.transaction() as tx:
+            return await tx.transition(
+                table, row_id, from_states, to_state, fields, match, returning
+            )
+
+    async def delete_in_states(self, table: str, row_id: int, from_states, match=None,
+                               returning=("user_id", "phone")):
+        async with self.transaction() as tx:
+            return await tx.delete_in_states(table, row_id, from_states, match, returning)
+
+    async def group_commit(self, work, *args):
+        """Выполняет await work(tx, *args) в общей с другими обработчиками транзакции
+        и возвращает его результат после фиксации. work только пишет в БД:
+        сообщения пользователям отправляются после возврата"""
+        return await self._group_commit.submit(work, *args)
+
+class Transaction(BaseTransaction):
+    """Транзакция на запись: все запросы идут через соединение писателя под общей блокировкой записи"""
+    def __init__(self, db):
+        self._db = db
+        self._touched = set()
+
+    async def __aenter__(self):
+        await self._db._write_lock.acquire()
+        try:
+            await self._db._write(Database._execute, "BEGIN IMMEDIATE", ())
+            self._touched.clear()
+        except BaseException:
+            self._db._write_lock.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await self._db._write(Database._finish, exc_type is None)
+            if exc_type is None:
+                # Хуки выполняются под той же блокировкой, пока никто не успел записать
+                for hook in self._touched:
+                    try:
+                        await hook(self)
+                    except Exception as e:
+                        logger.error(f"Commit hook {hook} failed: {e}")
+        finally:
+            self._db._write_lock.release()
+
+    def _track(self, sql: str):
+        for tables, hook in self._db._commit_hooks:
+            if any(table in sql for table in tables):
+                self._touched.add(hook)
+
+    @timed_query
+    async def fetchone(self, sql: str, params=()):
+        return await self._db._write(Database._fetchone, sql, params)
+
+    @timed_query
+    async def fetchall(self, sql: str, params=()):
+        return await self._db._write(Database._fetchall, sql, params)
+
+    @timed_query
+    async def execute(self, sql: str, params=()) -> int:
+        """Выполняет запрос и возвращает количество затронутых строк"""
+        self._track(sql)
+        return await self._db._write(Database._execute, sql, params)
+
+    @timed_query
+    async def insert(self, sql: str, params=()) -> int:
+        """Выполняет INSERT и возвращает id новой строки"""
+        self._track(sql)
+        return await self._db._write(Database._insert, sql, params)
+
+    @timed_query
+    async def executemany(self, sql: str, rows) -> int:
+        """Выполняет запрос для каждой строки rows за один переход в поток писателя"""
+        self._track(sql)
+        return await self._db._write(Database._executemany, sql, rows)
+
+class Database(BaseDatabase):
+    """Выполняет запросы к SQLite в отдельных потоках, не блокируя цикл событий.
+
+    Соединения живут все время работы процесса: один писатель в собственном
+    потоке и пул читателей с query_only. В режиме WAL читатели (меню, профили,
+    статистика) не ждут писателя (балансы, переходы холдов).
+    """
+    def __init__(self, path: str, readers: int = DB_READERS):
+        super().__init__()
+        self.path = path
+        self._reader_pool = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-read")
+        self._writer_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._write_lock = asyncio.Lock()
+
+    def _connect(self, readonly: bool) -> sqlite3.Connection:
+        # Транзакциями управляем сами, поэтому соединение в режиме autocommit
+        conn = sqlite3.connect(
+            self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            isolation_level=None, check_same_thread=False
+        )
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        if readonly:
+            conn.execute("PRAGMA query_only = ON")
+        with self._connections_lock:
+            self._connections.append(conn)
+        return conn
+
+    def _thread_connection(self, readonly: bool) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect(readonly)
+        return conn
+
+    async def open(self):
+        """Соединения открываются лениво, каждое в своем потоке"""
+        logger.info(f"Database: SQLite {self.path}")
+
+    async def migrate(self, dry_run: bool = False):
+        init_db(dry_run=dry_run)
+        if dry_run:
+            return
+        # Режим WAL сохраняется в файле БД, достаточно включить один раз
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+        try:
+            mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+        finally:
+            conn.close()
+        logger.info(f"Database journal mode: {mode}")
+
+    def _run_read(self, func, *args):
+        return func(self._thread_connection(readonly=True), *args)
+
+    def _run_write(self, func, *args):
+        return func(self._thread_connection(readonly=False), *args)
+
+    async def _read(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._reader_pool, functools.partial(self._run_read, func, *args)
+        )
+
+    async def _write(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._writer_pool, functools.partial(self._run_write, func, *args)
+        )
+
+    @staticmethod
+    def _fetchone(conn, sql, params):
+        return conn.execute(sql, params).fetchone()
+
+    @staticmethod
+    def _fetchall(conn, sql, params):
+        return conn.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _execute(conn, sql, params):
+        return conn.execute(sql, params).rowcount
+
+    @staticmethod
+    def _insert(conn, sql, params):
+        return conn.execute(sql, params).lastrowid
+
+    @staticmethod
+    def _executemany(conn, sql, rows):
+        return conn.executemany(sql, rows).rowcount
+
+    @staticmethod
+    def _finish(conn, commit):
+        # SQLite сам откатывает транзакцию при некоторых ошибках
+        if conn.in_transaction:
+            conn.execute("COMMIT" if commit else "ROLLBACK")
+
+    @timed_query
+    async def fetchone(self, sql: str, params=()):
+        return await self._read(self._fetchone, sql, params)
+
+    @timed_query
+    async def fetchall(self, sql: str, params=()):
+        return await self._read(self._fetchall, sql, params)
+
+    async def explain(self, sql: str, params=()) -> list:
+        """План запроса без выполнения; идет мимо замеров"""
+        plan = await self._read(self._fetchall, f"EXPLAIN QUERY PLAN {sql}", params)
+        return [row[-1] for row in plan]
+
+    async def columns(self, table: str) -> list:
+        """Имена столбцов таблицы в порядке схемы"""
+        rows = await self._read(self._fetchall, f"PRAGMA table_info({table})", ())
+        return [row[1] for row in rows]
+
+    def _backup_to(self, target: str, pages: int, pause: float) -> int:
+        # Копия идет внутри одной читающей транзакции: в режиме WAL она не мешает
+        # писателю, а записи во время копирования не заставляют начинать заново
+        src = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+        dst = sqlite3.connect(target)
+        try:
+            src.execute("BEGIN")
+            src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+            src.backup(dst, pages=pages, progress=lambda status, remaining, total: time.sleep(pause))
+            src.execute("COMMIT")
+            return dst.execute("PRAGMA page_count").fetchone()[0]
+        finally:
+            dst.close()
+            src.close()
+
+    async def backup(self, target: str, pages: int = BACKUP_PAGES_PER_STEP,
+                     pause: float = BACKUP_STEP_PAUSE) -> int:
+        """Снимает согласованную копию БД в файл target шагами по pages страниц
+        с паузой между шагами, чтобы не отнимать диск у обработчиков.
+        Копирование идет в отдельном потоке; возвращает число страниц копии."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._backup_to, target, pages, pause)
+
+    def transaction(self) -> Transaction:
+        return Transaction(self)
+
+    async def close(self):
+        await self._group_commit.drain()
+        self._reader_pool.shutdown(wait=True)
+        self._writer_pool.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+# PostgreSQL вместо файла SQLite, если задан DATABASE_URL
+PG_MIGRATE_LOCK_KEY = 7265001  # Ключ advisory-блокировки для создания схемы
+PG_COMMIT_CHANNEL = "db_commit"  # Канал NOTIFY об изменениях таблиц с хуками
+PG_NOW_TEXT = "to_char(timezone('UTC', now()), 'YYYY-MM-DD HH24:MI:SS')"
+
+@functools.lru_cache(maxsize=1024)
+def pg_sql(sql: str) -> str:
+    """Переводит запрос с диалекта SQLite: ?-параметры в $n, datetime('now') в текст UTC"""
+    sql = sql.replace("datetime('now')", PG_NOW_TEXT)
+    parts = sql.split("'")
+    number = 0
+    # Четные части лежат вне строковых литералов
+    for i in range(0, len(parts), 2):
+        chunks = parts[i].split("?")
+        for j in range(1, len(chunks)):
+            number += 1
+            chunks[j] = f"${number}{chunks[j]}"
+        parts[i] = "".join(chunks)
+    return "'".join(parts)
+
+def pg_rowcount(status: str) -> int:
+    """Количество строк из статуса команды asyncpg ("UPDATE 3", "INSERT 0 1")"""
+    count = status.rsplit(" ", 1)[-1]
+    return int(count) if count.isdigit() else 0
+
+class PgTransaction(BaseTransaction):
+    """Транзакция PostgreSQL на соединении из пула.
+
+    Транзакции идут параллельно. Переходы статусов защищены условием в самом
+    UPDATE, а проверки вида «прочитать баланс и списать» блокируют нужные
+    строки через lock_rows, поэтому остаются корректными и при нескольких
+    процессах бота на одной базе.
+    """
+    def __init__(self, db):
+        self._db = db
+        self._conn = None
+        self._tx = None
+
+    async def __aenter__(self):
+        self._conn = await self._db._pool.acquire()
+        try:
+            self._tx = self._conn.transaction()
+            await self._tx.start()
+        except BaseException:
+            # Пул откатывает незавершенную транзакцию при возврате соединения
+            await self._db._pool.release(self._conn)
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                await self._tx.commit()
+            else:
+                await self._tx.rollback()
+        finally:
+            await self._db._pool.release(self._conn)
+
+    @timed_query
+    async def fetchone(self, sql: str, params=()):
+        row = await self._conn.fetchrow(pg_sql(sql), *params)
+        return tuple(row) if row is not None else None
+
+    @timed_query
+    async def fetchall(self, sql: str, params=()):
+        return [tuple(row) for row in await self._conn.fetch(pg_sql(sql), *params)]
+
+    @timed_query
+    async def execute(self, sql: str, params=()) -> int:
+        return pg_rowcount(await self._conn.execute(pg_sql(sql), *params))
+
+    @timed_query
+    async def insert(self, sql: str, params=()) -> int:
+        return await self._conn.fetchval(pg_sql(f"{sql} RETURNING id"), *params)
+
+    @timed_query
+    async def executemany(self, sql: str, rows) -> int:
+        statement = pg_sql(sql)
+        count = 0
+        for params in rows:
+            count += pg_rowcount(await self._conn.execute(statement, *params))
+        return count
+
+    async def lock_rows(self, table: str, column: str, values) -> list:
+        values = list(values)
+        if not values:
+            return []
+        rows = await self.fetchall(
+            f"SELECT {column} FROM {table} WHERE {column} IN ({', '.join('?' * len(values))}) FOR UPDATE",
+            values
+        )
+        return [row[0] for row in rows]
+
+    async def lock_table(self, table: str):
+        # SHARE ROW EXCLUSIVE конфликтует со вставками и с самой собой, но не с чтением
+        await self._conn.execute(f"LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE")
+
+class PostgresDatabase(BaseDatabase):
+    """Тот же интерфейс поверх пула соединений asyncpg.
+
+    Хуки фиксации срабатывают по NOTIFY, который шлют триггеры таблиц,
+    поэтому зеркала в памяти (счетчики очередей) обновляются после записи
+    в любом из процессов бота, а не только в текущем.
+    """
+    def __init__(self, url: str, pool_size: int = DB_POOL_SIZE):
+        super().__init__()
+        self.url = url
+        self.pool_size = pool_size
+        self._pool = None
+        self._listener = None
+        self._hook_tasks = {}
+        self._dirty_hooks = set()
+
+    async def open(self):
+        import asyncpg
+        
+        self._pool = await asyncpg.create_pool(self.url, min_size=1, max_size=self.pool_size)
+        self._listener = await asyncpg.connect(self.url)
+        await self._listener.add_listener(PG_COMMIT_CHANNEL, self._on_notify)
+        logger.info(f"Database: PostgreSQL, pool size {self.pool_size}")
+
+    async def migrate(self, dry_run: bool = False):
+        """Создает схему, эквивалентную init_db; все шаги повторяемые"""
+        notify_tables = sorted({table for tables, _ in self._commit_hooks for table in tables})
+        async with self._pool.acquire() as conn:
+            tx = conn.transaction()
+            await tx.start()
+            try:
+                # Процессы, стартующие одновременно, создают схему по очереди
+                await conn.execute("SELECT pg_advisory_xact_lock($1)", PG_MIGRATE_LOCK_KEY)
+                current = None
+                if await conn.fetchval("SELECT to_regclass('schema_version') IS NOT NULL"):
+                    current = await conn.fetchval("SELECT version FROM schema_version")
+                recount = current != SCHEMA_VERSION
+                for statement in pg_schema_statements(notify_tables, recount):
+                    await conn.execute(statement)
+                version = await conn.fetchval("SELECT version FROM schema_version")
+            except BaseException:
+                await tx.rollback()
+                raise
+            if dry_run:
+                await tx.rollback()
+                logger.info(f"Migration dry run finished: schema version {version} (PostgreSQL)")
+            else:
+                await tx.commit()
+                logger.info(f"Database initialization completed successfully "
+                            f"(schema version {version}, PostgreSQL)")
+
+    def _on_notify(self, conn, pid, channel, table):
+        for tables, hook in self._commit_hooks:
+            if table in tables:
+                self._schedule_hook(hook)
+
+    def _schedule_hook(self, hook):
+        # Пока хук выполняется, новые уведомления сводятся к одному повтору
+        task = self._hook_tasks.get(hook)
+        if task is not None and not task.done():
+            self._dirty_hooks.add(hook)
+            return
+        self._hook_tasks[hook] = asyncio.create_task(self._run_hook(hook))
+
+    async def _run_hook(self, hook):
+        while True:
+            self._dirty_hooks.discard(hook)
+            try:
+                await hook(self)
+            except Exception as e:
+                logger.error(f"Commit hook {hook} failed: {e}")
+            if hook not in self._dirty_hooks:
+                return
+
+    @timed_query
+    async def fetchone(self, sql: str, params=()):
+        row = await self._pool.fetchrow(pg_sql(sql), *params)
+        return tuple(row) if row is not None else None
+
+    @timed_query
+    async def fetchall(self, sql: str, params=()):
+        return [tuple(row) for row in await self._pool.fetch(pg_sql(sql), *params)]
+
+    async def explain(self, sql: str, params=()) -> list:
+        """План запроса без выполнения; идет мимо замеров"""
+        plan = await self._pool.fetch(f"EXPLAIN {pg_sql(sql)}", *params)
+        return [row[0].strip() for row in plan]
+
+    async def columns(self, table: str) -> list:
+        """Имена столбцов таблицы в порядке схемы"""
+        rows = await self._pool.fetch("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = $1
+            ORDER BY ordinal_position
+        """, table)
+        return [row[0] for row in rows]
+
+    def transaction(self) -> PgTransaction:
+        return PgTransaction(self)
+
+    async def close(self):
+        await self._group_commit.drain()
+        if self._listener is not None:
+            await self._listener.close()
+        if self._pool is not None:
+            await self._pool.close()
+
+def create_database():
+    if DATABASE_URL.startswith(("postgres://", "postgresql://")):
+        return PostgresDatabase(DATABASE_URL)
+    return Database(DATABASE)
+
+db = create_database()
+
+# Счетчики очередей по сервисам и статусам
+COUNTED_TABLES = {
+    "whatsapp_numbers": "whatsapp",
+    "max_numbers": "max",
+    "sms_works": "sms",
+}
+
+class StatusCounters:
+    """Зеркало таблицы status_counters в памяти.
+
+    Таблицу обновляют триггеры в той же транзакции, что и смену статуса,
+    а зеркало перечитывается после фиксации, поэтому чтение счетчика
+    не зависит от количества строк в таблицах номеров.
+    """
+    def __init__(self):
+        self._counts = {}
+
+    async def load(self, source):
+        rows = await source.fetchall("SELECT service, status, count FROM status_counters")
+        self._counts = {(service, status): count for service, status, count in rows}
+
+    def get(self, service: str, *statuses: str) -> int:
+        """Сумма счетчиков сервиса по статусам, без статусов — по всем"""
+        if not statuses:
+            return sum(count for (name, _), count in self._counts.items() if name == service)
+        return sum(self._counts.get((service, status), 0) for status in statuses)
+
+queue_counters = StatusCounters()
+db.on_commit(COUNTED_TABLES, queue_counters.load)
+
+# Журнал движения средств
+BALANCE_CHECKPOINT_INTERVAL = 3600  # Секунд между контрольными точками балансов
+
+# Причины проводок; source_id указывает на строку, из-за которой она сделана
+LEDGER_OPENING_BALANCE = "opening_balance"  # Баланс до появления журнала (users.user_id)
+LEDGER_REFERRAL_BONUS = "referral_bonus"  # Бонус за приглашение (id приглашенного)
+LEDGER_SMS_REWARD = "sms_reward"  # Оплата SMS WORK (sms_works.id)
+LEDGER_REFERRAL_PAYOUT = "referral_payout"  # Процент с вывода реферала (withdraw_requests.id)
+LEDGER_WITHDRAW = "withdraw"  # Списание по заявке на вывод (withdraw_requests.id)
+
+# Проводки, которые учитываются в заработке пользователя (total_earned_usd)
+LEDGER_EARNING_REASONS = (LEDGER_SMS_REWARD,)
+
+def to_cents(amount_usd: float) -> int:
+    return int(round(amount_usd * 100))
+
+async def post_ledger(tx: Transaction, entries) -> int:
+    """Добавляет проводки (user_id, сумма в $, причина, source_id) одним пакетом.
+
+    Баланс пользователя и общие итоги обновляют триггеры в той же транзакции.
+    Проводка с уже записанными причиной и источником пропускается, поэтому
+    повторная обработка той же заявки не начислит деньги дважды.
+    Возвращает количество записанных проводок.
+    """
+    return await tx.executemany("""
+        INSERT INTO balance_ledger (user_id, amount_cents, reason, source_id)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (reason, source_id) DO NOTHING
+    """, [(user_id, to_cents(amount), reason, source_id)
+          for user_id, amount, reason, source_id in entries])
+
+async def write_balance_checkpoints(tx) -> tuple:
+    """Фиксирует балансы пользователей, по которым были проводки с прошлой точки.
+
+    Новая точка = прошлая точка + сумма проводок после нее; расхождение
+    с users.balance_cents означает, что баланс меняли в обход журнала.
+    Возвращает (количество точек, количество расхождений).
+    """
+    # Номера проводок выдаются до фиксации: без блокировки проводка с номером
+    # меньше upto могла бы зафиксироваться позже и не попасть ни в одну точку
+    await tx.lock_table("balance_ledger")
+    since = await tx.fetchval(
+        "SELECT COALESCE(MAX(ledger_id), 0) FROM balance_checkpoints", default=0
+    )
+    upto = await tx.fetchval("SELECT COALESCE(MAX(id), 0) FROM balance_ledger", default=0)
+    
+    written = await tx.execute("""
+        INSERT INTO balance_checkpoints (user_id, ledger_id, balance_cents, created_ts)
+        SELECT l.user_id, ?, COALESCE(MAX(c.balance_cents), 0) + SUM(l.amount_cents), ?
+        FROM balance_ledger l
+        LEFT JOIN balance_checkpoints c ON c.user_id = l.user_id
+        WHERE l.id > ? AND l.id <= ?
+        GROUP BY l.user_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            ledger_id = excluded.ledger_id,
+            balance_cents = excluded.balance_cents,
+            created_ts = excluded.created_ts
+    """, (upto, int(time.time()), since, upto))
+    
+    mismatched = await tx.fetchall("""
+        SELECT c.user_id, c.balance_cents, u.balance_cents
+        FROM balance_checkpoints c
+        JOIN users u ON u.user_id = c.user_id
+        WHERE c.ledger_id = ? AND c.balance_cents != u.balance_cents
+    """, (upto,))
+    
+    for user_id, expected, actual in mismatched:
+        logger.error(f"Balance mismatch for user {user_id}: ledger {expected}, users {actual}")
+    return written, len(mismatched)
+
+async def balance_checkpoint_loop():
+    while True:
+        await asyncio.sleep(BALANCE_CHECKPOINT_INTERVAL)
+        try:
+            async with db.transaction() as tx:
+                written, mismatched = await write_balance_checkpoints(tx)
+            if written:
+                logger.info(f"Balance checkpoints: {written} users, {mismatched} mismatches")
+        except Exception as e:
+            logger.error(f"Ошибка записи контрольных точек балансов: {e}")
+
+# Архив завершенной работы.
+# Строки в конечных статусах старше ARCHIVE_AFTER_DAYS переносятся в таблицы
+# <таблица>_archive с теми же столбцами. Столбцы переносятся по именам, поэтому
+# порядок в архиве может отличаться, но столбец, добавленный в горячую таблицу,
+# нужно добавить и в ее архив — иначе перенос остановится с ошибкой.
+ARCHIVE_TABLES = {
+    "whatsapp_numbers": ("completed", "failed"),
+    "max_numbers": ("completed", "failed"),
+    "sms_works": ("completed",),
+}
+ARCHIVE_INTERVAL = 3600  # Секунд между проходами архивации
+ARCHIVE_BATCH_SIZE = 500  # Строк за одну транзакцию переноса
+
+# Таблица -> список столбцов для INSERT и SELECT переноса, читается при запуске
+archive_columns = {}
+
+async def load_archive_columns(source):
+    for table in ARCHIVE_TABLES:
+        archive_columns[table] = ", ".join(await source.columns(table))
+
+async def archive_batch(tx, table: str, cutoff_ts: int) -> int:
+    """Переносит в архив до ARCHIVE_BATCH_SIZE строк, созданных раньше cutoff_ts.
+
+    Счетчики статусов не меняются: удаление из горячей таблицы уменьшает их,
+    а вставка в архив — увеличивает обратно.
+    """
+    statuses = ARCHIVE_TABLES[table]
+    rows = await tx.fetchall(f"""
+        SELECT id FROM {table}
+        WHERE status IN ({', '.join('?' * len(statuses))}) AND created_ts < ?
+        LIMIT ?
+    """, (*statuses, cutoff_ts, ARCHIVE_BATCH_SIZE))
+    if not rows:
+        return 0
+    
+    # Строки, которые уже перенес параллельный проход, пропускаются
+    ids = await tx.lock_rows(table, "id", [row[0] for row in rows])
+    if not ids:
+        return 0
+    placeholders = ", ".join("?" * len(ids))
+    columns = archive_columns[table]
+    await tx.execute(
+        f"INSERT INTO {table}_archive ({columns}) SELECT {columns} FROM {table} WHERE id IN ({placeholders})",
+        ids
+    )
+    await tx.execute(f"DELETE FROM {table} WHERE id IN ({placeholders})", ids)
+    return len(ids)
+
+async def archive_finished_work(max_age_days: int = ARCHIVE_AFTER_DAYS) -> int:
+    """Переносит завершенную работу в архив партиями, каждая в своей транзакции,
+    чтобы не держать блокировку записи. Возвращает количество перенесенных строк."""
+    cutoff_ts = int(time.time()) - max_age_days * 86400
+    moved = 0
+    for table in ARCHIVE_TABLES:
+        while True:
+            async with db.transaction() as tx:
+                count = await archive_batch(tx, table, cutoff_ts)
+            moved += count
+            if count < ARCHIVE_BATCH_SIZE:
+                break
+            await asyncio.sleep(0)
+    return moved
+
+async def archive_loop():
+    while True:
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+        try:
+            moved = await archive_finished_work()
+            if moved:
+                logger.info(f"Archived {moved} finished rows")
+        except Exception as e:
+            logger.error(f"Ошибка архивации завершенной работы: {e}")
+
+async def count_with_archive(table: str, where: str, params=()) -> int:
+    """COUNT(*) по горячей таблице вместе с архивом.
+
+    Нужен только для конечных статусов: строки в остальных в архив не попадают.
+    """
+    return await db.fetchval(f"""
+        SELECT (SELECT COUNT(*) FROM {table} WHERE {where})
+             + (SELECT COUNT(*) FROM {table}_archive WHERE {where})
+    """, (*params, *params), default=0)
+
+# Дневные сводки.
+# Фоновая задача складывает события каждого дня по сервисам в daily_stats:
+# одна строка на (день, сервис, показатель). Дни раньше отметки в rollup_marks
+# окончательны, поэтому проход пересчитывает только дни от отметки (диапазоны
+# по индексам меток времени) и сдвигает ее на начало текущего дня. Дни — московские
+ROLLUP_INTERVAL = 600  # Секунд между проходами
+ROLLUP_MARK = "daily_stats"
+DAY_SECONDS = 86400
+MOSCOW_OFFSET = int(MOSCOW_TZ.utcoffset(None).total_seconds())
+# (сервис, показатель, таблица, столбец времени события, столбец суммы в $)
+ROLLUP_METRICS = [
+    ("whatsapp", "submitted", "whatsapp_numbers", "created_ts", None),
+    ("whatsapp", "hold_started", "whatsapp_numbers", "hold_start_ts", None),
+    ("whatsapp", "failed", "whatsapp_numbers", "failed_ts", None),
+    ("max", "submitted", "max_numbers", "created_ts", None),
+    ("max", "hold_started", "max_numbers", "hold_start_ts", None),
+    ("sms", "submitted", "sms_works", "created_ts", None),
+    ("sms", "completed", "sms_works", "completed_ts", "amount"),
+    ("payouts", "paid", "withdraw_requests", "paid_ts", "amount_usd"),
+]
+
+def day_start(ts: int) -> int:
+    """Начало московского дня, в который попадает ts"""
+    return ts - (ts + MOSCOW_OFFSET) % DAY_SECONDS
+
+def rollup_sql(table: str, ts_column: str, amount_column) -> str:
+    """События таблицы с отметки по дням: (номер дня, количество, сумма в центах)"""
+    amount = f"SUM(ROUND({amount_column} * 100))" if amount_column else "0"
+    return (f"SELECT ({ts_column} + {MOSCOW_OFFSET}) / {DAY_SECONDS} AS day_no, COUNT(*), {amount} "
+            f"FROM {table} WHERE {ts_column} >= ? GROUP BY day_no")
+
+def rollup_sources(table: str) -> list:
+    return [table] + ([f"{table}_archive"] if table in ARCHIVE_TABLES else [])
+
+async def rollup_daily_stats(now: int = None) -> int:
+    """Пересчитывает сводки от отметки до текущего дня включительно.
+    Возвращает количество записанных строк сводки."""
+    now = now or int(time.time())
+    mark = await db.fetchval(
+        "SELECT value FROM rollup_marks WHERE name = ?", (ROLLUP_MARK,), default=0
+    )
+    
+    totals = {}
+    for service, metric, table, ts_column, amount_column in ROLLUP_METRICS:
+        for source in rollup_sources(table):
+            sql = rollup_sql(source, ts_column, amount_column)
+            for day_no, count, amount_cents in await db.fetchall(sql, (mark,)):
+                total = totals.setdefault((day_no, service, metric), [0, 0])
+                total[0] += count
+                total[1] += int(amount_cents or 0)
+    
+    rows = [
+        (datetime.fromtimestamp(day_no * DAY_SECONDS, timezone.utc).strftime("%Y-%m-%d"),
+         service, metric, count, amount_cents)
+        for (day_no, service, metric), (count, amount_cents) in totals.items()
+    ]
+    async with db.transaction() as tx:
+        await tx.execute("DELETE FROM daily_stats WHERE day >= ?", (format_ts(mark, "%Y-%m-%d"),))
+        if rows:
+            await tx.executemany("""
+                INSERT INTO daily_stats (day, service, metric, count, amount_cents)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (day, service, metric) DO UPDATE SET
+                    count = excluded.count,
+                    amount_cents = excluded.amount_cents
+            """, rows)
+        # Текущий день еще не закончился и будет пересчитан следующим проходом
+        await tx.execute("""
+            INSERT INTO rollup_marks (name, value) VALUES (?, ?)
+            ON CONFLICT (name) DO UPDATE SET value = excluded.value
+        """, (ROLLUP_MARK, day_start(now)))
+    return len(rows)
+
+def rollup_count(values: dict, service: str, metric: str) -> int:
+    return values.get((service, metric), (0, 0))[0]
+
+def rollup_usd(values: dict, service: str, metric: str) -> float:
+    return values.get((service, metric), (0, 0))[1] / 100
+
+async def rollup_loop():
+    while True:
+        try:
+            await rollup_daily_stats()
+        except Exception as e:
+            logger.error(f"Ошибка пересчета дневных сводок: {e}")
+        await asyncio.sleep(ROLLUP_INTERVAL)
+
+# Резервные копии SQLite
+def backup_files() -> list:
+    """Готовые копии, от старых к новым (в имени время создания в UTC)"""
+    stem = Path(DATABASE).stem
+    return sorted(path for path in BACKUP_DIR.glob(f"{stem}-*")
+                  if path.name.endswith((".db", ".db.gz")))
+
+def compress_backup(path: Path, target: Path):
+    with open(path, "rb") as src, gzip.open(target, "wb", compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+def verify_backup(path: Path, compressed: bool):
+    """Восстанавливает копию во временный файл и проверяет его: целостность,
+    версию схемы и читаемость таблиц. При ошибке бросает sqlite3.DatabaseError"""
+    restored = path.with_name(path.name + ".restore")
+    try:
+        if compressed:
+            with gzip.open(path, "rb") as src, open(restored, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+        else:
+            src, dst = sqlite3.connect(path), sqlite3.connect(restored)
+            try:
+                src.backup(dst)
+            finally:
+                dst.close()
+                src.close()
+        
+        conn = sqlite3.connect(restored)
+        try:
+            check = conn.execute("PRAGMA integrity_check").fetchone()[0]
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            conn.execute("SELECT COUNT(*) FROM users").fetchone()
+        finally:
+            conn.close()
+        if check != "ok":
+            raise sqlite3.DatabaseError(f"integrity_check: {check}")
+        if version != SCHEMA_VERSION:
+            raise sqlite3.DatabaseError(f"schema version {version}, expected {SCHEMA_VERSION}")
+    finally:
+        restored.unlink(missing_ok=True)
+
+async def make_backup() -> Path:
+    """Снимает копию, при необходимости сжимает, проверяет восстановлением
+    и только после этого дает ей итоговое имя и удаляет лишние старые копии.
+    Незавершенные файлы имеют суффикс .tmp и в ротацию не попадают."""
+    loop = asyncio.get_running_loop()
+    BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+    final = BACKUP_DIR / f"{Path(DATABASE).stem}-{stamp}.db{'.gz' if BACKUP_COMPRESS else ''}"
+    raw = BACKUP_DIR / f"{Path(DATABASE).stem}-{stamp}.db.tmp"
+    work = final.with_name(final.name + ".tmp")
+    
+    started = time.monotonic()
+    try:
+        pages = await db.backup(str(raw))
+        if BACKUP_COMPRESS:
+            await loop.run_in_executor(None, compress_backup, raw, work)
+            raw.unlink()
+        await loop.run_in_executor(None, verify_backup, work, BACKUP_COMPRESS)
+        work.rename(final)
+    finally:
+        raw.unlink(missing_ok=True)
+        work.unlink(missing_ok=True)
+    
+    for old in backup_files()[:-BACKUP_KEEP]:
+        old.unlink()
+    logger.info(f"Backup {final.name}: {pages} pages, {final.stat().st_size} bytes, "
+                f"{time.monotonic() - started:.1f}s")
+    return final
+
+async def backup_loop():
+    while True:
+        await asyncio.sleep(BACKUP_INTERVAL_HOURS * 3600)
+        try:
+            await make_backup()
+        except Exception as e:
+            logger.error(f"Ошибка резервного копирования базы данных: {e}")
+
+# Снимок статистики для админ-панели
+STATS_TTL_SECONDS = 30
+
+class StatsSnapshot:
+    """Агрегированная статистика бота с временем жизни.
+
+    Пользователи и суммы балансов берутся из итогов running_totals, которые
+    ведут триггеры, ожидающие заявки на вывод берутся по индексу статуса,
+    количество номеров берется из счетчиков очередей. Пока снимок
+    свежий, он отдается без запросов; устаревший снимок отдается сразу,
+    а пересчет запускается в фоне не чаще одного раза за интервал.
+    """
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.data = None
+        self.taken_at = 0.0
+        self._lock = asyncio.Lock()
+        self._refresh_task = None
+
+    async def _collect(self) -> dict:
+        row = await db.fetchone("""
+            SELECT t.total_users, t.total_balance, t.total_earned,
+                   w.pending_withdrawals, w.pending_withdrawals_amount
+            FROM (
+                SELECT COALESCE(SUM(CASE WHEN name = 'users' THEN value END), 0) AS total_users,
+                       COALESCE(SUM(CASE WHEN name = 'balance_cents' THEN value END), 0) / 100.0
+                           AS total_balance,
+                       COALESCE(SUM(CASE WHEN name = 'earned_cents' THEN value END), 0) / 100.0
+                           AS total_earned
+                FROM running_totals
+            ) AS t,
+            (
+                SELECT COUNT(*) AS pending_withdrawals,
+                       COALESCE(SUM(amount_usd), 0) AS pending_withdrawals_amount
+                FROM withdraw_requests
+                WHERE status = 'pending'
+            ) AS w
+        """)
+        data = dict(zip(
+            ("total_users", "total_balance", "total_earned",
+             "pending_withdrawals", "pending_withdrawals_amount"),
+            row
+        ))
+        for service in ("whatsapp", "max", "sms"):
+            data[f"total_{service}"] = queue_counters.get(service)
+            data[f"pending_{service}"] = queue_counters.get(service, "pending")
+        data["active_whatsapp"] = queue_counters.get("whatsapp", "hold_active", "active")
+        data["active_max"] = queue_counters.get("max", "active")
+        return data
+
+    async def refresh(self) -> dict:
+        """Пересчитывает снимок; параллельные вызовы ждут один пересчет"""
+        taken_before = self.taken_at
+        async with self._lock:
+            if self.data is not None and self.taken_at != taken_before:
+                return self.data
+            self.data = await self._collect()
+            self.taken_at = time.monotonic()
+            return self.data
+
+    async def _refresh_in_background(self):
+        try:
+            await self.refresh()
+        except Exception as e:
+            logger.error(f"Ошибка обновления статистики: {e}")
+
+    async def get(self) -> dict:
+        if self.data is None:
+            return await self.refresh()
+        if time.monotonic() - self.taken_at > self.ttl:
+            if self._refresh_task is None or self._refresh_task.done():
+                self._refresh_task = asyncio.create_task(self._refresh_in_background())
+        return self.data
+
+admin_stats_snapshot = StatsSnapshot(STATS_TTL_SECONDS)
+
 # Класс для ожидающих подтверждений
 class PendingConfirmations:
     def __init__(self):
@@ -214,6 +1463,12 @@ def rub_to_usd(rub_amount: float) -> float:
 def usd_to_rub(usd_amount: float) -> float:
     return usd_amount * EXCHANGE_RATE
 
+def format_ts(ts, fmt: str = "%d.%m.%Y %H:%M") -> str:
+    """Форматирует метку времени в секундах эпохи по московскому времени"""
+    if ts is None:
+        return "нет"
+    return datetime.fromtimestamp(ts, MOSCOW_TZ).strftime(fmt)
+
 def validate_phone(phone: str) -> bool:
     try:
         parsed = phonenumbers.parse(phone)
@@ -221,40 +1476,331 @@ def validate_phone(phone: str) -> bool:
     except:
         return False
 
-def get_user_referral_source(user_id: int) -> str:
+async def get_user_referral_source(user_id: int) -> str:
     """Получает источник реферала пользователя"""
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT referral_source FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        if result and result[0]:
-            return result[0]
-        return "не указан"
-
-async def notify_admins(message: str, reply_markup=None, parse_mode=ParseMode.HTML):
-    """Отправляет уведомление всем администраторам"""
-    all_admins = set(MAIN_ADMINS + ADMIN_IDS)
-    if not all_admins:
+    return await db.fetchval(
+        "SELECT referral_source FROM users WHERE user_id = ?", (user_id,), default="не указан"
+    ) or "не указан"
+
+# Лимит и повторы запросов к Bot API.
+# Middleware сессии бота пропускает каждый запрос, кроме long polling, через
+# общий ограничитель скорости. Ограничитель подстраивается под ответы Telegram:
+# после каждого успешного запроса скорость понемногу растет до
+# TELEGRAM_RATE_LIMIT, а на RetryAfter снижается, и все запросы ждут
+# указанное время. Так скорость держится около наибольшей, которую Telegram
+# принимает. Запрос с RetryAfter повторяется, после ошибок сети и 5xx — с
+# экспоненциальной задержкой со случайным разбросом. Счетчики видны в /telegram_stats
+TELEGRAM_RATE_MIN = 1.0  # Ниже этой скорости ограничитель не опускается
+TELEGRAM_RATE_DECREASE = 0.8  # Доля скорости, остающаяся после RetryAfter
+TELEGRAM_RATE_INCREASE = 0.25  # Прирост скорости за секунду работы без RetryAfter
+TELEGRAM_BURST = 5  # Запросов разом после простоя
+TELEGRAM_RETRIES = 3  # Повторов одного запроса
+TELEGRAM_BACKOFF_BASE = 1.0  # Секунд до первого повтора после ошибки сети или 5xx
+TELEGRAM_BACKOFF_MAX = 30.0
+# Методы, повтор которых не меняет результат, кроме чтений get*. Остальные
+# (отправка сообщений, правки) после ошибки сети или 5xx могли уже выполниться,
+# поэтому повторяются, только если соединение с сервером не было установлено
+TELEGRAM_IDEMPOTENT_METHODS = {"SetWebhook", "DeleteWebhook"}
+
+class TokenBucket:
+    """Ограничитель скорости: rate токенов в секунду, в запасе не больше capacity"""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+    
+    def pause(self, seconds: float):
+        """Не выдает токены seconds секунд, запас после паузы пустой"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+        self.updated = self.paused_until
+    
+    async def acquire(self):
+        # Ожидающие получают токены по очереди захвата блокировки
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class AdaptiveRateLimiter(TokenBucket):
+    """TokenBucket, скорость которого медленно растет после успешных запросов
+    (на TELEGRAM_RATE_INCREASE в секунду при полной загрузке) и падает на RetryAfter"""
+    def __init__(self, max_rate: float, min_rate: float, capacity: float):
+        super().__init__(max_rate, capacity)
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+    
+    def succeeded(self):
+        self.rate = min(self.max_rate, self.rate + TELEGRAM_RATE_INCREASE / self.rate)
+    
+    def throttled(self, retry_after: float):
+        self.rate = max(self.min_rate, self.rate * TELEGRAM_RATE_DECREASE)
+        self.pause(retry_after)
+
+class TelegramStats:
+    """Счетчики запросов к Bot API с момента запуска"""
+    def __init__(self):
+        self.requests = 0
+        self.throttled = 0  # Ответов RetryAfter
+        self.throttled_seconds = 0.0  # Сумма пауз по RetryAfter
+        self.retries = {"flood": 0, "network": 0, "server": 0}
+        self.failed = 0  # Запросов, не прошедших и после всех повторов
+        self.methods = {}  # Метод -> ответов RetryAfter на него
+
+telegram_limiter = AdaptiveRateLimiter(TELEGRAM_RATE_LIMIT, TELEGRAM_RATE_MIN, TELEGRAM_BURST)
+telegram_stats = TelegramStats()
+
+def telegram_retry_safe(method, error) -> bool:
+    """Можно ли повторить запрос после ошибки сети или 5xx, не рискуя дублем"""
+    name = type(method).__name__
+    if name.startswith("Get") or name in TELEGRAM_IDEMPOTENT_METHODS:
+        return True
+    # aiogram поднимает TelegramNetworkError внутри except, исходная ошибка в __context__
+    return isinstance(error.__context__, aiohttp.ClientConnectorError)
+
+class TelegramRetryMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        # getUpdates держит соединение до прихода обновлений, повторы у polling свои
+        if isinstance(method, GetUpdates):
+            return await make_request(bot, method)
+        
+        attempt = 0
+        while True:
+            await telegram_limiter.acquire()
+            telegram_stats.requests += 1
+            try:
+                response = await make_request(bot, method)
+            except exceptions.TelegramRetryAfter as e:
+                name = type(method).__name__
+                telegram_stats.throttled += 1
+                telegram_stats.throttled_seconds += e.retry_after
+                telegram_stats.methods[name] = telegram_stats.methods.get(name, 0) + 1
+                telegram_limiter.throttled(e.retry_after)
+                logger.warning(f"Flood control on {name}: retry after {e.retry_after}s, "
+                               f"rate lowered to {telegram_limiter.rate:.1f}/s")
+                reason, delay, error = "flood", 0, e  # Паузу выдерживает ограничитель
+            except exceptions.TelegramNetworkError as e:
+                reason, error = "network", e
+                delay = random.uniform(0, min(TELEGRAM_BACKOFF_MAX, TELEGRAM_BACKOFF_BASE * 2 ** attempt))
+            except exceptions.TelegramServerError as e:
+                reason, error = "server", e
+                delay = random.uniform(0, min(TELEGRAM_BACKOFF_MAX, TELEGRAM_BACKOFF_BASE * 2 ** attempt))
+            else:
+                telegram_limiter.succeeded()
+                return response
+            
+            if reason != "flood" and not telegram_retry_safe(method, error):
+                telegram_stats.failed += 1
+                logger.warning(f"{type(method).__name__} not retried after {reason} error, "
+                               f"the request may have been executed: {error}")
+                raise error
+            if attempt >= TELEGRAM_RETRIES:
+                telegram_stats.failed += 1
+                raise error
+            attempt += 1
+            telegram_stats.retries[reason] += 1
+            await asyncio.sleep(delay)
+
+bot.session.middleware(TelegramRetryMiddleware())
+
+# Очередь исходящих сообщений.
+# Сообщения бота пользователям и админам отправляются через outbox: лимит на
+# чат (около одного сообщения в секунду с короткими всплесками) соблюдается
+# здесь, общий лимит бота — в middleware сессии, и когда скорости не хватает,
+# первыми уходят сообщения важного класса. Сообщения в один чат уходят строго
+# по очереди. Чат получает приоритет самого важного из ждущих в нем сообщений,
+# поэтому чек выплаты не ждет конца рассылки, даже если перед ним в том же чате
+# стоит ее сообщение
+PRIORITY_URGENT = 0  # Чеки выплат и коды входа
+PRIORITY_USER = 1  # Остальные уведомления пользователям
+PRIORITY_ADMIN = 2  # Уведомления админам
+PRIORITY_BROADCAST = 3  # Рассылка
+OUTBOX_CHAT_RATE = 1.0  # Сообщений в секунду в один чат
+OUTBOX_CHAT_BURST = 3
+OUTBOX_WORKERS = 16  # Одновременных запросов к Telegram
+OUTBOX_CHAT_CACHE = 10000  # Чатов, для которых помнится расход лимита
+
+class OutboundQueue:
+    """Очередь запросов к Telegram с приоритетами, лимитами и пулом отправителей"""
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.pending = {}  # chat_id -> deque (приоритет, вызов, future)
+        # chat_id -> (приоритет, номер) записи в ready, "cooling" или "sending"
+        self.state = {}
+        self.chat_tokens = {}  # chat_id -> (токены, время обновления)
+        self.ready = []  # Куча (приоритет, номер, chat_id) чатов, готовых к отправке
+        self.cooling = []  # Куча (время готовности, chat_id) чатов, ждущих лимита
+        self.seq = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.tasks = []
+    
+    def start(self):
+        self.tasks = [asyncio.create_task(self.worker(), name=f"outbox_{i}")
+                      for i in range(self.workers)]
+    
+    async def send(self, priority: int, method, *args, **kwargs):
+        """Ставит вызов метода бота в очередь чата и возвращает его результат.
+
+        Чат берется из аргумента chat_id или из первого позиционного аргумента.
+        """
+        chat_id = kwargs["chat_id"] if "chat_id" in kwargs else args[0]
+        future = asyncio.get_running_loop().create_future()
+        call = functools.partial(method, *args, **kwargs)
+        self.pending.setdefault(chat_id, deque()).append((priority, call, future))
+        if not self.tasks:
+            self.start()
+        
+        state = self.state.get(chat_id)
+        if state is None:
+            self.schedule(chat_id)
+        elif isinstance(state, tuple) and priority < state[0]:
+            # Чат уже ждет в куче: повышаем его приоритет новой записью
+            self.push_ready(chat_id, priority)
+        return await future
+    
+    def push_ready(self, chat_id: int, priority: int):
+        seq = next(self.seq)
+        self.state[chat_id] = (priority, seq)
+        heapq.heappush(self.ready, (priority, seq, chat_id))
+        self.wakeup.set()
+    
+    def cool(self, chat_id: int, ready_at: float):
+        self.state[chat_id] = "cooling"
+        heapq.heappush(self.cooling, (ready_at, chat_id))
+        self.wakeup.set()
+    
+    def schedule(self, chat_id: int):
+        """Ставит чат с ждущими сообщениями в готовые или ждать лимита чата"""
+        now = time.monotonic()
+        tokens, updated = self.chat_tokens.get(chat_id, (OUTBOX_CHAT_BURST, now))
+        tokens = min(OUTBOX_CHAT_BURST, tokens + (now - updated) * OUTBOX_CHAT_RATE)
+        self.chat_tokens[chat_id] = (tokens, now)
+        if tokens < 1:
+            self.cool(chat_id, now + (1 - tokens) / OUTBOX_CHAT_RATE)
+        else:
+            self.push_ready(chat_id, min(item[0] for item in self.pending[chat_id]))
+    
+    async def take(self) -> int:
+        """Ждет чат, готовый к отправке, с наиболее важным сообщением"""
+        while True:
+            now = time.monotonic()
+            while self.cooling and self.cooling[0][0] <= now:
+                _, chat_id = heapq.heappop(self.cooling)
+                self.schedule(chat_id)
+            while self.ready:
+                priority, seq, chat_id = heapq.heappop(self.ready)
+                # Записи, замененные повышением приоритета, пропускаются
+                if self.state.get(chat_id) == (priority, seq):
+                    self.state[chat_id] = "sending"
+                    return chat_id
+            
+            self.wakeup.clear()
+            timeout = self.cooling[0][0] - now if self.cooling else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def deliver(self, chat_id: int):
+        queue = self.pending[chat_id]
+        priority, call, future = queue.popleft()
+        # Отправитель, который перестал ждать, лимит не расходует
+        if not future.done():
+            tokens, updated = self.chat_tokens[chat_id]
+            self.chat_tokens[chat_id] = (tokens - 1, updated)
+            try:
+                result = await call()
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+        
+        if queue:
+            self.schedule(chat_id)
+        else:
+            del self.pending[chat_id]
+            del self.state[chat_id]
+            if len(self.chat_tokens) > OUTBOX_CHAT_CACHE:
+                self.prune()
+    
+    def prune(self):
+        """Забывает чаты без сообщений в очереди, лимит которых уже восстановился"""
+        refill = OUTBOX_CHAT_BURST / OUTBOX_CHAT_RATE
+        now = time.monotonic()
+        self.chat_tokens = {
+            chat_id: value for chat_id, value in self.chat_tokens.items()
+            if chat_id in self.state or now - value[1] < refill
+        }
+    
+    async def worker(self):
+        while True:
+            chat_id = await self.take()
+            try:
+                await self.deliver(chat_id)
+            except Exception as e:
+                logger.error(f"Ошибка очереди исходящих сообщений: {e}")
+
+outbox = OutboundQueue(OUTBOX_WORKERS)
+
+# Уведомления админам рассылаются отдельной задачей, не задерживая обработчик,
+# который их вызвал. Сообщения всем админам ставятся в очередь исходящих
+# сообщений сразу, параллельность ограничивает ее пул отправителей
+admin_notify_tasks = set()
+
+async def send_admin_notification(admin_id: int, message: str, reply_markup, parse_mode):
+    await outbox.send(
+        PRIORITY_ADMIN, bot.send_message,
+        admin_id,
+        message,
+        reply_markup=reply_markup,
+        parse_mode=parse_mode
+    )
+
+async def fan_out_admins(admin_ids: list, message: str, reply_markup, parse_mode):
+    results = await asyncio.gather(
+        *(send_admin_notification(admin_id, message, reply_markup, parse_mode)
+          for admin_id in admin_ids),
+        return_exceptions=True
+    )
+    failures = [f"{admin_id}: {result}" for admin_id, result in zip(admin_ids, results)
+                if isinstance(result, BaseException)]
+    if failures:
+        logger.error(
+            f"Уведомление не доставлено {len(failures)} из {len(admin_ids)} админов: "
+            + "; ".join(failures)
+        )
+
+def notify_admins(message: str, reply_markup=None, parse_mode=ParseMode.HTML):
+    """Отправляет уведомление всем администраторам в фоне и возвращает задачу"""
+    admin_ids = [admin_id for admin_id in set(MAIN_ADMINS + ADMIN_IDS) if admin_id is not None]
+    if not admin_ids:
         logger.warning("Нет администраторов для уведомления")
-        return
+        return None
     
-    for admin_id in all_admins:
-        if admin_id is None:
-            continue
-        try:
-            await bot.send_message(
-                admin_id, 
-                message, 
-                reply_markup=reply_markup,
-                parse_mode=parse_mode
-            )
-        except Exception as e:
-            logger.error(f"Ошибка уведомления админа {admin_id}: {e}")
+    task = asyncio.create_task(fan_out_admins(admin_ids, message, reply_markup, parse_mode))
+    # Держим ссылку, иначе задачу может собрать сборщик мусора
+    admin_notify_tasks.add(task)
+    task.add_done_callback(admin_notify_tasks.discard)
+    return task
 
 async def notify_admin(admin_id: int, message: str, reply_markup=None, parse_mode=ParseMode.HTML):
     """Отправляет уведомление конкретному администратору"""
     try:
-        await bot.send_message(
+        await outbox.send(
+            PRIORITY_ADMIN, bot.send_message,
             admin_id, 
             message, 
             reply_markup=reply_markup,
@@ -312,7 +1858,7 @@ async def create_cryptopay_check(user_id: int, amount: float, description: str):
         
         payload = {
             "asset": CRYPTOBOT_ASSET,
-            "amount": str(amount),
+            "amount": f"{amount:.2f}",
             "description": f"Выплата пользователю {description} (ID: {user_id})",
             "payload": str(user_id),
             "public_key": True
@@ -329,326 +1875,873 @@ async def create_cryptopay_check(user_id: int, amount: float, description: str):
                 if data.get("ok"):
                     check = data["result"]
                     return check["check_id"], check.get("url") or check.get("bot_check_url"), check.get("expires_at", "")
+                logger.error(f"CryptoPay refused to create check: {data.get('error')}")
         
         return None, None, None
         
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        # Запрос мог дойти до CryptoPay: решает вызывающий
+        raise
     except Exception as e:
         logger.error(f"Error creating CryptoPay check: {e}")
         return None, None, None
 
 async def process_withdrawals_batch(admin_id: int):
-    """Обрабатывает выплаты партиями по 50 чеков"""
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        
-        # Получаем подтвержденные заявки на вывод
-        cursor.execute("""
-            SELECT wr.id, wr.user_id, wr.amount_usd, u.username
-            FROM withdraw_requests wr
-            JOIN users u ON wr.user_id = u.user_id
-            WHERE wr.status = 'confirmed' AND wr.invoice_id IS NULL
-            ORDER BY wr.created_at ASC
-            LIMIT ?
-        """, (MAX_CHECKS_PER_BATCH,))
+    """Обрабатывает выплаты партиями по 50 чеков.
+
+    Каждая заявка сначала захватывается переходом confirmed -> processing, и чек
+    создается только для выигранного захвата: два админа, нажавшие кнопку
+    одновременно, не выплатят одну заявку дважды. Если CryptoPay отказал, заявка
+    возвращается в confirmed. Если ответ не получен (сеть, таймаут), чек мог
+    быть создан, поэтому заявка переходит в failed для ручной проверки.
+    """
+    # Получаем подтвержденные заявки на вывод
+    pending_requests = await db.fetchall("""
+        SELECT wr.id, wr.user_id, wr.amount_usd, u.username
+        FROM withdraw_requests wr
+        JOIN users u ON wr.user_id = u.user_id
+        WHERE wr.status = 'confirmed' AND wr.invoice_id IS NULL
+        ORDER BY wr.created_at ASC
+        LIMIT ?
+    """, (MAX_CHECKS_PER_BATCH,))
+    
+    if not pending_requests:
+        await outbox.send(PRIORITY_ADMIN, bot.send_message, admin_id, "❌ Нет подтвержденных заявок на вывод.")
+        return 0, 0
+    
+    processed_count = 0
+    failed_count = 0
+    
+    for request in pending_requests:
+        request_id, user_id, amount_usd, username = request
+        
+        # Заявку уже забрал другой админ
+        if not await db.transition("withdraw_requests", request_id, ("confirmed",), "processing",
+                                   returning=("id",)):
+            continue
         
-        pending_requests = cursor.fetchall()
+        # Выплачивается ровно списанная сумма: старые заявки хранили доли цента
+        amount_usd = to_cents(amount_usd) / 100
         
-        if not pending_requests:
-            await bot.send_message(admin_id, "❌ Нет подтвержденных заявок на вывод.")
-            return 0, 0
+        try:
+            # Создаем чек в CryptoPay
+            check_id, check_url, expires_at = await create_cryptopay_check(
+                user_id, amount_usd, username or str(user_id))
+        except Exception as e:
+            logger.error(f"No answer from CryptoPay for request {request_id}, "
+                         f"marked failed for manual check: {e}")
+            await db.transition("withdraw_requests", request_id, ("processing",), "failed",
+                                returning=("id",))
+            failed_count += 1
+            continue
         
-        processed_count = 0
-        failed_count = 0
+        if not (check_id and check_url):
+            await db.transition("withdraw_requests", request_id, ("processing",), "confirmed",
+                                returning=("id",))
+            failed_count += 1
+            continue
         
-        for request in pending_requests:
-            request_id, user_id, amount_usd, username = request
-            
-            try:
-                # Создаем чек в CryptoPay
-                check_id, check_url, expires_at = await create_cryptopay_check(
-                    user_id, amount_usd, username or str(user_id))
-                
-                if check_id and check_url:
-                    # Обновляем запись в базе
-                    cursor.execute("""
-                        UPDATE withdraw_requests 
-                        SET status = 'paid', 
-                            invoice_id = ?,
-                            invoice_url = ?,
-                            expires_at = ?,
-                            confirmed_at = datetime('now'),
-                            paid_at = datetime('now')
-                        WHERE id = ?
-                    """, (check_id, check_url, expires_at, request_id))
-                    
-                    processed_count += 1
-                    
-                    # Отправляем чек пользователю
-                    try:
-                        await bot.send_message(
-                            user_id,
-                            f"💰 Ваша выплата {amount_usd:.2f}$ готова!\n\n"
-                            f"🔗 Ссылка на чек: {check_url}\n"
-                            f"⏰ Действителен до: {expires_at}"
-                        )
-                    except Exception as e:
-                        logger.error(f"Error sending check to user {user_id}: {e}")
-                else:
-                    failed_count += 1
-                    
-            except Exception as e:
-                logger.error(f"Error processing request {request_id}: {e}")
-                failed_count += 1
+        try:
+            # Обновляем запись в базе
+            await db.transition(
+                "withdraw_requests", request_id, ("processing",), "paid",
+                fields={
+                    "invoice_id": str(check_id),
+                    "invoice_url": check_url,
+                    "expires_at": expires_at,
+                    "confirmed_at": SQL_NOW,
+                    "paid_at": SQL_NOW,
+                },
+                returning=("id",)
+            )
+        except Exception as e:
+            # Чек уже создан: заявка остается в processing, чтобы не выплатить ее снова
+            logger.error(f"Error saving check {check_id} for request {request_id}: {e}")
         
-        conn.commit()
+        processed_count += 1
         
-        return processed_count, failed_count
+        # Отправляем чек пользователю
+        try:
+            await outbox.send(
+                PRIORITY_URGENT, bot.send_message,
+                user_id,
+                f"💰 Ваша выплата {amount_usd:.2f}$ готова!\n\n"
+                f"🔗 Ссылка на чек: {check_url}\n"
+                f"⏰ Действителен до: {expires_at}"
+            )
+        except Exception as e:
+            logger.error(f"Error sending check to user {user_id}: {e}")
+    
+    return processed_count, failed_count
 
 async def confirm_withdraw_request(user_id: int, amount: float):
     """Автоматическое подтверждение заявки через 1 час"""
     await asyncio.sleep(PROCESSING_DELAY)
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        
+    async with db.transaction() as tx:
         # Проверяем статус заявки
-        cursor.execute("""
-            SELECT status FROM withdraw_requests 
+        result = await tx.fetchone("""
+            SELECT id FROM withdraw_requests 
             WHERE user_id = ? AND amount_usd = ? AND status = 'pending'
             ORDER BY created_at DESC LIMIT 1
         """, (user_id, amount))
         
-        result = cursor.fetchone()
         if result:
-            # Подтверждаем заявку
-            cursor.execute("""
-                UPDATE withdraw_requests 
-                SET status = 'confirmed', confirmed_at = datetime('now')
-                WHERE user_id = ? AND amount_usd = ? AND status = 'pending'
-            """, (user_id, amount))
-            
+            # Подтверждаем заявку, если ее еще не обработали
+            result = await tx.transition(
+                "withdraw_requests", result[0], ("pending",), "confirmed",
+                fields={"confirmed_at": SQL_NOW}, returning=("id",)
+            )
+        
+        if result:
             # Начисляем опыт за заявку
-            cursor.execute("""
+            await tx.execute("""
                 UPDATE users 
                 SET level = level + 1 
                 WHERE user_id = ?
             """, (user_id,))
+    
+    if result:
+        # Уведомляем пользователя
+        try:
+            await outbox.send(
+                PRIORITY_USER, bot.send_message,
+                user_id, 
+                f"✅ Ваша заявка на вывод {amount:.2f}$ подтверждена!\n\n"
+                f"Ожидайте выплату в течение 24 часов."
+            )
+        except Exception as e:
+            logger.error(f"Error notifying user: {e}")
+        
+        # Обрабатываем реферальные выплаты
+        await process_referral_payout(user_id, amount, result[0])
+
+async def process_referral_payout(user_id: int, amount: float, request_id: int):
+    """Обработка реферальных процентов при выводе"""
+    # Получаем реферера пользователя
+    referrer_id = await db.fetchval("SELECT referrer_id FROM users WHERE user_id = ?", (user_id,))
+    
+    if referrer_id:
+        # Расчет реферального процента (5%)
+        referral_amount = round(amount * 0.05, 2)
+        
+        if referral_amount > 0:
+            # Начисляем реферальное вознаграждение
+            async with db.transaction() as tx:
+                posted = await post_ledger(tx, [
+                    (referrer_id, referral_amount, LEDGER_REFERRAL_PAYOUT, request_id)
+                ])
+            if not posted:
+                return
             
-            conn.commit()
-            
-            # Уведомляем пользователя
+            # Уведомляем реферера
             try:
-                await bot.send_message(
-                    user_id, 
-                    f"✅ Ваша заявка на вывод {amount:.2f}$ подтверждена!\n\n"
-                    f"Ожидайте выплату в течение 24 часов."
+                await outbox.send(
+                    PRIORITY_USER, bot.send_message,
+                    referrer_id,
+                    f"💸 Реферальное вознаграждение! {referral_amount:.2f}$"
                 )
             except Exception as e:
-                logger.error(f"Error notifying user: {e}")
-            
-            # Обрабатываем реферальные выплаты
-            await process_referral_payout(user_id, amount)
-
-async def process_referral_payout(user_id: int, amount: float):
-    """Обработка реферальных процентов при выводе"""
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        
-        # Получаем реферера пользователя
-        cursor.execute("SELECT referrer_id FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        
-        if result and result[0]:
-            referrer_id = result[0]
-            
-            # Расчет реферального процента (5%)
-            referral_amount = round(amount * 0.05, 2)
-            
-            if referral_amount > 0:
-                # Начисляем реферальное вознаграждение
-                cursor.execute("""
-                    UPDATE users 
-                    SET balance_usd = balance_usd + ?
-                    WHERE user_id = ?
-                """, (referral_amount, referrer_id))
-                
-                conn.commit()
-                
-                # Уведомляем реферера
-                try:
-                    await bot.send_message(
-                        referrer_id,
-                        f"💸 Реферальное вознаграждение! {referral_amount:.2f}$"
-                    )
-                except Exception as e:
-                    logger.error(f"Error notifying referrer: {e}")
+                logger.error(f"Error notifying referrer: {e}")
 
 # Инициализация базы данных
-def init_db():
-    try:
-        conn = sqlite3.connect(DATABASE, timeout=30)
-        cursor = conn.cursor()
-        
-        # Таблица пользователей
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            referral_source TEXT,
-            balance_usd REAL DEFAULT 0,
-            balance_rub REAL DEFAULT 0,
-            level INTEGER DEFAULT 1,
-            warnings INTEGER DEFAULT 0,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            whatsapp_numbers INTEGER DEFAULT 0,
-            max_numbers INTEGER DEFAULT 0,
-            sms_messages INTEGER DEFAULT 0,
-            total_earned_usd REAL DEFAULT 0,
-            total_earned_rub REAL DEFAULT 0,
-            referrer_id INTEGER,
-            captcha_passed INTEGER DEFAULT 1,
-            registration_date TEXT DEFAULT CURRENT_TIMESTAMP
-        )
+
+# Базовые таблицы
+SCHEMA_TABLES = [
+    # Таблица пользователей
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        referral_source TEXT,
+        balance_usd REAL DEFAULT 0,
+        balance_rub REAL DEFAULT 0,
+        level INTEGER DEFAULT 1,
+        warnings INTEGER DEFAULT 0,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        whatsapp_numbers INTEGER DEFAULT 0,
+        max_numbers INTEGER DEFAULT 0,
+        sms_messages INTEGER DEFAULT 0,
+        total_earned_usd REAL DEFAULT 0,
+        total_earned_rub REAL DEFAULT 0,
+        referrer_id INTEGER,
+        captcha_passed INTEGER DEFAULT 1,
+        registration_date TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    # Таблица номеров WhatsApp
+    """
+    CREATE TABLE IF NOT EXISTS whatsapp_numbers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        phone TEXT UNIQUE,
+        status TEXT DEFAULT 'pending',
+        hold_start TEXT,
+        hold_hours INTEGER DEFAULT 3,
+        completed BOOLEAN DEFAULT 0,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        failed_at TEXT,
+        admin_id INTEGER,
+        code_text TEXT,
+        code_sent BOOLEAN DEFAULT 0,
+        code_entered BOOLEAN DEFAULT 0,
+        FOREIGN KEY(user_id) REFERENCES users(user_id)
+    )
+    """,
+    # Таблица номеров MAX
+    """
+    CREATE TABLE IF NOT EXISTS max_numbers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        phone TEXT UNIQUE,
+        status TEXT DEFAULT 'pending',
+        hold_start TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        admin_id INTEGER,
+        user_code TEXT,
+        code_sent BOOLEAN DEFAULT 0,
+        code_entered BOOLEAN DEFAULT 0,
+        admin_accepted BOOLEAN DEFAULT 0,
+        completed BOOLEAN DEFAULT 0,
+        FOREIGN KEY(user_id) REFERENCES users(user_id)
+    )
+    """,
+    # Таблица SMS работ
+    """
+    CREATE TABLE IF NOT EXISTS sms_works (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        admin_id INTEGER,
+        text TEXT,
+        work_message TEXT,
+        proof_photo TEXT,
+        status TEXT DEFAULT 'pending',
+        amount REAL DEFAULT 0,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        processed_at TEXT,
+        completed_at TEXT,
+        FOREIGN KEY(user_id) REFERENCES users(user_id),
+        FOREIGN KEY(admin_id) REFERENCES users(user_id)
+    )
+    """,
+    # Таблица рефералов
+    """
+    CREATE TABLE IF NOT EXISTS referrals (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        referrer_id INTEGER,
+        referred_id INTEGER UNIQUE,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(referrer_id) REFERENCES users(user_id),
+        FOREIGN KEY(referred_id) REFERENCES users(user_id)
+    )
+    """,
+    # Таблица заявки на вывод
+    """
+    CREATE TABLE IF NOT EXISTS withdraw_requests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        amount_usd REAL,
+        amount_rub REAL,
+        status TEXT DEFAULT 'pending',
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        invoice_id TEXT,
+        invoice_url TEXT,
+        expires_at TEXT,
+        confirmed_at TEXT,
+        paid_at DATETIME,
+        FOREIGN KEY(user_id) REFERENCES users(user_id)
+    )
+    """,
+    # Таблица поддержки
+    """
+    CREATE TABLE IF NOT EXISTS support_tickets (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        message TEXT,
+        status TEXT DEFAULT 'open',
+        admin_id INTEGER,
+        response TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        responded_at TEXT,
+        username TEXT,
+        FOREIGN KEY(user_id) REFERENCES users(user_id),
+        FOREIGN KEY(admin_id) REFERENCES users(user_id)
+    )
+    """,
+]
+
+# Столбцы, добавленные после первых версий бота: (таблица, столбец, определение)
+LEGACY_COLUMNS = [
+    ('whatsapp_numbers', 'completed', 'BOOLEAN DEFAULT 0'),
+    ('whatsapp_numbers', 'failed_at', 'TEXT'),
+    ('whatsapp_numbers', 'admin_id', 'INTEGER'),
+    ('whatsapp_numbers', 'code_text', 'TEXT'),
+    ('whatsapp_numbers', 'code_sent', 'BOOLEAN DEFAULT 0'),
+    ('whatsapp_numbers', 'code_entered', 'BOOLEAN DEFAULT 0'),
+    ('max_numbers', 'admin_id', 'INTEGER'),
+    ('max_numbers', 'user_code', 'TEXT'),
+    ('max_numbers', 'code_sent', 'BOOLEAN DEFAULT 0'),
+    ('max_numbers', 'code_entered', 'BOOLEAN DEFAULT 0'),
+    ('max_numbers', 'admin_accepted', 'BOOLEAN DEFAULT 0'),
+    ('max_numbers', 'completed', 'BOOLEAN DEFAULT 0'),
+    ('sms_works', 'work_message', 'TEXT'),
+    ('sms_works', 'completed_at', 'TEXT'),
+    ('users', 'referrer_id', 'INTEGER'),
+    ('users', 'captcha_passed', 'INTEGER DEFAULT 1'),
+    ('users', 'registration_date', 'TEXT'),
+    ('withdraw_requests', 'paid_at', 'DATETIME'),
+    ('support_tickets', 'username', 'TEXT'),
+]
+
+# Индексы под горячие запросы: очереди по статусу, холды по времени начала,
+# выборки пользователя по статусу и рефералы
+DB_INDEXES = [
+    # Очередь на подтверждение и счетчик общей очереди WhatsApp
+    "CREATE INDEX IF NOT EXISTS idx_whatsapp_status_created ON whatsapp_numbers(status, created_at)",
+    # Аккаунты на холде, отсортированные по началу холда
+    """CREATE INDEX IF NOT EXISTS idx_whatsapp_hold ON whatsapp_numbers(hold_start)
+       WHERE status IN ('hold_active', 'active')""",
+    "CREATE INDEX IF NOT EXISTS idx_whatsapp_user_status ON whatsapp_numbers(user_id, status)",
+    "CREATE INDEX IF NOT EXISTS idx_max_status_created ON max_numbers(status, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_max_status_hold ON max_numbers(status, hold_start)",
+    "CREATE INDEX IF NOT EXISTS idx_max_user_status ON max_numbers(user_id, status)",
+    "CREATE INDEX IF NOT EXISTS idx_sms_status_created ON sms_works(status, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_sms_user_status ON sms_works(user_id, status)",
+    # Выплаты: заявки по статусу в порядке поступления
+    "CREATE INDEX IF NOT EXISTS idx_withdraw_status_created ON withdraw_requests(status, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_withdraw_user_status ON withdraw_requests(user_id, status, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_withdraw_created ON withdraw_requests(created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id)",
+]
+
+def table_columns(cursor, table: str) -> set:
+    return {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+
+def add_column(cursor, table: str, column: str, definition: str):
+    """Добавляет столбец, если его еще нет (шаги миграций должны быть повторяемыми)"""
+    if column not in table_columns(cursor, table):
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def migrate_base_schema(cursor):
+    for table_sql in SCHEMA_TABLES:
+        cursor.execute(table_sql)
+    for table, column, definition in LEGACY_COLUMNS:
+        add_column(cursor, table, column, definition)
+
+def migrate_hot_indexes(cursor):
+    for index_sql in DB_INDEXES:
+        cursor.execute(index_sql)
+
+def migrate_status_counters(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS status_counters (
+        service TEXT NOT NULL,
+        status TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (service, status)
+    ) WITHOUT ROWID
+    """)
+    
+    for table, service in COUNTED_TABLES.items():
+        increment = f"""
+            INSERT INTO status_counters (service, status, count)
+            VALUES ('{service}', COALESCE(NEW.status, ''), 1)
+            ON CONFLICT(service, status) DO UPDATE SET count = count + 1;
+        """
+        decrement = f"""
+            UPDATE status_counters SET count = count - 1
+            WHERE service = '{service}' AND status = COALESCE(OLD.status, '');
+        """
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_count_insert AFTER INSERT ON {table}
+        BEGIN {increment} END
         """)
-        
-        # Таблица номеров WhatsApp
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS whatsapp_numbers (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            phone TEXT UNIQUE,
-            status TEXT DEFAULT 'pending',
-            hold_start TEXT,
-            hold_hours INTEGER DEFAULT 3,
-            completed BOOLEAN DEFAULT 0,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            failed_at TEXT,
-            admin_id INTEGER,
-            code_text TEXT,
-            code_sent BOOLEAN DEFAULT 0,
-            code_entered BOOLEAN DEFAULT 0,
-            FOREIGN KEY(user_id) REFERENCES users(user_id)
-        )
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_count_delete AFTER DELETE ON {table}
+        BEGIN {decrement} END
         """)
-        
-        # Таблица номеров MAX
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS max_numbers (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            phone TEXT UNIQUE,
-            status TEXT DEFAULT 'pending',
-            hold_start TEXT,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            admin_id INTEGER,
-            user_code TEXT,
-            code_sent BOOLEAN DEFAULT 0,
-            code_entered BOOLEAN DEFAULT 0,
-            admin_accepted BOOLEAN DEFAULT 0,
-            completed BOOLEAN DEFAULT 0,
-            FOREIGN KEY(user_id) REFERENCES users(user_id)
-        )
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_count_update AFTER UPDATE OF status ON {table}
+        WHEN OLD.status IS NOT NEW.status
+        BEGIN {decrement} {increment} END
         """)
         
-        # Таблица SMS работ
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS sms_works (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            admin_id INTEGER,
-            text TEXT,
-            work_message TEXT,
-            proof_photo TEXT,
-            status TEXT DEFAULT 'pending',
-            amount REAL DEFAULT 0,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            processed_at TEXT,
-            completed_at TEXT,
-            FOREIGN KEY(user_id) REFERENCES users(user_id),
-            FOREIGN KEY(admin_id) REFERENCES users(user_id)
-        )
+        # Начальные значения считаем один раз по индексу статуса
+        cursor.execute("DELETE FROM status_counters WHERE service = ?", (service,))
+        cursor.execute(f"""
+            INSERT INTO status_counters (service, status, count)
+            SELECT '{service}', COALESCE(status, ''), COUNT(*) FROM {table} GROUP BY status
         """)
-        
-        # Таблица рефералов
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS referrals (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            referrer_id INTEGER,
-            referred_id INTEGER UNIQUE,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY(referrer_id) REFERENCES users(user_id),
-            FOREIGN KEY(referred_id) REFERENCES users(user_id)
+
+# Метки времени в секундах эпохи рядом с текстовыми столбцами datetime('now').
+# Триггеры пересчитывают их при каждой записи текстового столбца, поэтому
+# код может и дальше писать текст, а выборки по времени идут по индексам.
+TIMESTAMP_COLUMNS = {
+    "whatsapp_numbers": [("created_at", "created_ts"), ("hold_start", "hold_start_ts"),
+                         ("failed_at", "failed_ts")],
+    "max_numbers": [("created_at", "created_ts"), ("hold_start", "hold_start_ts")],
+    "sms_works": [("created_at", "created_ts"), ("completed_at", "completed_ts"),
+                  ("processed_at", "processed_ts")],
+    "withdraw_requests": [("created_at", "created_ts"), ("paid_at", "paid_ts")],
+}
+
+TIMESTAMP_INDEXES = [
+    # Холды по времени начала внутри статуса: списки на холде и диапазон истекших
+    "CREATE INDEX IF NOT EXISTS idx_whatsapp_status_hold_ts ON whatsapp_numbers(status, hold_start_ts)",
+    "CREATE INDEX IF NOT EXISTS idx_max_status_hold_ts ON max_numbers(status, hold_start_ts)",
+]
+
+# Индексы по текстовому hold_start, замененные индексами по hold_start_ts
+DROPPED_INDEXES = ("idx_whatsapp_hold", "idx_max_status_hold")
+
+def epoch_sql(column: str) -> str:
+    return f"CAST(strftime('%s', {column}) AS INTEGER)"
+
+def migrate_epoch_timestamps(cursor):
+    for table, columns in TIMESTAMP_COLUMNS.items():
+        for text_column, ts_column in columns:
+            add_column(cursor, table, ts_column, "INTEGER")
+        
+        # Новая строка: все метки из значений по умолчанию и вставленных
+        assignments = ", ".join(
+            f"{ts_column} = {epoch_sql('NEW.' + text_column)}" for text_column, ts_column in columns
         )
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_ts_insert AFTER INSERT ON {table}
+        BEGIN UPDATE {table} SET {assignments} WHERE rowid = NEW.rowid; END
         """)
-        
-        # Таблица заявки на вывод
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS withdraw_requests (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            amount_usd REAL,
-            amount_rub REAL,
-            status TEXT DEFAULT 'pending',
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            invoice_id TEXT,
-            invoice_url TEXT,
-            expires_at TEXT,
-            confirmed_at TEXT,
-            paid_at DATETIME,
-            FOREIGN KEY(user_id) REFERENCES users(user_id)
-        )
+        for text_column, ts_column in columns:
+            cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_{ts_column} AFTER UPDATE OF {text_column} ON {table}
+            WHEN OLD.{text_column} IS NOT NEW.{text_column}
+            BEGIN
+                UPDATE {table} SET {ts_column} = {epoch_sql('NEW.' + text_column)}
+                WHERE rowid = NEW.rowid;
+            END
+            """)
+    
+    for index_sql in TIMESTAMP_INDEXES:
+        cursor.execute(index_sql)
+    for index_name in DROPPED_INDEXES:
+        cursor.execute(f"DROP INDEX IF EXISTS {index_name}")
+
+def backfill_epoch_timestamps(cursor, batch_size: int) -> int:
+    """Заполняет метки для существующих строк; значения, которые SQLite
+    не может разобрать как дату, остаются NULL и не выбираются повторно"""
+    processed = 0
+    for table, columns in TIMESTAMP_COLUMNS.items():
+        for text_column, ts_column in columns:
+            if processed >= batch_size:
+                return processed
+            cursor.execute(f"""
+                UPDATE {table} SET {ts_column} = {epoch_sql(text_column)}
+                WHERE rowid IN (
+                    SELECT rowid FROM {table}
+                    WHERE {ts_column} IS NULL AND {epoch_sql(text_column)} IS NOT NULL
+                    LIMIT ?
+                )
+            """, (batch_size - processed,))
+            processed += cursor.rowcount
+    return processed
+
+def migrate_balance_ledger(cursor):
+    # Триггер журнала пишет оба столбца, даже если БД старше total_earned_usd
+    add_column(cursor, "users", "total_earned_usd", "REAL DEFAULT 0")
+    add_column(cursor, "users", "balance_cents", "INTEGER NOT NULL DEFAULT 0")
+    add_column(cursor, "users", "earned_cents", "INTEGER NOT NULL DEFAULT 0")
+    
+    # Журнал проводок в центах; одна проводка на причину и исходную строку
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS balance_ledger (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        amount_cents INTEGER NOT NULL,
+        reason TEXT NOT NULL,
+        source_id INTEGER NOT NULL,
+        created_ts INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+        UNIQUE (reason, source_id)
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ledger_user ON balance_ledger(user_id, id)")
+    
+    # Контрольные точки: баланс пользователя на момент проводки ledger_id
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS balance_checkpoints (
+        user_id INTEGER PRIMARY KEY,
+        ledger_id INTEGER NOT NULL,
+        balance_cents INTEGER NOT NULL,
+        created_ts INTEGER NOT NULL
+    )
+    """)
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_checkpoints_ledger ON balance_checkpoints(ledger_id)"
+    )
+    
+    # Итоги по всем пользователям для статистики
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS running_totals (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+    """)
+    
+    earning = ", ".join(f"'{reason}'" for reason in LEDGER_EARNING_REASONS)
+    earned_delta = f"CASE WHEN NEW.reason IN ({earning}) THEN NEW.amount_cents ELSE 0 END"
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_balance_ledger_insert AFTER INSERT ON balance_ledger
+    BEGIN
+        UPDATE users SET
+            balance_cents = balance_cents + NEW.amount_cents,
+            balance_usd = (balance_cents + NEW.amount_cents) / 100.0,
+            earned_cents = earned_cents + {earned_delta},
+            total_earned_usd = (earned_cents + {earned_delta}) / 100.0
+        WHERE user_id = NEW.user_id;
+    END
+    """)
+    
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_users_totals_insert AFTER INSERT ON users
+    BEGIN
+        UPDATE running_totals SET value = value + 1 WHERE name = 'users';
+        UPDATE running_totals SET value = value + NEW.balance_cents WHERE name = 'balance_cents';
+        UPDATE running_totals SET value = value + NEW.earned_cents WHERE name = 'earned_cents';
+    END
+    """)
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_users_totals_delete AFTER DELETE ON users
+    BEGIN
+        UPDATE running_totals SET value = value - 1 WHERE name = 'users';
+        UPDATE running_totals SET value = value - OLD.balance_cents WHERE name = 'balance_cents';
+        UPDATE running_totals SET value = value - OLD.earned_cents WHERE name = 'earned_cents';
+    END
+    """)
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_users_totals_update
+    AFTER UPDATE OF balance_cents, earned_cents ON users
+    BEGIN
+        UPDATE running_totals SET value = value + NEW.balance_cents - OLD.balance_cents
+        WHERE name = 'balance_cents';
+        UPDATE running_totals SET value = value + NEW.earned_cents - OLD.earned_cents
+        WHERE name = 'earned_cents';
+    END
+    """)
+    
+    # Суммы в центах на этот момент — те, что уже лежат в новых столбцах
+    cursor.execute("DELETE FROM running_totals")
+    cursor.execute("""
+        INSERT INTO running_totals (name, value)
+        SELECT 'users', COUNT(*) FROM users
+        UNION ALL SELECT 'balance_cents', COALESCE(SUM(balance_cents), 0) FROM users
+        UNION ALL SELECT 'earned_cents', COALESCE(SUM(earned_cents), 0) FROM users
+    """)
+
+def backfill_balance_ledger(cursor, batch_size: int) -> int:
+    """Переносит балансы, накопленные до журнала, входящими проводками;
+    заработок переносится в earned_cents напрямую"""
+    rows = cursor.execute("""
+        SELECT user_id,
+               CAST(ROUND(COALESCE(balance_usd, 0) * 100) AS INTEGER) - balance_cents,
+               CAST(ROUND(COALESCE(total_earned_usd, 0) * 100) AS INTEGER)
+        FROM users
+        WHERE balance_cents != CAST(ROUND(COALESCE(balance_usd, 0) * 100) AS INTEGER)
+           OR earned_cents != CAST(ROUND(COALESCE(total_earned_usd, 0) * 100) AS INTEGER)
+        LIMIT ?
+    """, (batch_size,)).fetchall()
+    
+    # Заработок раньше проводок: триггер журнала пересчитывает total_earned_usd из earned_cents
+    cursor.executemany(
+        "UPDATE users SET earned_cents = ? WHERE user_id = ?",
+        [(earned, user_id) for user_id, _, earned in rows]
+    )
+    cursor.executemany("""
+        INSERT INTO balance_ledger (user_id, amount_cents, reason, source_id)
+        VALUES (?, ?, ?, ?)
+    """, [(user_id, delta, LEDGER_OPENING_BALANCE, user_id)
+          for user_id, delta, _ in rows if delta])
+    return len(rows)
+
+# Индексы под сортировки, найденные python check_plans.py
+ORDER_INDEXES = [
+    # Список аккаунтов на холде от новых к старым: условие индекса совпадает
+    # с условием запросов, поэтому сортировка идет по индексу только живых строк
+    """CREATE INDEX IF NOT EXISTS idx_whatsapp_on_hold_ts ON whatsapp_numbers(hold_start_ts)
+       WHERE status IN ('hold_active', 'active')""",
+]
+
+def migrate_order_indexes(cursor):
+    for index_sql in ORDER_INDEXES:
+        cursor.execute(index_sql)
+
+# Индексы постраничных списков админ-панели: порядок (created_ts, id) внутри
+# статуса, поэтому каждая страница — поиск по индексу с LIMIT
+KEYSET_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_whatsapp_queue_ts ON whatsapp_numbers(status, created_ts, id)",
+    "CREATE INDEX IF NOT EXISTS idx_max_queue_ts ON max_numbers(status, created_ts, id)",
+    "CREATE INDEX IF NOT EXISTS idx_sms_queue_ts ON sms_works(status, created_ts, id)",
+    # Аккаунты на холде для отметки о слёте; условие совпадает с запросом списка
+    """CREATE INDEX IF NOT EXISTS idx_whatsapp_on_hold_created ON whatsapp_numbers(created_ts, id)
+       WHERE status IN ('hold_active', 'active')""",
+]
+
+# Индексы по текстовому created_at, замененные индексами по created_ts
+KEYSET_REPLACED_INDEXES = ("idx_whatsapp_status_created", "idx_max_status_created",
+                           "idx_sms_status_created")
+
+def migrate_keyset_indexes(cursor):
+    for index_sql in KEYSET_INDEXES:
+        cursor.execute(index_sql)
+    for index_name in KEYSET_REPLACED_INDEXES:
+        cursor.execute(f"DROP INDEX IF EXISTS {index_name}")
+
+# Индексы архива: поиск строки по id, история пользователя и проверка
+# повторной сдачи номера
+ARCHIVE_INDEXES = [
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_whatsapp_archive_id ON whatsapp_numbers_archive(id)",
+    "CREATE INDEX IF NOT EXISTS idx_whatsapp_archive_user_status ON whatsapp_numbers_archive(user_id, status)",
+    "CREATE INDEX IF NOT EXISTS idx_whatsapp_archive_phone ON whatsapp_numbers_archive(phone)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_max_archive_id ON max_numbers_archive(id)",
+    "CREATE INDEX IF NOT EXISTS idx_max_archive_user_status ON max_numbers_archive(user_id, status)",
+    "CREATE INDEX IF NOT EXISTS idx_max_archive_phone ON max_numbers_archive(phone)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_sms_archive_id ON sms_works_archive(id)",
+    "CREATE INDEX IF NOT EXISTS idx_sms_archive_user_status ON sms_works_archive(user_id, status)",
+]
+
+def migrate_archive_tables(cursor):
+    for table in ARCHIVE_TABLES:
+        # Копия столбцов горячей таблицы в ее текущем порядке, без ограничений
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {table}_archive AS SELECT * FROM {table} WHERE 0")
+        
+        # Счетчики статусов продолжают учитывать перенесенные строки
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_archive_count AFTER INSERT ON {table}_archive
+        BEGIN
+            INSERT INTO status_counters (service, status, count)
+            VALUES ('{COUNTED_TABLES[table]}', COALESCE(NEW.status, ''), 1)
+            ON CONFLICT(service, status) DO UPDATE SET count = count + 1;
+        END
         """)
-        
-        # Таблица поддержки
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS support_tickets (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            message TEXT,
-            status TEXT DEFAULT 'open',
-            admin_id INTEGER,
-            response TEXT,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            responded_at TEXT,
-            username TEXT,
-            FOREIGN KEY(user_id) REFERENCES users(user_id),
-            FOREIGN KEY(admin_id) REFERENCES users(user_id)
+    for index_sql in ARCHIVE_INDEXES:
+        cursor.execute(index_sql)
+
+# Дневные сводки: таблица сводки, отметка пересчета и индексы по времени
+# событий в горячих и архивных таблицах, чтобы проход читал только новые дни
+ROLLUP_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS daily_stats (
+        day TEXT NOT NULL,
+        service TEXT NOT NULL,
+        metric TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        amount_cents INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, service, metric)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rollup_marks (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )
+    """,
+]
+
+ROLLUP_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_whatsapp_ts_created ON whatsapp_numbers(created_ts)",
+    "CREATE INDEX IF NOT EXISTS idx_whatsapp_ts_hold ON whatsapp_numbers(hold_start_ts) WHERE hold_start_ts IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_whatsapp_ts_failed ON whatsapp_numbers(failed_ts) WHERE failed_ts IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_max_ts_created ON max_numbers(created_ts)",
+    "CREATE INDEX IF NOT EXISTS idx_max_ts_hold ON max_numbers(hold_start_ts) WHERE hold_start_ts IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_sms_ts_created ON sms_works(created_ts)",
+    "CREATE INDEX IF NOT EXISTS idx_sms_ts_completed ON sms_works(completed_ts) WHERE completed_ts IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_withdraw_ts_paid ON withdraw_requests(paid_ts) WHERE paid_ts IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_whatsapp_archive_ts_created ON whatsapp_numbers_archive(created_ts)",
+    "CREATE INDEX IF NOT EXISTS idx_whatsapp_archive_ts_hold ON whatsapp_numbers_archive(hold_start_ts) WHERE hold_start_ts IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_whatsapp_archive_ts_failed ON whatsapp_numbers_archive(failed_ts) WHERE failed_ts IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_max_archive_ts_created ON max_numbers_archive(created_ts)",
+    "CREATE INDEX IF NOT EXISTS idx_max_archive_ts_hold ON max_numbers_archive(hold_start_ts) WHERE hold_start_ts IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_sms_archive_ts_created ON sms_works_archive(created_ts)",
+    "CREATE INDEX IF NOT EXISTS idx_sms_archive_ts_completed ON sms_works_archive(completed_ts) WHERE completed_ts IS NOT NULL",
+]
+
+def migrate_daily_rollups(cursor):
+    for table_sql in ROLLUP_TABLES:
+        cursor.execute(table_sql)
+    for index_sql in ROLLUP_INDEXES:
+        cursor.execute(index_sql)
+
+# Поиск пользователей: триграммные индексы FTS5 над внешним содержимым.
+# Таблица FTS -> (таблица-источник, ее rowid, индексируемые столбцы); триггеры
+# повторяют каждую запись источника, как в документации FTS5
+SEARCH_FTS_TABLES = {
+    "users_fts": ("users", "user_id", ("username", "first_name", "last_name")),
+    "whatsapp_phones_fts": ("whatsapp_numbers", "id", ("phone",)),
+    "max_phones_fts": ("max_numbers", "id", ("phone",)),
+    # Номера из архива тоже находятся: id там уникален, хотя и не rowid
+    "whatsapp_archive_phones_fts": ("whatsapp_numbers_archive", "id", ("phone",)),
+    "max_archive_phones_fts": ("max_numbers_archive", "id", ("phone",)),
+}
+
+def migrate_user_search(cursor):
+    for fts, (table, key, columns) in SEARCH_FTS_TABLES.items():
+        # Старые БД могли создаваться без имени и фамилии пользователя
+        for column in columns:
+            add_column(cursor, table, column, "TEXT")
+        column_list = ", ".join(columns)
+        new_values = ", ".join(f"NEW.{column}" for column in columns)
+        old_values = ", ".join(f"OLD.{column}" for column in columns)
+        cursor.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+            {column_list}, content='{table}', content_rowid='{key}', tokenize='trigram'
         )
         """)
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{fts}_insert AFTER INSERT ON {table}
+        BEGIN
+            INSERT INTO {fts} (rowid, {column_list}) VALUES (NEW.{key}, {new_values});
+        END
+        """)
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{fts}_delete AFTER DELETE ON {table}
+        BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {column_list}) VALUES ('delete', OLD.{key}, {old_values});
+        END
+        """)
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{fts}_update AFTER UPDATE OF {column_list} ON {table}
+        BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {column_list}) VALUES ('delete', OLD.{key}, {old_values});
+            INSERT INTO {fts} (rowid, {column_list}) VALUES (NEW.{key}, {new_values});
+        END
+        """)
+        # Индекс для уже существующих строк
+        cursor.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+
+# Рассылки: текст, счетчики и последний обработанный user_id, чтобы после
+# перезапуска продолжить с места остановки
+BROADCASTS_TABLE = """
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        admin_id INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        total INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        last_user_id INTEGER NOT NULL DEFAULT 0,
+        progress_message_id INTEGER,
+        created_ts INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+        finished_ts INTEGER
+    )
+"""
+
+def migrate_broadcasts(cursor):
+    cursor.execute(BROADCASTS_TABLE)
+
+def migrate_broadcast_owner(cursor):
+    # Процесс бота, который ведет рассылку, и до какого времени (секунды эпохи)
+    add_column(cursor, "broadcasts", "owner", "TEXT")
+    add_column(cursor, "broadcasts", "lease_until", "INTEGER")
+
+class Migration:
+    """Шаг миграции схемы.
+
+    apply выполняется одной транзакцией. backfill(cursor, batch_size) за вызов
+    обрабатывает не больше batch_size строк и возвращает их количество; неполная
+    партия означает, что обрабатывать больше нечего. Каждая партия фиксируется
+    отдельно, чтобы не держать блокировку записи на большой БД.
+    Оба шага должны быть повторяемыми: версия записывается только после backfill.
+    """
+    def __init__(self, version: int, description: str, apply=None, backfill=None):
+        self.version = version
+        self.description = description
+        self.apply = apply
+        self.backfill = backfill
+
+MIGRATIONS = [
+    Migration(1, "Базовая схема", migrate_base_schema),
+    Migration(2, "Индексы для горячих запросов", migrate_hot_indexes),
+    Migration(3, "Счетчики очередей по статусам", migrate_status_counters),
+    Migration(4, "Метки времени в секундах эпохи", migrate_epoch_timestamps,
+              backfill_epoch_timestamps),
+    Migration(5, "Журнал проводок по балансам", migrate_balance_ledger,
+              backfill_balance_ledger),
+    Migration(6, "Архив завершенной работы", migrate_archive_tables),
+    Migration(7, "Индексы под сортировки списков", migrate_order_indexes),
+    Migration(8, "Индексы постраничных списков", migrate_keyset_indexes),
+    Migration(9, "Дневные сводки", migrate_daily_rollups),
+    Migration(10, "Поиск пользователей", migrate_user_search),
+    Migration(11, "Рассылки", migrate_broadcasts),
+    Migration(12, "Владелец рассылки", migrate_broadcast_owner),
+]
+SCHEMA_VERSION = MIGRATIONS[-1].version
+MIGRATION_BATCH_SIZE = 5000  # Строк за одну партию backfill
+
+def run_migrations(conn: sqlite3.Connection, dry_run: bool = False) -> int:
+    """Применяет недостающие миграции и возвращает итоговую версию схемы.
+
+    В режиме dry_run все шаги выполняются в одной транзакции, которая затем
+    откатывается: так видно, что и в каком объеме изменится, без записи в БД.
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    pending = [m for m in MIGRATIONS if m.version > version]
+    if not pending:
+        return version
+    
+    cursor = conn.cursor()
+    if dry_run:
+        cursor.execute("BEGIN IMMEDIATE")
+    
+    try:
+        for migration in pending:
+            logger.info(f"Migration {migration.version}: {migration.description}"
+                        f"{' (dry run)' if dry_run else ''}")
+            started = time.monotonic()
+            
+            if migration.apply:
+                if not dry_run:
+                    cursor.execute("BEGIN IMMEDIATE")
+                migration.apply(cursor)
+                if not dry_run:
+                    cursor.execute("COMMIT")
+            
+            if migration.backfill:
+                total = 0
+                while True:
+                    if not dry_run:
+                        cursor.execute("BEGIN IMMEDIATE")
+                    processed = migration.backfill(cursor, MIGRATION_BATCH_SIZE)
+                    if not dry_run:
+                        cursor.execute("COMMIT")
+                    total += processed
+                    if processed < MIGRATION_BATCH_SIZE:
+                        break
+                logger.info(f"Migration {migration.version}: backfilled {total} rows")
+            
+            cursor.execute(f"PRAGMA user_version = {migration.version}")
+            logger.info(f"Migration {migration.version} finished in {time.monotonic() - started:.2f}s")
+    except BaseException:
+        if conn.in_transaction:
+            cursor.execute("ROLLBACK")
+        raise
+    
+    if dry_run:
+        cursor.execute("ROLLBACK")
+        return version
+    return SCHEMA_VERSION
+
+def init_db(dry_run: bool = False):
+    try:
+        conn = sqlite3.connect(DATABASE, timeout=30, isolation_level=None)
         
-        # Проверяем существование столбцов и добавляем их при необходимости
-        columns_to_check = [
-            ('whatsapp_numbers', 'completed'),
-            ('whatsapp_numbers', 'failed_at'),
-            ('whatsapp_numbers', 'admin_id'),
-            ('whatsapp_numbers', 'code_text'),
-            ('whatsapp_numbers', 'code_sent'),
-            ('whatsapp_numbers', 'code_entered'),
-            ('max_numbers', 'admin_id'),
-            ('max_numbers', 'user_code'),
-            ('max_numbers', 'code_sent'),
-            ('max_numbers', 'code_entered'),
-            ('max_numbers', 'admin_accepted'),
-            ('max_numbers', 'completed'),
-            ('sms_works', 'work_message'),
-            ('sms_works', 'completed_at'),
-            ('users', 'referrer_id'),
-            ('users', 'captcha_passed'),
-            ('users', 'registration_date'),
-            ('withdraw_requests', 'paid_at'),
-            ('support_tickets', 'username')
-        ]
-        
-        for table, column in columns_to_check:
-            try:
-                cursor.execute(f"SELECT {column} FROM {table} LIMIT 1")
-            except sqlite3.OperationalError:
-                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {get_column_type(column)}")
+        version = run_migrations(conn, dry_run=dry_run)
+        if dry_run:
+            logger.info(f"Migration dry run finished: schema version {version}, target {SCHEMA_VERSION}")
+            return
         
-        conn.commit()
-        logger.info("Database initialization completed successfully")
+        # Обновляем статистику планировщика для новых и изменившихся индексов
+        conn.execute("PRAGMA optimize")
+        logger.info(f"Database initialization completed successfully (schema version {version})")
         
     except sqlite3.Error as e:
         logger.error(f"Database initialization failed: {e}")
@@ -657,66 +2750,414 @@ def init_db():
         if 'conn' in locals():
             conn.close()
 
-def get_column_type(column_name):
-    """Возвращает тип столбца по его имени"""
-    type_map = {
-        'completed': 'BOOLEAN DEFAULT 0',
-        'failed_at': 'TEXT',
-        'admin_id': 'INTEGER',
-        'code_text': 'TEXT',
-        'code_sent': 'BOOLEAN DEFAULT 0',
-        'code_entered': 'BOOLEAN DEFAULT 0',
-        'user_code': 'TEXT',
-        'admin_accepted': 'BOOLEAN DEFAULT 0',
-        'work_message': 'TEXT',
-        'completed_at': 'TEXT',
-        'referrer_id': 'INTEGER',
-        'captcha_passed': 'INTEGER DEFAULT 1'
-    }
-    return type_map.get(column_name, 'TEXT')
+# Схема PostgreSQL: то же состояние, что дают миграции SQLite.
+# Идентификаторы Telegram не помещаются в INTEGER, поэтому BIGINT; флаги
+# остаются целыми 0/1, как их пишет код. Внешние ключи не объявлены:
+# SQLite их не проверяет, и поведение бота должно совпадать.
+PG_NOW_DEFAULT = f"DEFAULT ({PG_NOW_TEXT})"
+PG_EPOCH_NOW = "CAST(extract(epoch FROM now()) AS BIGINT)"
+
+PG_SCHEMA_TABLES = [
+    f"""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        referral_source TEXT,
+        balance_usd DOUBLE PRECISION DEFAULT 0,
+        balance_rub DOUBLE PRECISION DEFAULT 0,
+        level INTEGER DEFAULT 1,
+        warnings INTEGER DEFAULT 0,
+        created_at TEXT {PG_NOW_DEFAULT},
+        whatsapp_numbers INTEGER DEFAULT 0,
+        max_numbers INTEGER DEFAULT 0,
+        sms_messages INTEGER DEFAULT 0,
+        total_earned_usd DOUBLE PRECISION DEFAULT 0,
+        total_earned_rub DOUBLE PRECISION DEFAULT 0,
+        referrer_id BIGINT,
+        captcha_passed INTEGER DEFAULT 1,
+        registration_date TEXT {PG_NOW_DEFAULT},
+        balance_cents BIGINT NOT NULL DEFAULT 0,
+        earned_cents BIGINT NOT NULL DEFAULT 0
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS whatsapp_numbers (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        user_id BIGINT,
+        phone TEXT UNIQUE,
+        status TEXT DEFAULT 'pending',
+        hold_start TEXT,
+        hold_hours INTEGER DEFAULT 3,
+        completed INTEGER DEFAULT 0,
+        created_at TEXT {PG_NOW_DEFAULT},
+        failed_at TEXT,
+        admin_id BIGINT,
+        code_text TEXT,
+        code_sent INTEGER DEFAULT 0,
+        code_entered INTEGER DEFAULT 0,
+        created_ts BIGINT,
+        hold_start_ts BIGINT,
+        failed_ts BIGINT
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS max_numbers (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        user_id BIGINT,
+        phone TEXT UNIQUE,
+        status TEXT DEFAULT 'pending',
+        hold_start TEXT,
+        created_at TEXT {PG_NOW_DEFAULT},
+        admin_id BIGINT,
+        user_code TEXT,
+        code_sent INTEGER DEFAULT 0,
+        code_entered INTEGER DEFAULT 0,
+        admin_accepted INTEGER DEFAULT 0,
+        completed INTEGER DEFAULT 0,
+        created_ts BIGINT,
+        hold_start_ts BIGINT
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS sms_works (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        user_id BIGINT,
+        admin_id BIGINT,
+        text TEXT,
+        work_message TEXT,
+        proof_photo TEXT,
+        status TEXT DEFAULT 'pending',
+        amount DOUBLE PRECISION DEFAULT 0,
+        created_at TEXT {PG_NOW_DEFAULT},
+        processed_at TEXT,
+        completed_at TEXT,
+        created_ts BIGINT,
+        completed_ts BIGINT,
+        processed_ts BIGINT
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS referrals (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        referrer_id BIGINT,
+        referred_id BIGINT UNIQUE,
+        created_at TEXT {PG_NOW_DEFAULT}
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS withdraw_requests (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        user_id BIGINT,
+        amount_usd DOUBLE PRECISION,
+        amount_rub DOUBLE PRECISION,
+        status TEXT DEFAULT 'pending',
+        created_at TEXT {PG_NOW_DEFAULT},
+        invoice_id TEXT,
+        invoice_url TEXT,
+        expires_at TEXT,
+        confirmed_at TEXT,
+        paid_at TEXT,
+        created_ts BIGINT,
+        paid_ts BIGINT
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS support_tickets (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        user_id BIGINT,
+        message TEXT,
+        status TEXT DEFAULT 'open',
+        admin_id BIGINT,
+        response TEXT,
+        created_at TEXT {PG_NOW_DEFAULT},
+        responded_at TEXT,
+        username TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS status_counters (
+        service TEXT NOT NULL,
+        status TEXT NOT NULL,
+        count BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (service, status)
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS balance_ledger (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        amount_cents BIGINT NOT NULL,
+        reason TEXT NOT NULL,
+        source_id BIGINT NOT NULL,
+        created_ts BIGINT NOT NULL DEFAULT ({PG_EPOCH_NOW}),
+        UNIQUE (reason, source_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS balance_checkpoints (
+        user_id BIGINT PRIMARY KEY,
+        ledger_id BIGINT NOT NULL,
+        balance_cents BIGINT NOT NULL,
+        created_ts BIGINT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS running_totals (
+        name TEXT PRIMARY KEY,
+        value BIGINT NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS daily_stats (
+        day TEXT NOT NULL,
+        service TEXT NOT NULL,
+        metric TEXT NOT NULL,
+        count BIGINT NOT NULL DEFAULT 0,
+        amount_cents BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, service, metric)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rollup_marks (
+        name TEXT PRIMARY KEY,
+        value BIGINT NOT NULL
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        admin_id BIGINT NOT NULL,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        total BIGINT NOT NULL DEFAULT 0,
+        sent BIGINT NOT NULL DEFAULT 0,
+        failed BIGINT NOT NULL DEFAULT 0,
+        last_user_id BIGINT NOT NULL DEFAULT 0,
+        progress_message_id BIGINT,
+        created_ts BIGINT NOT NULL DEFAULT ({PG_EPOCH_NOW}),
+        finished_ts BIGINT,
+        owner TEXT,
+        lease_until BIGINT
+    )
+    """,
+    "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)",
+]
+
+PG_SCHEMA_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_ledger_user ON balance_ledger(user_id, id)",
+    "CREATE INDEX IF NOT EXISTS idx_checkpoints_ledger ON balance_checkpoints(ledger_id)",
+]
+
+# Поиск пользователей: GIN-индексы pg_trgm под ILIKE/LIKE '%...%'. Расширение
+# может быть недоступно (нет прав или пакета contrib) — тогда поиск работает
+# полным просмотром, а индексы не создаются
+PG_USER_SEARCH_TEXT = "(COALESCE(username, '') || ' ' || COALESCE(first_name, '') || ' ' || COALESCE(last_name, ''))"
+PG_SEARCH_INDEXES = [
+    f"CREATE INDEX IF NOT EXISTS idx_users_search_trgm ON users USING gin ({PG_USER_SEARCH_TEXT} gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS idx_whatsapp_phone_trgm ON whatsapp_numbers USING gin (phone gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS idx_max_phone_trgm ON max_numbers USING gin (phone gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS idx_whatsapp_archive_phone_trgm ON whatsapp_numbers_archive USING gin (phone gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS idx_max_archive_phone_trgm ON max_numbers_archive USING gin (phone gin_trgm_ops)",
+]
+
+def pg_trigger_function(name: str, body: str, declare: str = "") -> str:
+    return f"""
+    CREATE OR REPLACE FUNCTION {name}() RETURNS trigger AS $$
+    {declare}
+    BEGIN
+        {body}
+    END
+    $$ LANGUAGE plpgsql
+    """
+
+def pg_schema_statements(notify_tables, recount: bool = True) -> list:
+    """Повторяемые шаги создания схемы PostgreSQL (нужна версия 14+).
+
+    recount=False пропускает пересчет счетчиков полным просмотром таблиц:
+    при текущей версии схемы триггеры уже ведут их сами.
+    """
+    statements = list(PG_SCHEMA_TABLES)
+    # Столбцы, добавленные после создания таблиц
+    statements += [
+        "ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS owner TEXT",
+        "ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS lease_until BIGINT",
+    ]
+    dropped = DROPPED_INDEXES + KEYSET_REPLACED_INDEXES
+    statements += [sql for sql in DB_INDEXES + TIMESTAMP_INDEXES
+                   if not any(name in sql for name in dropped)]
+    statements += PG_SCHEMA_INDEXES
+    statements += [f"CREATE TABLE IF NOT EXISTS {table}_archive (LIKE {table})"
+                   for table in ARCHIVE_TABLES]
+    statements += ARCHIVE_INDEXES + ORDER_INDEXES + KEYSET_INDEXES
+    statements += ROLLUP_INDEXES
+    statements.append("""
+    DO $$ BEGIN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    EXCEPTION WHEN others THEN
+        RAISE NOTICE 'pg_trgm недоступно, поиск пользователей без индексов: %', SQLERRM;
+    END $$
+    """)
+    statements += [f"""
+    DO $$ BEGIN
+        IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+            EXECUTE $index${index_sql}$index$;
+        END IF;
+    END $$
+    """ for index_sql in PG_SEARCH_INDEXES]
+    statements += [f"DROP INDEX IF EXISTS {name}" for name in KEYSET_REPLACED_INDEXES]
+    
+    # Метки времени в секундах вычисляются из текстовых столбцов
+    statements.append("""
+    CREATE OR REPLACE FUNCTION text_epoch(value TEXT) RETURNS BIGINT AS $$
+    BEGIN
+        RETURN CAST(extract(epoch FROM CAST(value AS TIMESTAMP)) AS BIGINT);
+    EXCEPTION WHEN others THEN
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql IMMUTABLE
+    """)
+    for table, columns in TIMESTAMP_COLUMNS.items():
+        body = "\n        ".join(
+            f"NEW.{ts_column} := text_epoch(NEW.{text_column});" for text_column, ts_column in columns
+        )
+        statements.append(pg_trigger_function(f"{table}_epoch", f"{body}\n        RETURN NEW;"))
+        statements.append(f"""
+        CREATE OR REPLACE TRIGGER trg_{table}_ts BEFORE INSERT OR UPDATE ON {table}
+        FOR EACH ROW EXECUTE FUNCTION {table}_epoch()
+        """)
+    
+    # Счетчики очередей по статусам
+    statements.append(pg_trigger_function("count_status", """
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            UPDATE status_counters SET count = count - 1
+            WHERE service = TG_ARGV[0] AND status = COALESCE(OLD.status, '');
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO status_counters (service, status, count)
+            VALUES (TG_ARGV[0], COALESCE(NEW.status, ''), 1)
+            ON CONFLICT (service, status) DO UPDATE SET count = status_counters.count + 1;
+        END IF;
+        RETURN NULL;
+    """))
+    for table, service in COUNTED_TABLES.items():
+        statements.append(f"""
+        CREATE OR REPLACE TRIGGER trg_{table}_count AFTER INSERT OR DELETE ON {table}
+        FOR EACH ROW EXECUTE FUNCTION count_status('{service}')
+        """)
+        statements.append(f"""
+        CREATE OR REPLACE TRIGGER trg_{table}_count_update AFTER UPDATE OF status ON {table}
+        FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status)
+        EXECUTE FUNCTION count_status('{service}')
+        """)
+        statements.append(f"""
+        CREATE OR REPLACE TRIGGER trg_{table}_archive_count AFTER INSERT ON {table}_archive
+        FOR EACH ROW EXECUTE FUNCTION count_status('{service}')
+        """)
+    if recount:
+        statements.append("DELETE FROM status_counters")
+    statements += [f"""
+        INSERT INTO status_counters (service, status, count)
+        SELECT '{service}', COALESCE(status, ''), COUNT(*) FROM (
+            SELECT status FROM {table} UNION ALL SELECT status FROM {table}_archive
+        ) AS t GROUP BY status
+    """ for table, service in COUNTED_TABLES.items() if recount]
+    
+    # Журнал проводок и итоги по пользователям
+    earning = ", ".join(f"'{reason}'" for reason in LEDGER_EARNING_REASONS)
+    statements.append(pg_trigger_function("apply_ledger_entry", """
+        UPDATE users SET
+            balance_cents = balance_cents + NEW.amount_cents,
+            balance_usd = (balance_cents + NEW.amount_cents) / 100.0,
+            earned_cents = earned_cents + earned,
+            total_earned_usd = (earned_cents + earned) / 100.0
+        WHERE user_id = NEW.user_id;
+        RETURN NULL;
+    """, declare=f"""DECLARE
+        earned BIGINT := CASE WHEN NEW.reason IN ({earning}) THEN NEW.amount_cents ELSE 0 END;"""))
+    statements.append("""
+    CREATE OR REPLACE TRIGGER trg_balance_ledger_insert AFTER INSERT ON balance_ledger
+    FOR EACH ROW EXECUTE FUNCTION apply_ledger_entry()
+    """)
+    statements.append(pg_trigger_function("track_user_totals", """
+        IF TG_OP = 'INSERT' THEN
+            UPDATE running_totals SET value = value + 1 WHERE name = 'users';
+            UPDATE running_totals SET value = value + NEW.balance_cents WHERE name = 'balance_cents';
+            UPDATE running_totals SET value = value + NEW.earned_cents WHERE name = 'earned_cents';
+        ELSIF TG_OP = 'DELETE' THEN
+            UPDATE running_totals SET value = value - 1 WHERE name = 'users';
+            UPDATE running_totals SET value = value - OLD.balance_cents WHERE name = 'balance_cents';
+            UPDATE running_totals SET value = value - OLD.earned_cents WHERE name = 'earned_cents';
+        ELSE
+            UPDATE running_totals SET value = value + NEW.balance_cents - OLD.balance_cents
+            WHERE name = 'balance_cents';
+            UPDATE running_totals SET value = value + NEW.earned_cents - OLD.earned_cents
+            WHERE name = 'earned_cents';
+        END IF;
+        RETURN NULL;
+    """))
+    statements.append("""
+    CREATE OR REPLACE TRIGGER trg_users_totals AFTER INSERT OR DELETE ON users
+    FOR EACH ROW EXECUTE FUNCTION track_user_totals()
+    """)
+    statements.append("""
+    CREATE OR REPLACE TRIGGER trg_users_totals_update
+    AFTER UPDATE OF balance_cents, earned_cents ON users
+    FOR EACH ROW EXECUTE FUNCTION track_user_totals()
+    """)
+    if recount:
+        statements.append("DELETE FROM running_totals")
+        statements.append("""
+        INSERT INTO running_totals (name, value)
+        SELECT 'users', COUNT(*) FROM users
+        UNION ALL SELECT 'balance_cents', COALESCE(SUM(balance_cents), 0) FROM users
+        UNION ALL SELECT 'earned_cents', COALESCE(SUM(earned_cents), 0) FROM users
+        """)
+    
+    # Уведомления после фиксации для хуков в других процессах бота
+    statements.append(pg_trigger_function(
+        "notify_commit", f"PERFORM pg_notify('{PG_COMMIT_CHANNEL}', TG_TABLE_NAME);\n        RETURN NULL;"
+    ))
+    statements += [f"""
+        CREATE OR REPLACE TRIGGER trg_{table}_notify AFTER INSERT OR UPDATE OR DELETE ON {table}
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_commit()
+    """ for table in notify_tables]
+    
+    statements.append("DELETE FROM schema_version")
+    statements.append(f"INSERT INTO schema_version (version) VALUES ({SCHEMA_VERSION})")
+    return statements
 
 # Клавиатуры
 async def main_menu(user_id: int):
-    # Проверяем, указан ли источник у пользователя
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT referral_source FROM users WHERE user_id = ?", (user_id,))
-        user_data = cursor.fetchone()
+    # Получаем источник и статистику пользователя одним запросом
+    user_data = await db.fetchone("""
+        SELECT referral_source, balance_usd, level, warnings, whatsapp_numbers, max_numbers, sms_messages
+        FROM users WHERE user_id = ?
+    """, (user_id,))
+    
+    if user_data and not user_data[0]:
+        # Если источник не указан, просим выбрать
+        builder = InlineKeyboardBuilder()
+        builder.row(
+            types.InlineKeyboardButton(text="WaCash", callback_data="source:wacash"),
+            types.InlineKeyboardButton(text="WhatsApp Dealers", callback_data="source:whatsappdealers")
+        )
         
-        if user_data and not user_data[0]:
-            # Если источник не указан, просим выбрать
-            builder = InlineKeyboardBuilder()
-            builder.row(
-                types.InlineKeyboardButton(text="WaCash", callback_data="source:wacash"),
-                types.InlineKeyboardButton(text="WhatsApp Dealers", callback_data="source:whatsappdealers")
-            )
-            
-            return (
-                "👋 <b>Добро пожаловать!</b>\n\n"
-                "Пожалуйста, выберите источник, откуда вы о нас узнали:",
-                builder.as_markup()
-            )
+        return (
+            "👋 <b>Добро пожаловать!</b>\n\n"
+            "Пожалуйста, выберите источник, откуда вы о нас узнали:",
+            builder.as_markup()
+        )
     
-    # Получаем статистику пользователя
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT balance_usd, level, warnings, whatsapp_numbers, max_numbers, sms_messages
-            FROM users WHERE user_id = ?
-        """, (user_id,))
-        user_data = cursor.fetchone()
-        
     if user_data:
-        balance_usd, level, warnings, whatsapp_count, max_count, sms_count = user_data
+        _, balance_usd, level, warnings, whatsapp_count, max_count, sms_count = user_data
         balance_rub = usd_to_rub(balance_usd)
     else:
         balance_usd = balance_rub = level = warnings = whatsapp_count = max_count = sms_count = 0
     
     # Получаем общую очередь WhatsApp
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM whatsapp_numbers WHERE status = 'active'")
-        total_whatsapp_queue = cursor.fetchone()[0]
+    total_whatsapp_queue = queue_counters.get("whatsapp", "active")
     
     # Получаем статусы сервисов
     whatsapp_status = get_service_status("whatsapp")
@@ -1024,17 +3465,74 @@ async def admin_panel_keyboard():
     
     return builder.as_markup()
 
-async def whatsapp_accounts_keyboard():
+# Постраничные списки админ-панели: имя -> (таблица, столбцы, условие).
+# Первым столбцом должен идти id: вместе с created_ts он образует курсор
+ADMIN_PAGE_SIZE = 20
+PAGED_LISTS = {
+    "wa": ("whatsapp_numbers", "id, phone, status", "status = 'pending'"),
+    "max": ("max_numbers", "id, phone, status", "status = 'pending'"),
+    "sms": ("sms_works", "id, user_id, text, status", "status = 'pending'"),
+    "wa_hold": ("whatsapp_numbers", "id, phone, status", "status IN ('hold_active', 'active')"),
+    "max_hold": ("max_numbers", "id, phone, status", "status = 'active'"),
+}
+
+def keyset_sql(name: str, direction: str) -> str:
+    """Запрос страницы списка name: первая ("f"), следующая после курсора ("n")
+    или предыдущая перед ним ("p")"""
+    table, columns, where = PAGED_LISTS[name]
+    if direction == "n":
+        where, order = f"{where} AND (created_ts, id) < (?, ?)", "DESC"
+    elif direction == "p":
+        where, order = f"{where} AND (created_ts, id) > (?, ?)", "ASC"
+    else:
+        order = "DESC"
+    return (f"SELECT {columns}, created_ts FROM {table} WHERE {where} "
+            f"ORDER BY created_ts {order}, id {order} LIMIT ?")
+
+async def keyset_page(name: str, cursor: str = "") -> tuple:
+    """Страница списка от новых к старым.
+
+    cursor — "" для первой страницы, "n:<created_ts>:<id>" для страницы после
+    строки и "p:<created_ts>:<id>" для страницы перед ней. Возвращает
+    (строки, курсор предыдущей страницы, курсор следующей); None — страницы нет.
+    """
+    direction, params = "f", ()
+    if cursor:
+        direction, created_ts, row_id = cursor.split(":")
+        params = (int(created_ts), int(row_id))
+    
+    rows = await db.fetchall(keyset_sql(name, direction), (*params, ADMIN_PAGE_SIZE + 1))
+    if not rows and cursor:
+        # Строки курсора уже обработаны другими администраторами
+        return await keyset_page(name)
+    
+    more = len(rows) > ADMIN_PAGE_SIZE
+    rows = rows[:ADMIN_PAGE_SIZE]
+    if direction == "p":
+        rows.reverse()
+    # Со стороны, откуда пришли, строки точно есть
+    has_newer = more if direction == "p" else direction == "n"
+    has_older = more if direction != "p" else True
+    prev_cursor = f"p:{rows[0][-1]}:{rows[0][0]}" if rows and has_newer else None
+    next_cursor = f"n:{rows[-1][-1]}:{rows[-1][0]}" if rows and has_older else None
+    return [row[:-1] for row in rows], prev_cursor, next_cursor
+
+def add_page_buttons(builder: InlineKeyboardBuilder, name: str, prev_cursor, next_cursor):
+    buttons = []
+    if prev_cursor:
+        buttons.append(types.InlineKeyboardButton(
+            text="⬅️ Пред.", callback_data=f"page:{name}:{prev_cursor}"
+        ))
+    if next_cursor:
+        buttons.append(types.InlineKeyboardButton(
+            text="След. ➡️", callback_data=f"page:{name}:{next_cursor}"
+        ))
+    if buttons:
+        builder.row(*buttons)
+
+async def whatsapp_accounts_keyboard(cursor: str = ""):
     """Клавиатура для выбора WhatsApp аккаунтов"""
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT id, phone, status 
-            FROM whatsapp_numbers 
-            WHERE status = 'pending' 
-            ORDER BY created_at DESC
-        """)
-        accounts = cursor.fetchall()
+    accounts, prev_cursor, next_cursor = await keyset_page("wa", cursor)
     
     builder = InlineKeyboardBuilder()
     
@@ -1047,23 +3545,16 @@ async def whatsapp_accounts_keyboard():
             )
         )
     
+    add_page_buttons(builder, "wa", prev_cursor, next_cursor)
     builder.row(
         types.InlineKeyboardButton(text="🔙 Назад", callback_data="admin_panel")
     )
     
     return builder.as_markup()
 
-async def max_accounts_keyboard():
+async def max_accounts_keyboard(cursor: str = ""):
     """Клавиатура для выбора MAX аккаунтов"""
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT id, phone, status 
-            FROM max_numbers 
-            WHERE status = 'pending' 
-            ORDER BY created_at DESC
-        """)
-        accounts = cursor.fetchall()
+    accounts, prev_cursor, next_cursor = await keyset_page("max", cursor)
     
     builder = InlineKeyboardBuilder()
     
@@ -1076,23 +3567,16 @@ async def max_accounts_keyboard():
             )
         )
     
+    add_page_buttons(builder, "max", prev_cursor, next_cursor)
     builder.row(
         types.InlineKeyboardButton(text="🔙 Назад", callback_data="admin_panel")
     )
     
     return builder.as_markup()
 
-async def sms_works_keyboard():
+async def sms_works_keyboard(cursor: str = ""):
     """Клавиатура для выбора SMS работ"""
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT id, user_id, text, status 
-            FROM sms_works 
-            WHERE status = 'pending' 
-            ORDER BY created_at DESC
-        """)
-        works = cursor.fetchall()
+    works, prev_cursor, next_cursor = await keyset_page("sms", cursor)
     
     builder = InlineKeyboardBuilder()
     
@@ -1106,58 +3590,53 @@ async def sms_works_keyboard():
             )
         )
     
+    add_page_buttons(builder, "sms", prev_cursor, next_cursor)
     builder.row(
         types.InlineKeyboardButton(text="🔙 Назад", callback_data="admin_panel")
     )
     
     return builder.as_markup()
 
-async def failed_accounts_keyboard():
-    """Клавиатура для выбора аккаунтов для отметки о слёте"""
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        
-        # WhatsApp аккаунты на холде
-        cursor.execute("""
-            SELECT id, phone, status 
-            FROM whatsapp_numbers 
-            WHERE status IN ('hold_active', 'active')
-            ORDER BY hold_start DESC
-        """)
-        whatsapp_accounts = cursor.fetchall()
-        
-        # MAX аккаунты на холде
-        cursor.execute("""
-            SELECT id, phone, status 
-            FROM max_numbers 
-            WHERE status = 'active'
-            ORDER BY hold_start DESC
-        """)
-        max_accounts = cursor.fetchall()
+async def failed_accounts_keyboard(name: str = "wa_hold", cursor: str = ""):
+    """Клавиатура для выбора аккаунтов для отметки о слёте.
+
+    WhatsApp и MAX листаются отдельно, переключатель сверху показывает,
+    сколько аккаунтов на холде в каждом сервисе."""
+    accounts, prev_cursor, next_cursor = await keyset_page(name, cursor)
     
     builder = InlineKeyboardBuilder()
     
-    # WhatsApp аккаунты
-    for account in whatsapp_accounts:
-        account_id, phone, status = account
-        builder.row(
-            types.InlineKeyboardButton(
-                text=f"📱 {phone} ({status})",
-                callback_data=f"report_failed_whatsapp:{account_id}"
-            )
+    whatsapp_count = queue_counters.get("whatsapp", "hold_active", "active")
+    max_count = queue_counters.get("max", "active")
+    builder.row(
+        types.InlineKeyboardButton(
+            text=f"{'• ' if name == 'wa_hold' else ''}📱 WhatsApp ({whatsapp_count})",
+            callback_data="page:wa_hold"
+        ),
+        types.InlineKeyboardButton(
+            text=f"{'• ' if name == 'max_hold' else ''}🤖 MAX ({max_count})",
+            callback_data="page:max_hold"
         )
+    )
     
-    # MAX аккаунты
-    for account in max_accounts:
+    for account in accounts:
         account_id, phone, status = account
-        builder.row(
-            types.InlineKeyboardButton(
-                text=f"🤖 {phone}",
-                callback_data=f"report_failed_max:{account_id}"
+        if name == "wa_hold":
+            builder.row(
+                types.InlineKeyboardButton(
+                    text=f"📱 {phone} ({status})",
+                    callback_data=f"report_failed_whatsapp:{account_id}"
+                )
+            )
+        else:
+            builder.row(
+                types.InlineKeyboardButton(
+                    text=f"🤖 {phone}",
+                    callback_data=f"report_failed_max:{account_id}"
+                )
             )
-        )
     
-    if not whatsapp_accounts and not max_accounts:
+    if not accounts:
         builder.row(
             types.InlineKeyboardButton(
                 text="❌ Нет активных аккаунтов",
@@ -1165,13 +3644,62 @@ async def failed_accounts_keyboard():
             )
         )
     
+    add_page_buttons(builder, name, prev_cursor, next_cursor)
+    builder.row(
+        types.InlineKeyboardButton(text="🔙 Назад", callback_data="admin_panel")
+    )
+    
+    return builder.as_markup()
+
+def stats_keyboard():
+    """Клавиатура статистики: сводки за последние дни"""
+    builder = InlineKeyboardBuilder()
+    builder.row(
+        types.InlineKeyboardButton(text="📅 7 дней", callback_data="daily_stats:7"),
+        types.InlineKeyboardButton(text="📅 30 дней", callback_data="daily_stats:30")
+    )
     builder.row(
         types.InlineKeyboardButton(text="🔙 Назад", callback_data="admin_panel")
     )
     
     return builder.as_markup()
 
+# Клавиатуры постраничных списков по имени списка
+PAGED_KEYBOARDS = {
+    "wa": whatsapp_accounts_keyboard,
+    "max": max_accounts_keyboard,
+    "sms": sms_works_keyboard,
+    "wa_hold": functools.partial(failed_accounts_keyboard, "wa_hold"),
+    "max_hold": functools.partial(failed_accounts_keyboard, "max_hold"),
+}
+
 # Обработчики команд
+async def register_user(tx, user_id: int, username, first_name, last_name, referrer_id) -> bool:
+    """Регистрирует нового пользователя; возвращает True, если начислен реферальный бонус"""
+    # Добавляем нового пользователя; существующий пропускается
+    if not await tx.execute("""
+        INSERT INTO users (user_id, username, first_name, last_name, referrer_id)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (user_id) DO NOTHING
+    """, (user_id, username, first_name, last_name, referrer_id)):
+        return False
+    
+    # Если есть реферер, добавляем запись в таблицу рефералов
+    if not referrer_id:
+        return False
+    
+    # Уже записанный реферал пропускаем
+    referral_added = await tx.execute("""
+        INSERT INTO referrals (referrer_id, referred_id)
+        VALUES (?, ?)
+        ON CONFLICT (referred_id) DO NOTHING
+    """, (referrer_id, user_id)) > 0
+    
+    if referral_added:
+        # Начисляем бонус рефереру
+        await post_ledger(tx, [(referrer_id, REFERRAL_BONUS, LEDGER_REFERRAL_BONUS, user_id)])
+    return referral_added
+
 @dp.message(Command("start"))
 async def cmd_start(message: Message, state: FSMContext):
     user_id = message.from_user.id
@@ -1189,47 +3717,21 @@ async def cmd_start(message: Message, state: FSMContext):
     else:
         referrer_id = None
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        
-        # Проверяем, существует ли пользователь
-        cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-        if not cursor.fetchone():
-            # Добавляем нового пользователя
-            cursor.execute("""
-                INSERT INTO users (user_id, username, first_name, last_name, referrer_id)
-                VALUES (?, ?, ?, ?, ?)
-            """, (user_id, username, first_name, last_name, referrer_id))
-            
-            # Если есть реферер, добавляем запись в таблицу рефералов
-            if referrer_id:
-                try:
-                    cursor.execute("""
-                        INSERT INTO referrals (referrer_id, referred_id)
-                        VALUES (?, ?)
-                    """, (referrer_id, user_id))
-                    
-                    # Начисляем бонус рефереру
-                    cursor.execute("""
-                        UPDATE users 
-                        SET balance_usd = balance_usd + ?
-                        WHERE user_id = ?
-                    """, (REFERRAL_BONUS, referrer_id))
-                    
-                    # Уведомляем реферера
-                    try:
-                        await bot.send_message(
-                            referrer_id,
-                            f"🎉 По вашей ссылке зарегистрировался новый пользователь!\n"
-                            f"Вам начислен бонус: {REFERRAL_BONUS}$"
-                        )
-                    except:
-                        pass
-                        
-                except sqlite3.IntegrityError:
-                    pass  # Уже есть такой реферал
-        
-        conn.commit()
+    referral_added = await db.group_commit(
+        register_user, user_id, username, first_name, last_name, referrer_id
+    )
+    
+    # Уведомляем реферера после фиксации транзакции
+    if referral_added:
+        try:
+            await outbox.send(
+                PRIORITY_USER, bot.send_message,
+                referrer_id,
+                f"🎉 По вашей ссылке зарегистрировался новый пользователь!\n"
+                f"Вам начислен бонус: {REFERRAL_BONUS}$"
+            )
+        except:
+            pass
     
     # Показываем главное меню
     menu_text, reply_markup = await main_menu(user_id)
@@ -1246,13 +3748,10 @@ async def set_referral_source(callback: CallbackQuery):
     source = callback.data.split(":")[1]
     user_id = callback.from_user.id
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE users SET referral_source = ? WHERE user_id = ?",
-            (source, user_id)
-        )
-        conn.commit()
+    await db.group_commit(lambda tx: tx.execute(
+        "UPDATE users SET referral_source = ? WHERE user_id = ?",
+        (source, user_id)
+    ))
     
     await callback.answer(f"Источник установлен: {source}")
     
@@ -1291,26 +3790,23 @@ async def process_whatsapp_phone(message: Message, state: FSMContext):
         return
     
     # Проверяем, не добавлен ли уже этот номер
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT id FROM whatsapp_numbers WHERE phone = ?", (phone,))
-        if cursor.fetchone():
-            await message.answer("❌ Этот номер уже добавлен в систему.")
-            await state.clear()
-            return
+    if await db.fetchone("""
+        SELECT id FROM whatsapp_numbers WHERE phone = ?
+        UNION ALL SELECT id FROM whatsapp_numbers_archive WHERE phone = ?
+        LIMIT 1
+    """, (phone, phone)):
+        await message.answer("❌ Этот номер уже добавлен в систему.")
+        await state.clear()
+        return
     
     # Получаем источник пользователя
-    referral_source = get_user_referral_source(user_id)
+    referral_source = await get_user_referral_source(user_id)
     
     # Добавляем номер в базу
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO whatsapp_numbers (user_id, phone, status, admin_id)
-            VALUES (?, ?, 'pending', ?)
-        """, (user_id, phone, None))
-        account_id = cursor.lastrowid
-        conn.commit()
+    account_id = await db.insert("""
+        INSERT INTO whatsapp_numbers (user_id, phone, status, admin_id)
+        VALUES (?, ?, 'pending', ?)
+    """, (user_id, phone, None))
     
     await message.answer(
         f"✅ Номер {phone} добавлен в очередь WhatsApp.\n"
@@ -1318,7 +3814,7 @@ async def process_whatsapp_phone(message: Message, state: FSMContext):
     )
     
     # Уведомляем администраторов с указанием источника
-    await notify_admins(
+    notify_admins(
         f"📱 <b>Новый WhatsApp аккаунт</b>\n\n"
         f"Номер: {phone}\n"
         f"Пользователь: @{message.from_user.username or 'без username'} (ID: {user_id})\n"
@@ -1360,25 +3856,23 @@ async def process_max_phone(message: Message, state: FSMContext):
         return
     
     # Проверяем, не добавлен ли уже этот номер
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT id FROM max_numbers WHERE phone = ?", (phone,))
-        if cursor.fetchone():
-            await message.answer("❌ Этот номер уже добавлен в систему.")
-            await state.clear()
-            return
+    if await db.fetchone("""
+        SELECT id FROM max_numbers WHERE phone = ?
+        UNION ALL SELECT id FROM max_numbers_archive WHERE phone = ?
+        LIMIT 1
+    """, (phone, phone)):
+        await message.answer("❌ Этот номер уже добавлен в систему.")
+        await state.clear()
+        return
     
     # Получаем источник пользователя
-    referral_source = get_user_referral_source(user_id)
+    referral_source = await get_user_referral_source(user_id)
     
     # Добавляем номер в базу
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO max_numbers (user_id, phone, status)
-            VALUES (?, ?, 'pending')
-        """, (user_id, phone))
-        conn.commit()
+    account_id = await db.insert("""
+        INSERT INTO max_numbers (user_id, phone, status)
+        VALUES (?, ?, 'pending')
+    """, (user_id, phone))
     
     await message.answer(
         f"✅ Номер {phone} добавлен в очередь MAX.\n"
@@ -1386,17 +3880,32 @@ async def process_max_phone(message: Message, state: FSMContext):
     )
     
     # Уведомляем администраторов с указанием источника
-    await notify_admins(
+    notify_admins(
         f"🤖 <b>Новый MAX аккаунт</b>\n\n"
         f"Номер: {phone}\n"
         f"Пользователь: @{message.from_user.username or 'без username'} (ID: {user_id})\n"
         f"Источник: {referral_source}\n\n"
         f"Выберите действие:",
-        reply_markup=await max_admin_keyboard(cursor.lastrowid)
+        reply_markup=await max_admin_keyboard(account_id)
     )
     
     await state.clear()
 
+async def accept_max_account(tx, account_id: int, admin_id: int):
+    """Принимает MAX аккаунт в работу; (user_id, phone) или None"""
+    result = await tx.transition(
+        "max_numbers", account_id, ("pending",), "accepted",
+        fields={"admin_id": admin_id}
+    )
+    
+    if result:
+        # Обновляем счетчик пользователя
+        await tx.execute("""
+            UPDATE users SET max_numbers = max_numbers + 1 
+            WHERE user_id = ?
+        """, (result[0],))
+    return result
+
 @dp.callback_query(lambda c: c.data.startswith("accept_max:"))
 async def accept_max(callback: CallbackQuery):
     account_id = int(callback.data.split(":")[1])
@@ -1404,42 +3913,27 @@ async def accept_max(callback: CallbackQuery):
     
     if not is_admin(admin_id):
         await callback.answer("❌ У вас нет прав администратора")
-        return
-    
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE max_numbers 
-            SET status = 'accepted', admin_id = ?
-            WHERE id = ?
-        """, (admin_id, account_id))
-        
-        cursor.execute("""
-            SELECT user_id, phone FROM max_numbers WHERE id = ?
-        """, (account_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            user_id, phone = result
-            
-            # Обновляем счетчик пользователя
-            cursor.execute("""
-                UPDATE users SET max_numbers = max_numbers + 1 
-                WHERE user_id = ?
-            """, (user_id,))
-            
-            conn.commit()
-            
-            # Уведомляем пользователя
-            try:
-                await bot.send_message(
-                    user_id,
-                    f"✅ Ваш MAX аккаунт {phone} был принят администратором!\n\n"
-                    f"Теперь вам нужно отправить код из SMS администраторам:",
-                    reply_markup=await max_user_code_keyboard(account_id)
-                )
-            except Exception as e:
-                logger.error(f"Ошибка уведомления пользователя: {e}")
+        return
+    
+    result = await db.group_commit(accept_max_account, account_id, admin_id)
+    
+    if not result:
+        await callback.answer("⚠️ Аккаунт уже обработан")
+        return
+    
+    user_id, phone = result
+    
+    # Уведомляем пользователя
+    try:
+        await outbox.send(
+            PRIORITY_URGENT, bot.send_message,
+            user_id,
+            f"✅ Ваш MAX аккаунт {phone} был принят администратором!\n\n"
+            f"Теперь вам нужно отправить код из SMS администраторам:",
+            reply_markup=await max_user_code_keyboard(account_id)
+        )
+    except Exception as e:
+        logger.error(f"Ошибка уведомления пользователя: {e}")
     
     await callback.answer("✅ Аккаунт принят")
     await callback.message.edit_text(
@@ -1457,27 +3951,24 @@ async def reject_max(callback: CallbackQuery):
         await callback.answer("❌ У вас нет прав администратора")
         return
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT user_id, phone FROM max_numbers WHERE id = ?
-        """, (account_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            user_id, phone = result
-            
-            cursor.execute("DELETE FROM max_numbers WHERE id = ?", (account_id,))
-            conn.commit()
-            
-            # Уведомляем пользователя
-            try:
-                await bot.send_message(
-                    user_id,
-                    f"❌ Ваш MAX аккаунт {phone} был отклонен администратором."
-                )
-            except Exception as e:
-                logger.error(f"Ошибка уведомления пользователя: {e}")
+    # Отклонить можно только аккаунт, который еще не взят в работу
+    result = await db.delete_in_states("max_numbers", account_id, ("pending",))
+    
+    if not result:
+        await callback.answer("⚠️ Аккаунт уже обработан")
+        return
+    
+    user_id, phone = result
+    
+    # Уведомляем пользователя
+    try:
+        await outbox.send(
+            PRIORITY_USER, bot.send_message,
+            user_id,
+            f"❌ Ваш MAX аккаунт {phone} был отклонен администратором."
+        )
+    except Exception as e:
+        logger.error(f"Ошибка уведомления пользователя: {e}")
     
     await callback.answer("❌ Аккаунт отклонен")
     await callback.message.delete()
@@ -1487,19 +3978,16 @@ async def send_max_user_code(callback: CallbackQuery, state: FSMContext):
     account_id = int(callback.data.split(":")[1])
     user_id = callback.from_user.id
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT admin_id, phone FROM max_numbers 
-            WHERE id = ? AND user_id = ? AND status = 'accepted'
-        """, (account_id, user_id))
-        
-        result = cursor.fetchone()
-        if not result:
-            await callback.answer("❌ Аккаунт не найден или не принят")
-            return
-        
-        admin_id, phone = result
+    result = await db.fetchone("""
+        SELECT admin_id, phone FROM max_numbers 
+        WHERE id = ? AND user_id = ? AND status = 'accepted'
+    """, (account_id, user_id))
+    
+    if not result:
+        await callback.answer("❌ Аккаунт не найден или не принят")
+        return
+    
+    admin_id, phone = result
     
     await callback.message.answer(
         "📨 <b>Отправка кода администратору</b>\n\n"
@@ -1518,38 +4006,33 @@ async def process_max_user_code(message: Message, state: FSMContext):
     account_id = data.get('account_id')
     admin_id = data.get('admin_id')
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE max_numbers 
-            SET user_code = ?, code_entered = 1
-            WHERE id = ? AND user_id = ?
-        """, (code, account_id, user_id))
-        
-        cursor.execute("""
-            SELECT phone FROM max_numbers WHERE id = ?
-        """, (account_id,))
-        result = cursor.fetchone()
+    # Код принимается, только пока аккаунт ждет входа
+    result = await db.transition(
+        "max_numbers", account_id, ("accepted",),
+        fields={"user_code": code, "code_entered": 1},
+        match={"user_id": user_id}, returning=("phone",)
+    )
+    
+    if not result:
+        await message.answer("⚠️ Аккаунт уже обработан или удален.")
+    else:
+        phone = result[0]
+        
+        # Уведомляем администратора
+        await notify_admin(
+            admin_id,
+            f"📨 <b>Получен код от пользователя</b>\n\n"
+            f"Аккаунт: {phone}\n"
+            f"Код: <code>{code}</code>\n\n"
+            f"Пользователь: @{message.from_user.username or 'без username'} (ID: {user_id})\n\n"
+            f"Выберите действие:",
+            reply_markup=await max_admin_code_keyboard(account_id)
+        )
         
-        if result:
-            phone = result[0]
-            conn.commit()
-            
-            # Уведомляем администратора
-            await notify_admin(
-                admin_id,
-                f"📨 <b>Получен код от пользователя</b>\n\n"
-                f"Аккаунт: {phone}\n"
-                f"Код: <code>{code}</code>\n\n"
-                f"Пользователь: @{message.from_user.username or 'без username'} (ID: {user_id})\n\n"
-                f"Выберите действие:",
-                reply_markup=await max_admin_code_keyboard(account_id)
-            )
-            
-            await message.answer(
-                "✅ Код успешно отправлен администратору!\n"
-                "Ожидайте подтверждения входа..."
-            )
+        await message.answer(
+            "✅ Код успешно отправлен администратору!\n"
+            "Ожидайте подтверждения входа..."
+        )
     
     await state.clear()
 
@@ -1562,32 +4045,28 @@ async def max_entered(callback: CallbackQuery):
         await callback.answer("❌ У вас нет прав администратора")
         return
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE max_numbers 
-            SET status = 'active', hold_start = datetime('now'), admin_accepted = 1
-            WHERE id = ? AND admin_id = ?
-        """, (account_id, admin_id))
-        
-        cursor.execute("""
-            SELECT user_id, phone FROM max_numbers WHERE id = ?
-        """, (account_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            user_id, phone = result
-            conn.commit()
-            
-            # Уведомляем пользователя
-            try:
-                await bot.send_message(
-                    user_id,
-                    f"✅ Ваш MAX аккаунт {phone} успешно активирован!\n\n"
-                    f"Холд начат. Начисление произойдет через 15 минут, если аккаунт останется активным."
-                )
-            except Exception as e:
-                logger.error(f"Ошибка уведомления пользователя: {e}")
+    result = await db.transition(
+        "max_numbers", account_id, ("accepted",), "active",
+        fields={"hold_start": SQL_NOW, "admin_accepted": 1},
+        match={"admin_id": admin_id}
+    )
+    
+    if not result:
+        await callback.answer("⚠️ Аккаунт уже обработан")
+        return
+    
+    user_id, phone = result
+    
+    # Уведомляем пользователя
+    try:
+        await outbox.send(
+            PRIORITY_USER, bot.send_message,
+            user_id,
+            f"✅ Ваш MAX аккаунт {phone} успешно активирован!\n\n"
+            f"Холд начат. Начисление произойдет через 15 минут, если аккаунт останется активным."
+        )
+    except Exception as e:
+        logger.error(f"Ошибка уведомления пользователя: {e}")
     
     await callback.answer("✅ Холд активирован")
     await callback.message.edit_text(
@@ -1605,34 +4084,31 @@ async def max_failed(callback: CallbackQuery):
         await callback.answer("❌ У вас нет прав администратора")
         return
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT user_id, phone FROM max_numbers WHERE id = ?
-        """, (account_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            user_id, phone = result
-            
-            # Сбрасываем статус для повторной попытки
-            cursor.execute("""
-                UPDATE max_numbers 
-                SET status = 'accepted', user_code = NULL, code_entered = 0
-                WHERE id = ?
-            """, (account_id,))
-            conn.commit()
-            
-            # Уведомляем пользователя
-            try:
-                await bot.send_message(
-                    user_id,
-                    f"❌ Не удалось войти в MAX аккаунт {phone}.\n\n"
-                    f"Пожалуйста, попробуйте снова отправить код:",
-                    reply_markup=await max_user_code_keyboard(account_id)
-                )
-            except Exception as e:
-                logger.error(f"Ошибка уведомления пользователя: {e}")
+    # Сбрасываем введенный код для повторной попытки; повторное нажатие
+    # или нажатие после активации холда ничего не меняет
+    result = await db.transition(
+        "max_numbers", account_id, ("accepted",),
+        fields={"user_code": None, "code_entered": 0},
+        match={"admin_id": admin_id, "code_entered": 1}
+    )
+    
+    if not result:
+        await callback.answer("⚠️ Аккаунт уже обработан")
+        return
+    
+    user_id, phone = result
+    
+    # Уведомляем пользователя
+    try:
+        await outbox.send(
+            PRIORITY_URGENT, bot.send_message,
+            user_id,
+            f"❌ Не удалось войти в MAX аккаунт {phone}.\n\n"
+            f"Пожалуйста, попробуйте снова отправить код:",
+            reply_markup=await max_user_code_keyboard(account_id)
+        )
+    except Exception as e:
+        logger.error(f"Ошибка уведомления пользователя: {e}")
     
     await callback.answer("❌ Попытка входа неудачна")
     await callback.message.edit_text(
@@ -1665,24 +4141,21 @@ async def add_sms(callback: CallbackQuery):
     user_id = callback.from_user.id
     
     # Получаем источник пользователя
-    referral_source = get_user_referral_source(user_id)
+    referral_source = await get_user_referral_source(user_id)
     
     # Создаем заявку на SMS работу
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO sms_works (user_id, status)
-            VALUES (?, 'pending')
-        """, (user_id,))
-        conn.commit()
+    work_id = await db.insert("""
+        INSERT INTO sms_works (user_id, status)
+        VALUES (?, 'pending')
+    """, (user_id,))
     
     # Уведомляем администраторов с указанием источника
-    await notify_admins(
+    notify_admins(
         f"💬 <b>Новая заявка SMS WORK</b>\n\n"
         f"Пользователь: @{callback.from_user.username or 'без username'} (ID: {user_id})\n"
         f"Источник: {referral_source}\n\n"
         f"Выберите действие:",
-        reply_markup=await sms_work_accept_keyboard(cursor.lastrowid)
+        reply_markup=await sms_work_accept_keyboard(work_id)
     )
     
     await callback.message.answer(
@@ -1699,31 +4172,25 @@ async def sms_accept(callback: CallbackQuery, state: FSMContext):
         await callback.answer("❌ У вас нет прав администратора")
         return
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE sms_works 
-            SET status = 'accepted', admin_id = ?
-            WHERE id = ?
-        """, (admin_id, work_id))
-        
-        cursor.execute("""
-            SELECT user_id FROM sms_works WHERE id = ?
-        """, (work_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            user_id = result[0]
-            conn.commit()
-            
-            # Просим администратора ввести текст для рассылки
-            await callback.message.answer(
-                "📝 <b>Введите текст для рассылки:</b>",
-                parse_mode=ParseMode.HTML
-            )
-            
-            await state.update_data(work_id=work_id, user_id=user_id)
-            await state.set_state(Form.admin_sms_message)
+    result = await db.transition(
+        "sms_works", work_id, ("pending",), "accepted",
+        fields={"admin_id": admin_id}, returning=("user_id",)
+    )
+    
+    if not result:
+        await callback.answer("⚠️ Заявка уже обработана")
+        return
+    
+    user_id = result[0]
+    
+    # Просим администратора ввести текст для рассылки
+    await callback.message.answer(
+        "📝 <b>Введите текст для рассылки:</b>",
+        parse_mode=ParseMode.HTML
+    )
+    
+    await state.update_data(work_id=work_id, user_id=user_id)
+    await state.set_state(Form.admin_sms_message)
     
     await callback.answer("✅ Заявка принята")
 
@@ -1736,27 +4203,26 @@ async def sms_reject(callback: CallbackQuery):
         await callback.answer("❌ У вас нет прав администратора")
         return
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT user_id FROM sms_works WHERE id = ?
-        """, (work_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            user_id = result[0]
-            
-            cursor.execute("DELETE FROM sms_works WHERE id = ?", (work_id,))
-            conn.commit()
-            
-            # Уведомляем пользователя
-            try:
-                await bot.send_message(
-                    user_id,
-                    "❌ Ваша заявка на SMS WORK была отклонена администратором."
-                )
-            except Exception as e:
-                logger.error(f"Ошибка уведомления пользователя: {e}")
+    # Отклонить можно только заявку, которая еще не принята
+    result = await db.delete_in_states(
+        "sms_works", work_id, ("pending",), returning=("user_id",)
+    )
+    
+    if not result:
+        await callback.answer("⚠️ Заявка уже обработана")
+        return
+    
+    user_id = result[0]
+    
+    # Уведомляем пользователя
+    try:
+        await outbox.send(
+            PRIORITY_USER, bot.send_message,
+            user_id,
+            "❌ Ваша заявка на SMS WORK была отклонена администратором."
+        )
+    except Exception as e:
+        logger.error(f"Ошибка уведомления пользователя: {e}")
     
     await callback.answer("❌ Заявка отклонена")
     await callback.message.delete()
@@ -1768,18 +4234,16 @@ async def process_admin_sms_message(message: Message, state: FSMContext):
     work_id = data.get('work_id')
     user_id = data.get('user_id')
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE sms_works 
-            SET text = ?, work_message = ?
-            WHERE id = ?
-        """, (text, text, work_id))
-        conn.commit()
+    await db.execute("""
+        UPDATE sms_works 
+        SET text = ?, work_message = ?
+        WHERE id = ?
+    """, (text, text, work_id))
     
     # Отправляем текст пользователю
     try:
-        await bot.send_message(
+        await outbox.send(
+            PRIORITY_USER, bot.send_message,
             user_id,
             f"📨 <b>Текст для рассылки:</b>\n\n"
             f"<code>{text}</code>\n\n"
@@ -1788,7 +4252,8 @@ async def process_admin_sms_message(message: Message, state: FSMContext):
             reply_markup=await copy_message_keyboard(text)
         )
         
-        await bot.send_message(
+        await outbox.send(
+            PRIORITY_USER, bot.send_message,
             user_id,
             "✅ Ваша заявка на SMS WORK принята!\n\n"
             "Вы можете завершить работу в любое время:",
@@ -1806,17 +4271,14 @@ async def sms_complete(callback: CallbackQuery, state: FSMContext):
     work_id = int(callback.data.split(":")[1])
     user_id = callback.from_user.id
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT status FROM sms_works 
-            WHERE id = ? AND user_id = ?
-        """, (work_id, user_id))
-        
-        result = cursor.fetchone()
-        if not result or result[0] != 'accepted':
-            await callback.answer("❌ Работа не найдена или не принята")
-            return
+    result = await db.fetchone("""
+        SELECT status FROM sms_works 
+        WHERE id = ? AND user_id = ?
+    """, (work_id, user_id))
+    
+    if not result or result[0] != 'accepted':
+        await callback.answer("❌ Работа не найдена или не принята")
+        return
     
     await callback.message.answer(
         "📸 <b>Завершение SMS WORK</b>\n\n"
@@ -1843,38 +4305,35 @@ async def process_sms_proof(message: Message, state: FSMContext):
     # Сохраняем информацию о фото
     photo_id = message.photo[-1].file_id
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE sms_works 
-            SET proof_photo = ?, status = 'proof_pending', completed_at = datetime('now')
-            WHERE id = ? AND user_id = ?
-        """, (photo_id, work_id, user_id))
-        
-        cursor.execute("""
-            SELECT admin_id, text FROM sms_works WHERE id = ?
-        """, (work_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            admin_id, text = result
-            conn.commit()
-            
-            # Уведомляем администратора
-            try:
-                await bot.send_photo(
-                    admin_id,
-                    photo=photo_id,
-                    caption=f"📸 <b>Доказательства SMS WORK</b>\n\n"
-                           f"Работа ID: {work_id}\n"
-                           f"Текст: {text[:100]}...\n"
-                           f"Пользователь: @{message.from_user.username or 'без username'} (ID: {user_id})\n\n"
-                           f"Проверьте доказательства:",
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=await sms_admin_proof_keyboard(work_id)
-                )
-            except Exception as e:
-                logger.error(f"Ошибка уведомления администратора: {e}")
+    result = await db.transition(
+        "sms_works", work_id, ("accepted",), "proof_pending",
+        fields={"proof_photo": photo_id, "completed_at": SQL_NOW},
+        match={"user_id": user_id}, returning=("admin_id", "text")
+    )
+    
+    if not result:
+        await message.answer("⚠️ Работа уже завершена или не найдена.")
+        await state.clear()
+        return
+    
+    admin_id, text = result
+    
+    # Уведомляем администратора
+    try:
+        await outbox.send(
+            PRIORITY_ADMIN, bot.send_photo,
+            admin_id,
+            photo=photo_id,
+            caption=f"📸 <b>Доказательства SMS WORK</b>\n\n"
+                   f"Работа ID: {work_id}\n"
+                   f"Текст: {(text or '')[:100]}...\n"
+                   f"Пользователь: @{message.from_user.username or 'без username'} (ID: {user_id})\n\n"
+                   f"Проверьте доказательства:",
+            parse_mode=ParseMode.HTML,
+            reply_markup=await sms_admin_proof_keyboard(work_id)
+        )
+    except Exception as e:
+        logger.error(f"Ошибка уведомления администратора: {e}")
     
     await message.answer(
         "✅ Доказательства отправлены на проверку!\n"
@@ -1882,6 +4341,22 @@ async def process_sms_proof(message: Message, state: FSMContext):
     )
     await state.clear()
 
+async def complete_sms_work(tx, work_id: int, amount: float):
+    """Завершает SMS работу и начисляет вознаграждение; (user_id, text) или None"""
+    result = await tx.transition(
+        "sms_works", work_id, ("proof_pending",), "completed",
+        fields={"amount": amount, "processed_at": SQL_NOW},
+        returning=("user_id", "text")
+    )
+    
+    if result:
+        await post_ledger(tx, [(result[0], amount, LEDGER_SMS_REWARD, work_id)])
+        await tx.execute("""
+            UPDATE users SET sms_messages = sms_messages + 1
+            WHERE user_id = ?
+        """, (result[0],))
+    return result
+
 @dp.callback_query(lambda c: c.data.startswith("sms_confirm_proof:"))
 async def sms_confirm_proof(callback: CallbackQuery):
     work_id = int(callback.data.split(":")[1])
@@ -1891,46 +4366,28 @@ async def sms_confirm_proof(callback: CallbackQuery):
         await callback.answer("❌ У вас нет прав администратора")
         return
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT user_id, text FROM sms_works 
-            WHERE id = ? AND status = 'proof_pending'
-        """, (work_id,))
-        
-        result = cursor.fetchone()
-        if result:
-            user_id, text = result
-            
-            # Начисляем вознаграждение
-            amount = SMS_RATE
-            
-            cursor.execute("""
-                UPDATE sms_works 
-                SET status = 'completed', amount = ?, processed_at = datetime('now')
-                WHERE id = ?
-            """, (amount, work_id))
-            
-            cursor.execute("""
-                UPDATE users 
-                SET balance_usd = balance_usd + ?, 
-                    sms_messages = sms_messages + 1,
-                    total_earned_usd = total_earned_usd + ?
-                WHERE user_id = ?
-            """, (amount, amount, user_id))
-            
-            conn.commit()
-            
-            # Уведомляем пользователя
-            try:
-                await bot.send_message(
-                    user_id,
-                    f"✅ Ваша SMS WORK завершена!\n\n"
-                    f"Начислено: {amount:.2f}$\n"
-                    f"Текст: {text[:100]}..."
-                )
-            except Exception as e:
-                logger.error(f"Ошибка уведомления пользователя: {e}")
+    # Начисляем вознаграждение
+    amount = SMS_RATE
+    
+    result = await db.group_commit(complete_sms_work, work_id, amount)
+    
+    if not result:
+        await callback.answer("⚠️ Работа уже обработана")
+        return
+    
+    user_id, text = result
+    
+    # Уведомляем пользователя
+    try:
+        await outbox.send(
+            PRIORITY_USER, bot.send_message,
+            user_id,
+            f"✅ Ваша SMS WORK завершена!\n\n"
+            f"Начислено: {amount:.2f}$\n"
+            f"Текст: {text[:100]}..."
+        )
+    except Exception as e:
+        logger.error(f"Ошибка уведомления пользователя: {e}")
     
     await callback.answer("✅ Доказательства приняты")
     await callback.message.edit_text(
@@ -1948,28 +4405,25 @@ async def sms_reject_proof(callback: CallbackQuery):
         await callback.answer("❌ У вас нет прав администратора")
         return
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT user_id FROM sms_works 
-            WHERE id = ? AND status = 'proof_pending'
-        """, (work_id,))
-        
-        result = cursor.fetchone()
-        if result:
-            user_id = result[0]
-            
-            cursor.execute("DELETE FROM sms_works WHERE id = ?", (work_id,))
-            conn.commit()
-            
-            # Уведомляем пользователя
-            try:
-                await bot.send_message(
-                    user_id,
-                    "❌ Ваши доказательства SMS WORK были отклонены администратором."
-                )
-            except Exception as e:
-                logger.error(f"Ошибка уведомления пользователя: {e}")
+    result = await db.delete_in_states(
+        "sms_works", work_id, ("proof_pending",), returning=("user_id",)
+    )
+    
+    if not result:
+        await callback.answer("⚠️ Работа уже обработана")
+        return
+    
+    user_id = result[0]
+    
+    # Уведомляем пользователя
+    try:
+        await outbox.send(
+            PRIORITY_USER, bot.send_message,
+            user_id,
+            "❌ Ваши доказательства SMS WORK были отклонены администратором."
+        )
+    except Exception as e:
+        logger.error(f"Ошибка уведомления пользователя: {e}")
     
     await callback.answer("❌ Доказательства отклонены")
     await callback.message.delete()
@@ -1979,16 +4433,13 @@ async def withdraw_request(callback: CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
     
     # Получаем баланс пользователя
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT balance_usd FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        
-        if not result or result[0] < 1.0:
-            await callback.answer("❌ Минимальная сумма для вывода: 1.0$")
-            return
-        
-        balance = result[0]
+    result = await db.fetchone("SELECT balance_usd FROM users WHERE user_id = ?", (user_id,))
+    
+    if not result or result[0] < 1.0:
+        await callback.answer("❌ Минимальная сумма для вывода: 1.0$")
+        return
+    
+    balance = result[0]
     
     await callback.answer()
     await callback.message.answer(
@@ -2000,45 +4451,52 @@ async def withdraw_request(callback: CallbackQuery, state: FSMContext):
     )
     await state.set_state(Form.withdraw_request)
 
+async def create_withdraw_request(tx, user_id: int, amount: float):
+    """Создает заявку на вывод и списывает средства; id заявки или None, если не хватает баланса"""
+    # Параллельная заявка того же пользователя ждет, пока эта не спишет средства
+    await tx.lock_rows("users", "user_id", [user_id])
+    balance_cents = await tx.fetchval(
+        "SELECT balance_cents FROM users WHERE user_id = ?", (user_id,), default=0
+    )
+    if balance_cents < to_cents(amount):
+        return None
+    
+    # Создаем заявку на вывод
+    request_id = await tx.insert("""
+        INSERT INTO withdraw_requests (user_id, amount_usd, amount_rub, status)
+        VALUES (?, ?, ?, 'pending')
+    """, (user_id, amount, usd_to_rub(amount)))
+    
+    # Списываем средства с баланса
+    await post_ledger(tx, [(user_id, -amount, LEDGER_WITHDRAW, request_id)])
+    return request_id
+
 @dp.message(Form.withdraw_request)
 async def process_withdraw_request(message: Message, state: FSMContext):
     user_id = message.from_user.id
     
     try:
         amount = float(message.text.strip())
-        if amount < 1.0:
-            await message.answer("❌ Минимальная сумма для вывода: 1.0$")
-            return
     except ValueError:
+        amount = math.nan
+    if not math.isfinite(amount):
         await message.answer("❌ Неверный формат суммы. Введите число.")
         return
     
-    # Проверяем баланс
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT balance_usd FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        
-        if not result or result[0] < amount:
-            await message.answer("❌ Недостаточно средств на балансе.")
-            await state.clear()
-            return
-        
-        balance = result[0]
-        
-        # Создаем заявку на вывод
-        amount_rub = usd_to_rub(amount)
-        cursor.execute("""
-            INSERT INTO withdraw_requests (user_id, amount_usd, amount_rub, status)
-            VALUES (?, ?, ?, 'pending')
-        """, (user_id, amount, amount_rub))
-        
-        # Списываем средства с баланса
-        cursor.execute("""
-            UPDATE users SET balance_usd = balance_usd - ? WHERE user_id = ?
-        """, (amount, user_id))
-        
-        conn.commit()
+    # Сумма заявки, списание и чек — ровно в центах
+    amount_cents = to_cents(amount)
+    amount = amount_cents / 100
+    if amount < 1.0:
+        await message.answer("❌ Минимальная сумма для вывода: 1.0$")
+        return
+    
+    async with db.transaction() as tx:
+        request_id = await create_withdraw_request(tx, user_id, amount)
+    
+    if request_id is None:
+        await message.answer("❌ Недостаточно средств на балансе.")
+        await state.clear()
+        return
     
     await message.answer(
         f"✅ Заявка на вывод {amount:.2f}$ создана!\n\n"
@@ -2046,7 +4504,7 @@ async def process_withdraw_request(message: Message, state: FSMContext):
     )
     
     # Уведомляем администраторов
-    await notify_admins(
+    notify_admins(
         f"💰 <b>Новая заявка на вывод</b>\n\n"
         f"Пользователь: @{message.from_user.username or 'без username'} (ID: {user_id})\n"
         f"Сумма: {amount:.2f}$\n\n"
@@ -2062,43 +4520,25 @@ async def process_withdraw_request(message: Message, state: FSMContext):
 async def show_profile(callback: CallbackQuery):
     user_id = callback.from_user.id
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT balance_usd, level, warnings, whatsapp_numbers, max_numbers, sms_messages, 
-                   total_earned_usd, created_at
-            FROM users WHERE user_id = ?
-        """, (user_id,))
-        result = cursor.fetchone()
-        
-        if not result:
-            await callback.answer("❌ Пользователь не найден")
-            return
-        
-        balance, level, warnings, whatsapp_count, max_count, sms_count, total_earned, reg_date = result
-        
-        # Получаем количество активных номеров
-        cursor.execute("""
-            SELECT COUNT(*) FROM whatsapp_numbers 
-            WHERE user_id = ? AND status IN ('hold_active', 'active')
-        """, (user_id,))
-        active_whatsapp = cursor.fetchone()[0]
-        
-        cursor.execute("""
-            SELECT COUNT(*) FROM max_numbers 
-            WHERE user_id = ? AND status = 'active'
-        """, (user_id,))
-        active_max = cursor.fetchone()[0]
-        
-        cursor.execute("""
-            SELECT COUNT(*) FROM sms_works 
-            WHERE user_id = ? AND status = 'active'
-        """, (user_id,))
-        active_sms = cursor.fetchone()[0]
-        
-        # Получаем реферальную статистику
-        cursor.execute("SELECT COUNT(*) FROM referrals WHERE referrer_id = ?", (user_id,))
-        referrals_count = cursor.fetchone()[0]
+    result = await db.fetchone("""
+        SELECT balance_usd, level, warnings, whatsapp_numbers, max_numbers, sms_messages, 
+               total_earned_usd, created_at,
+               (SELECT COUNT(*) FROM whatsapp_numbers 
+                WHERE user_id = u.user_id AND status IN ('hold_active', 'active')),
+               (SELECT COUNT(*) FROM max_numbers 
+                WHERE user_id = u.user_id AND status = 'active'),
+               (SELECT COUNT(*) FROM sms_works 
+                WHERE user_id = u.user_id AND status = 'active'),
+               (SELECT COUNT(*) FROM referrals WHERE referrer_id = u.user_id)
+        FROM users u WHERE user_id = ?
+    """, (user_id,))
+    
+    if not result:
+        await callback.answer("❌ Пользователь не найден")
+        return
+    
+    (balance, level, warnings, whatsapp_count, max_count, sms_count, total_earned, reg_date,
+     active_whatsapp, active_max, active_sms, referrals_count) = result
     
     profile_text = (
         f"👤 <b>Профиль</b>\n\n"
@@ -2142,27 +4582,241 @@ async def process_support_message(message: Message, state: FSMContext):
     support_text = message.text
     
     # Сохраняем обращение в базу
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO support_tickets (user_id, username, message, status)
-            VALUES (?, ?, ?, 'open')
-        """, (user_id, username, support_text))
-        conn.commit()
+    await db.insert("""
+        INSERT INTO support_tickets (user_id, username, message, status)
+        VALUES (?, ?, ?, 'open')
+    """, (user_id, username, support_text))
     
     # Уведомляем администраторов
-    await notify_admins(
+    notify_admins(
         f"🆘 <b>Новое обращение в поддержку</b>\n\n"
         f"Пользователь: @{username or 'без username'} (ID: {user_id})\n\n"
         f"Сообщение:\n{support_text}\n\n"
         f"Статус: открыто"
     )
     
-    await message.answer(
-        "✅ Ваше обращение отправлено в поддержку!\n\n"
-        "Мы ответим вам в ближайшее время."
+    await message.answer(
+        "✅ Ваше обращение отправлено в поддержку!\n\n"
+        "Мы ответим вам в ближайшее время."
+    )
+    await state.clear()
+
+# Длинные отчеты для админов.
+# Отчет собирается из частей, которые выдает асинхронный генератор поверх
+# курсора по (created_ts, id), и режется на сообщения только между частями.
+# Несколько сообщений показываются страницами с навигацией, совсем большой
+# отчет уходит текстовым файлом
+REPORT_CHUNK_LIMIT = 4000  # ограничение Telegram — 4096 символов
+REPORT_BATCH_SIZE = 200
+REPORT_MAX_PAGES = 10
+REPORT_CACHE_SIZE = 32
+# Курсор перед первой строкой: больше любого (created_ts, id)
+KEYSET_START = (2 ** 62, 0)
+
+report_pages = {}
+report_ids = itertools.count(1)
+
+async def iter_keyset(sql: str, params=(), batch_size: int = REPORT_BATCH_SIZE):
+    """Строки запроса пачками по batch_size, от новых к старым.
+
+    Запрос заканчивается на "(created_ts, id) < (?, ?) ORDER BY created_ts DESC,
+    id DESC LIMIT ?", последние два столбца выборки — created_ts и id (в строки
+    не попадают).
+    """
+    cursor = KEYSET_START
+    while True:
+        rows = await db.fetchall(sql, (*params, *cursor, batch_size))
+        for row in rows:
+            yield row[:-2]
+        if len(rows) < batch_size:
+            return
+        cursor = tuple(rows[-1][-2:])
+
+async def render_chunks(parts, limit: int = REPORT_CHUNK_LIMIT):
+    """Склеивает части отчета в сообщения не длиннее limit"""
+    chunk, size = [], 0
+    async for part in parts:
+        if chunk and size + len(part) > limit:
+            yield "".join(chunk)
+            chunk, size = [], 0
+        chunk.append(part)
+        size += len(part)
+    if chunk:
+        yield "".join(chunk)
+
+def report_keyboard(report_id: int, page: int, total: int):
+    builder = InlineKeyboardBuilder()
+    buttons = []
+    if page > 0:
+        buttons.append(types.InlineKeyboardButton(
+            text="⬅️ Пред.", callback_data=f"report:{report_id}:{page - 1}"
+        ))
+    buttons.append(types.InlineKeyboardButton(
+        text=f"{page + 1}/{total}", callback_data=f"report:{report_id}:{page}"
+    ))
+    if page < total - 1:
+        buttons.append(types.InlineKeyboardButton(
+            text="След. ➡️", callback_data=f"report:{report_id}:{page + 1}"
+        ))
+    builder.row(*buttons)
+    return builder.as_markup()
+
+async def send_report(message: Message, parts, filename: str):
+    """Отправляет отчет одним сообщением, страницами или файлом filename"""
+    pages = [chunk async for chunk in render_chunks(parts)]
+    
+    if len(pages) == 1:
+        await message.answer(pages[0], parse_mode=ParseMode.HTML)
+        return
+    
+    if len(pages) <= REPORT_MAX_PAGES:
+        report_id = next(report_ids)
+        report_pages[report_id] = pages
+        # Храним только последние отчеты; у старых навигация перестает работать
+        for stale in list(report_pages)[:-REPORT_CACHE_SIZE]:
+            del report_pages[stale]
+        await message.answer(
+            pages[0], parse_mode=ParseMode.HTML,
+            reply_markup=report_keyboard(report_id, 0, len(pages))
+        )
+        return
+    
+    text = html.unescape(re.sub(r"<[^>]+>", "", "".join(pages)))
+    await message.answer_document(
+        BufferedInputFile(text.encode("utf-8"), filename=filename),
+        caption=f"📄 Отчет слишком большой для сообщений ({len(pages)} стр.), отправлен файлом"
+    )
+
+async def active_hold_report():
+    now = int(time.time())
+    
+    # Холды, которые идут дольше положенного (диапазон по индексу времени начала)
+    whatsapp_expired = await db.fetchval("""
+        SELECT COUNT(*) FROM whatsapp_numbers
+        WHERE status = 'hold_active' AND hold_start_ts <= ?
+    """, (now - MAX_HOLD_DURATION,), default=0)
+    
+    max_expired = await db.fetchval("""
+        SELECT COUNT(*) FROM max_numbers
+        WHERE status = 'active' AND hold_start_ts <= ?
+    """, (now - MAX_HOLD_DURATION_MAX,), default=0)
+    
+    yield "📊 <b>Аккаунты на холде</b>\n\n"
+    
+    # WhatsApp аккаунты на холде
+    whatsapp_count = queue_counters.get("whatsapp", "hold_active", "active")
+    yield f"📱 <b>WhatsApp ({whatsapp_count}, холд истек: {whatsapp_expired})</b>:\n"
+    found = False
+    async for account in iter_keyset("""
+        SELECT wn.id, wn.phone, wn.hold_start_ts, wn.status,
+               u.user_id, u.username, wn.created_ts, wn.id
+        FROM whatsapp_numbers wn
+        LEFT JOIN users u ON wn.user_id = u.user_id
+        WHERE wn.status IN ('hold_active', 'active') AND (wn.created_ts, wn.id) < (?, ?)
+        ORDER BY wn.created_ts DESC, wn.id DESC LIMIT ?
+    """):
+        found = True
+        account_id, phone, hold_start_ts, status, user_id, username = account
+        hold_time = f"{(now - hold_start_ts) / 3600:.1f} ч." if hold_start_ts else "не начат"
+        yield (
+            f"• {phone} (ID: {account_id})\n"
+            f"  👤 @{username or 'нет'} (ID: {user_id})\n"
+            f"  ⏰ {format_ts(hold_start_ts)} ({hold_time})\n"
+            f"  📊 {status}\n\n"
+        )
+    if not found:
+        yield "   Нет аккаунтов на холде\n\n"
+    
+    # MAX аккаунты на холде
+    max_count = queue_counters.get("max", "active")
+    yield f"🤖 <b>MAX ({max_count}, холд истек: {max_expired})</b>:\n"
+    found = False
+    async for account in iter_keyset("""
+        SELECT mn.id, mn.phone, mn.hold_start_ts, mn.status,
+               u.user_id, u.username, mn.created_ts, mn.id
+        FROM max_numbers mn
+        LEFT JOIN users u ON mn.user_id = u.user_id
+        WHERE mn.status = 'active' AND (mn.created_ts, mn.id) < (?, ?)
+        ORDER BY mn.created_ts DESC, mn.id DESC LIMIT ?
+    """):
+        found = True
+        account_id, phone, hold_start_ts, status, user_id, username = account
+        hold_time = f"{(now - hold_start_ts) / 60:.1f} мин." if hold_start_ts else "не начат"
+        yield (
+            f"• {phone} (ID: {account_id})\n"
+            f"  👤 @{username or 'нет'} (ID: {user_id})\n"
+            f"  ⏰ {format_ts(hold_start_ts)} ({hold_time})\n\n"
+        )
+    if not found:
+        yield "   Нет аккаунтов на холде\n"
+
+async def user_hold_report(user_id: int, username, balance, level):
+    now = int(time.time())
+    
+    whatsapp_count = await db.fetchval("""
+        SELECT COUNT(*) FROM whatsapp_numbers
+        WHERE user_id = ? AND status IN ('hold_active', 'active')
+    """, (user_id,), default=0)
+    max_count = await db.fetchval("""
+        SELECT COUNT(*) FROM max_numbers
+        WHERE user_id = ? AND status = 'active'
+    """, (user_id,), default=0)
+    
+    # История завершенных холдов, включая перенесенные в архив
+    whatsapp_completed = await count_with_archive(
+        "whatsapp_numbers", "user_id = ? AND status = 'completed'", (user_id,)
+    )
+    max_completed = await count_with_archive(
+        "max_numbers", "user_id = ? AND status = 'completed'", (user_id,)
+    )
+    
+    yield (
+        f"👤 <b>Информация о холдах пользователя</b>\n\n"
+        f"Пользователь: @{username or 'нет'} (ID: {user_id})\n"
+        f"Баланс: {balance:.2f}$ | Уровень: {level}\n\n"
+    )
+    
+    # Активные холды WhatsApp
+    yield f"📱 <b>WhatsApp активные ({whatsapp_count})</b>:\n"
+    if not whatsapp_count:
+        yield "   Нет активных холдов\n"
+    # plan-ok: холды одного пользователя, сортируется несколько строк
+    async for account in iter_keyset("""
+        SELECT id, phone, hold_start_ts, status, created_ts, id
+        FROM whatsapp_numbers
+        WHERE user_id = ? AND status IN ('hold_active', 'active') AND (created_ts, id) < (?, ?)
+        ORDER BY created_ts DESC, id DESC LIMIT ?
+    """, (user_id,)):
+        account_id, phone, hold_start_ts, status = account
+        if hold_start_ts:
+            yield f"• {phone} ({(now - hold_start_ts) / 3600:.1f} ч., с {format_ts(hold_start_ts)}) - {status}\n"
+        else:
+            yield f"• {phone} (холд не начат) - {status}\n"
+    
+    # Активные холды MAX
+    yield f"\n🤖 <b>MAX активные ({max_count})</b>:\n"
+    if not max_count:
+        yield "   Нет активных холдов\n"
+    # plan-ok: холды одного пользователя, сортируется несколько строк
+    async for account in iter_keyset("""
+        SELECT id, phone, hold_start_ts, status, created_ts, id
+        FROM max_numbers
+        WHERE user_id = ? AND status = 'active' AND (created_ts, id) < (?, ?)
+        ORDER BY created_ts DESC, id DESC LIMIT ?
+    """, (user_id,)):
+        account_id, phone, hold_start_ts, status = account
+        if hold_start_ts:
+            yield f"• {phone} ({(now - hold_start_ts) / 60:.1f} мин., с {format_ts(hold_start_ts)})\n"
+        else:
+            yield f"• {phone} (холд не начат)\n"
+    
+    # Статистика
+    yield (
+        f"\n📊 <b>Статистика:</b>\n"
+        f"   • WhatsApp завершено: {whatsapp_completed}\n"
+        f"   • MAX завершено: {max_completed}\n"
+        f"   • Всего: {whatsapp_completed + max_completed}"
     )
-    await state.clear()
 
 @dp.message(Command("active_hold"))
 async def show_active_hold(message: Message):
@@ -2170,76 +4824,7 @@ async def show_active_hold(message: Message):
         await message.answer("❌ У вас нет прав администратора")
         return
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        
-        # WhatsApp аккаунты на холде
-        cursor.execute("""
-            SELECT wn.id, wn.phone, wn.hold_start, wn.status, 
-                   u.user_id, u.username,
-                   CASE 
-                       WHEN wn.hold_start IS NOT NULL THEN 
-                           (julianday('now') - julianday(wn.hold_start)) * 24 
-                       ELSE 0 
-                   END as hours_held
-            FROM whatsapp_numbers wn
-            LEFT JOIN users u ON wn.user_id = u.user_id
-            WHERE wn.status IN ('hold_active', 'active')
-            ORDER BY wn.hold_start DESC
-        """)
-        
-        whatsapp_accounts = cursor.fetchall()
-        
-        # MAX аккаунты на холде
-        cursor.execute("""
-            SELECT mn.id, mn.phone, mn.hold_start, mn.status,
-                   u.user_id, u.username,
-                   CASE 
-                       WHEN mn.hold_start IS NOT NULL THEN 
-                           (julianday('now') - julianday(mn.hold_start)) * 24 * 60 
-                       ELSE 0 
-                   END as minutes_held
-            FROM max_numbers mn
-            LEFT JOIN users u ON mn.user_id = u.user_id
-            WHERE mn.status = 'active'
-            ORDER BY mn.hold_start DESC
-        """)
-        
-        max_accounts = cursor.fetchall()
-    
-    # Формируем ответ
-    response = "📊 <b>Аккаунты на холде</b>\n\n"
-    
-    # WhatsApp аккаунты
-    response += f"📱 <b>WhatsApp ({len(whatsapp_accounts)})</b>:\n"
-    if whatsapp_accounts:
-        for account in whatsapp_accounts:
-            account_id, phone, hold_start, status, user_id, username, hours_held = account
-            hold_time = f"{hours_held:.1f} ч." if hold_start else "не начат"
-            response += (
-                f"• {phone} (ID: {account_id})\n"
-                f"  👤 @{username or 'нет'} (ID: {user_id})\n"
-                f"  ⏰ {hold_start or 'нет'} ({hold_time})\n"
-                f"  📊 {status}\n\n"
-            )
-    else:
-        response += "   Нет аккаунтов на холде\n\n"
-    
-    # MAX аккаунты
-    response += f"🤖 <b>MAX ({len(max_accounts)})</b>:\n"
-    if max_accounts:
-        for account in max_accounts:
-            account_id, phone, hold_start, status, user_id, username, minutes_held = account
-            hold_time = f"{minutes_held:.1f} мин." if hold_start else "не начат"
-            response += (
-                f"• {phone} (ID: {account_id})\n"
-                f"  👤 @{username or 'нет'} (ID: {user_id})\n"
-                f"  ⏰ {hold_start or 'нет'} ({hold_time})\n\n"
-            )
-    else:
-        response += "   Нет аккаунтов на холде\n"
-    
-    await message.answer(response, parse_mode=ParseMode.HTML)
+    await send_report(message, active_hold_report(), "active_hold.txt")
 
 @dp.message(Command("user_hold"))
 async def user_hold_info(message: Message, command: CommandObject):
@@ -2248,95 +4833,241 @@ async def user_hold_info(message: Message, command: CommandObject):
         return
     
     if not command.args:
-        await message.answer("❌ Укажите ID пользователя: /user_hold <user_id>")
+        await message.answer("❌ Укажите ID пользователя или запрос для поиска: /user_hold <user_id>",
+                             parse_mode=None)
         return
     
     try:
         user_id = int(command.args)
     except ValueError:
-        await message.answer("❌ Неверный формат ID пользователя")
+        # Не ID — ищем пользователя по имени или номеру
+        await send_search_results(message, command.args)
         return
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        
-        # Информация о пользователе
-        cursor.execute("""
-            SELECT username, balance_usd, level 
-            FROM users WHERE user_id = ?
-        """, (user_id,))
-        user_info = cursor.fetchone()
-        
-        if not user_info:
-            await message.answer("❌ Пользователь не найден")
-            return
-        
-        username, balance, level = user_info
-        
-        # Активные холды WhatsApp
-        cursor.execute("""
-            SELECT id, phone, hold_start, status,
-                   (julianday('now') - julianday(hold_start)) * 24 as hours_held
-            FROM whatsapp_numbers 
-            WHERE user_id = ? AND status IN ('hold_active', 'active')
-        """, (user_id,))
-        whatsapp_holds = cursor.fetchall()
-        
-        # Активные холды MAX
-        cursor.execute("""
-            SELECT id, phone, hold_start, status,
-                   (julianday('now') - julianday(hold_start)) * 24 * 60 as minutes_held
-            FROM max_numbers 
-            WHERE user_id = ? AND status = 'active'
-        """, (user_id,))
-        max_holds = cursor.fetchall()
-        
-        # История завершенных холдов
-        cursor.execute("""
-            SELECT COUNT(*) FROM whatsapp_numbers 
-            WHERE user_id = ? AND status = 'completed'
-        """, (user_id,))
-        whatsapp_completed = cursor.fetchone()[0]
-        
-        cursor.execute("""
-            SELECT COUNT(*) FROM max_numbers 
-            WHERE user_id = ? AND status = 'completed'
-        """, (user_id,))
-        max_completed = cursor.fetchone()[0]
+    await send_user_hold(message, user_id)
+
+async def send_user_hold(message: Message, user_id: int):
+    # Информация о пользователе
+    user_info = await db.fetchone("""
+        SELECT username, balance_usd, level 
+        FROM users WHERE user_id = ?
+    """, (user_id,))
+    
+    if not user_info:
+        await message.answer("❌ Пользователь не найден")
+        return
+    
+    username, balance, level = user_info
+    await send_report(message, user_hold_report(user_id, username, balance, level),
+                      f"user_hold_{user_id}.txt")
+
+@dp.message(Command("slow_queries"))
+async def show_slow_queries(message: Message, command: CommandObject):
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ У вас нет прав администратора")
+        return
+    
+    try:
+        limit = min(max(int(command.args or 10), 1), 50)
+    except ValueError:
+        await message.answer("❌ Использование: /slow_queries [N]")
+        return
+    
+    top = query_stats.top(limit)
+    if not top:
+        await message.answer("📊 Запросов еще не было")
+        return
     
     response = (
-        f"👤 <b>Информация о холдах пользователя</b>\n\n"
-        f"Пользователь: @{username or 'нет'} (ID: {user_id})\n"
-        f"Баланс: {balance:.2f}$ | Уровень: {level}\n\n"
+        f"🐢 <b>Самые медленные запросы</b>\n"
+        f"Порог лога: {SLOW_QUERY_MS} мс, медленных в журнале: {len(query_stats.slow)}\n\n"
     )
+    for position, (name, timing) in enumerate(top, 1):
+        callers = ", ".join(sorted(timing.callers, key=timing.callers.get, reverse=True)[:3])
+        entry = (
+            f"{position}. среднее {timing.total_ms / timing.count:.1f} мс, "
+            f"p95 ≤ {timing.percentile(0.95):.0f} мс, макс. {timing.max_ms:.0f} мс, "
+            f"{timing.count} раз, ~{timing.rows / timing.count:.1f} стр.\n"
+            f"<code>{html.escape(name[:200], quote=False)}</code>\n"
+            f"Обработчики: {html.escape(callers, quote=False)}\n\n"
+        )
+        # Ограничение Telegram на длину сообщения
+        if len(response) + len(entry) > 4000:
+            break
+        response += entry
     
-    # Активные холды WhatsApp
-    response += f"📱 <b>WhatsApp активные ({len(whatsapp_holds)})</b>:\n"
-    if whatsapp_holds:
-        for account in whatsapp_holds:
-            account_id, phone, hold_start, status, hours_held = account
-            response += f"• {phone} ({hours_held:.1f} ч.) - {status}\n"
-    else:
-        response += "   Нет активных холдов\n"
+    await message.answer(response, parse_mode=ParseMode.HTML)
+
+@dp.message(Command("telegram_stats"))
+async def show_telegram_stats(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ У вас нет прав администратора")
+        return
     
-    # Активные холды MAX
-    response += f"\n🤖 <b>MAX активные ({len(max_holds)})</b>:\n"
-    if max_holds:
-        for account in max_holds:
-            account_id, phone, hold_start, status, minutes_held = account
-            response += f"• {phone} ({minutes_held:.1f} мин.)\n"
-    else:
-        response += "   Нет активных холдов\n"
+    stats = telegram_stats
+    retries = stats.retries
+    waiting = {}
+    for queue in outbox.pending.values():
+        for priority, _, _ in queue:
+            waiting[priority] = waiting.get(priority, 0) + 1
+    methods = ", ".join(
+        f"{name}: {count}" for name, count in
+        sorted(stats.methods.items(), key=lambda item: item[1], reverse=True)[:5]
+    ) or "нет"
     
-    # Статистика
-    response += (
-        f"\n📊 <b>Статистика:</b>\n"
-        f"   • WhatsApp завершено: {whatsapp_completed}\n"
-        f"   • MAX завершено: {max_completed}\n"
-        f"   • Всего: {whatsapp_completed + max_completed}"
+    await message.answer(
+        f"📡 <b>Запросы к Telegram</b>\n\n"
+        f"Скорость: {telegram_limiter.rate:.1f} из {telegram_limiter.max_rate:.0f} в сек.\n"
+        f"Запросов: {stats.requests}\n"
+        f"RetryAfter: {stats.throttled} (пауз на {stats.throttled_seconds:.0f} с)\n"
+        f"Методы с RetryAfter: {methods}\n"
+        f"Повторов: флуд {retries['flood']}, сеть {retries['network']}, 5xx {retries['server']}\n"
+        f"Не отправлено после повторов: {stats.failed}\n\n"
+        f"В очереди: срочных {waiting.get(PRIORITY_URGENT, 0)}, "
+        f"пользователям {waiting.get(PRIORITY_USER, 0)}, "
+        f"админам {waiting.get(PRIORITY_ADMIN, 0)}, "
+        f"рассылки {waiting.get(PRIORITY_BROADCAST, 0)}",
+        parse_mode=ParseMode.HTML
     )
+
+# Выгрузка данных для админов.
+# /export <таблица> [csv|jsonl] [status=<статус>] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД]
+# читает таблицу вместе с ее архивом пачками по первичному ключу, пишет строки
+# в gzip-файл во временном каталоге из пула потоков и отправляет файл с диска,
+# поэтому расход памяти не зависит от размера таблицы. Даты — UTC, to включительно
+EXPORT_BATCH_SIZE = 1000
+EXPORT_MAX_BYTES = 50 * 1024 * 1024  # Ограничение Telegram на файлы от ботов
+EXPORT_FORMATS = ("csv", "jsonl")
+# Таблица -> (первичный ключ, столбец даты, дата в секундах эпохи, столбцы).
+# Первым столбцом идет первичный ключ: по нему читаются пачки
+EXPORT_TABLES = {
+    "users": ("user_id", "created_at", False,
+              "user_id, username, first_name, last_name, referral_source, referrer_id, "
+              "balance_usd, balance_rub, total_earned_usd, level, warnings, created_at"),
+    "whatsapp_numbers": ("id", "created_ts", True,
+                         "id, user_id, phone, status, admin_id, created_at, hold_start, failed_at"),
+    "max_numbers": ("id", "created_ts", True,
+                    "id, user_id, phone, status, admin_id, created_at, hold_start"),
+    "sms_works": ("id", "created_ts", True,
+                  "id, user_id, admin_id, text, status, amount, created_at, processed_at, completed_at"),
+    "withdraw_requests": ("id", "created_ts", True,
+                          "id, user_id, amount_usd, amount_rub, status, invoice_id, created_at, paid_at"),
+}
+
+def parse_export_args(args) -> tuple:
+    """(таблица, формат, условие, параметры) из аргументов /export.
+
+    При ошибке бросает ValueError с текстом для админа.
+    """
+    tokens = (args or "").split()
+    if not tokens or tokens[0] not in EXPORT_TABLES:
+        raise ValueError(f"Укажите таблицу: {', '.join(EXPORT_TABLES)}")
+    
+    table, export_format, filters = tokens[0], "csv", {}
+    for token in tokens[1:]:
+        name, _, value = token.partition("=")
+        if token in EXPORT_FORMATS:
+            export_format = token
+        elif name in ("status", "from", "to") and value:
+            filters[name] = value
+        else:
+            raise ValueError(f"Непонятный аргумент: {token}")
+    
+    _, date_column, epoch, _ = EXPORT_TABLES[table]
+    conditions, params = [], []
+    if "status" in filters:
+        if table == "users":
+            raise ValueError("У пользователей нет статуса")
+        conditions.append("status = ?")
+        params.append(filters["status"])
+    for name, operator, shift in (("from", ">=", 0), ("to", "<", 1)):
+        if name not in filters:
+            continue
+        try:
+            day = datetime.strptime(filters[name], "%Y-%m-%d").replace(tzinfo=timezone.utc)
+        except ValueError:
+            raise ValueError(f"Неверная дата {name}={filters[name]}, нужен формат ГГГГ-ММ-ДД")
+        day += timedelta(days=shift)
+        conditions.append(f"{date_column} {operator} ?")
+        params.append(int(day.timestamp()) if epoch else day.strftime("%Y-%m-%d %H:%M:%S"))
+    return table, export_format, " AND ".join(conditions), params
+
+def write_export_rows(out, export_format: str, columns: list, rows):
+    if export_format == "csv":
+        csv.writer(out).writerows(rows)
+        return
+    for row in rows:
+        out.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str) + "\n")
+
+async def export_table(path: str, table: str, export_format: str, where: str, params) -> int:
+    """Пишет строки table и ее архива в gzip-файл path, возвращает их число"""
+    key, _, _, columns = EXPORT_TABLES[table]
+    names = [column.strip() for column in columns.split(",")]
+    sources = [table] + ([f"{table}_archive"] if table in ARCHIVE_TABLES else [])
+    condition = f"AND {where}" if where else ""
+    loop = asyncio.get_running_loop()
+    exported = 0
+    
+    with gzip.open(path, "wt", encoding="utf-8", newline="") as out:
+        if export_format == "csv":
+            csv.writer(out).writerow(names)
+        for source in sources:
+            last_key = -1
+            while True:
+                rows = await db.fetchall(
+                    f"SELECT {columns} FROM {source} WHERE {key} > ? {condition} "
+                    f"ORDER BY {key} LIMIT ?",
+                    (last_key, *params, EXPORT_BATCH_SIZE)
+                )
+                if rows:
+                    # Форматирование и сжатие — в пуле потоков, не в цикле событий
+                    await loop.run_in_executor(None, write_export_rows, out, export_format, names, rows)
+                    exported += len(rows)
+                if len(rows) < EXPORT_BATCH_SIZE:
+                    break
+                last_key = rows[-1][0]
+    return exported
+
+@dp.message(Command("export"))
+async def export_data(message: Message, command: CommandObject):
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ У вас нет прав администратора")
+        return
     
-    await message.answer(response, parse_mode=ParseMode.HTML)
+    try:
+        table, export_format, where, params = parse_export_args(command.args)
+    except ValueError as e:
+        await message.answer(
+            f"❌ {e}\n\nИспользование: /export <таблица> [csv|jsonl] "
+            f"[status=<статус>] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД]",
+            parse_mode=None
+        )
+        return
+    
+    await message.answer("⏳ Готовлю выгрузку...")
+    
+    fd, path = tempfile.mkstemp(suffix=f".{export_format}.gz")
+    os.close(fd)
+    try:
+        exported = await export_table(path, table, export_format, where, params)
+        size = os.path.getsize(path)
+        if size > EXPORT_MAX_BYTES:
+            await message.answer(
+                f"❌ Файл слишком большой ({size / 1024 / 1024:.1f} МБ). "
+                f"Сузьте выборку фильтрами status, from и to"
+            )
+            return
+        
+        filename = f"{table}-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}.{export_format}.gz"
+        await message.answer_document(
+            FSInputFile(path, filename=filename),
+            caption=f"📦 {table}: {exported} строк"
+        )
+    except Exception as e:
+        logger.error(f"Ошибка выгрузки {table}: {e}")
+        await message.answer("❌ Ошибка при выгрузке данных")
+    finally:
+        os.remove(path)
 
 @dp.callback_query(lambda c: c.data == "admin_panel")
 async def admin_panel(callback: CallbackQuery):
@@ -2357,34 +5088,31 @@ async def admin_panel(callback: CallbackQuery):
 async def whatsapp_account_detail(callback: CallbackQuery):
     account_id = int(callback.data.split(":")[1])
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT wn.phone, wn.status, u.user_id, u.username
-            FROM whatsapp_numbers wn
-            LEFT JOIN users u ON wn.user_id = u.user_id
-            WHERE wn.id = ?
-        """, (account_id,))
+    result = await db.fetchone("""
+        SELECT wn.phone, wn.status, u.user_id, u.username
+        FROM whatsapp_numbers wn
+        LEFT JOIN users u ON wn.user_id = u.user_id
+        WHERE wn.id = ?
+    """, (account_id,))
+    
+    if result:
+        phone, status, user_id, username = result
+        
+        text = (
+            f"📱 <b>WhatsApp аккаунт #{account_id}</b>\n\n"
+            f"Номер: {phone}\n"
+            f"Статус: {status}\n"
+            f"Пользователь: @{username or 'без username'} (ID: {user_id})\n\n"
+            f"Выберите действие:"
+        )
         
-        result = cursor.fetchone()
-        if result:
-            phone, status, user_id, username = result
-            
-            text = (
-                f"📱 <b>WhatsApp аккаунт #{account_id}</b>\n\n"
-                f"Номер: {phone}\n"
-                f"Статус: {status}\n"
-                f"Пользователь: @{username or 'без username'} (ID: {user_id})\n\n"
-                f"Выберите действие:"
-            )
-            
-            await callback.message.edit_text(
-                text,
-                parse_mode=ParseMode.HTML,
-                reply_markup=await whatsapp_admin_keyboard(account_id)
-            )
-        else:
-            await callback.answer("❌ Аккаунт не найден")
+        await callback.message.edit_text(
+            text,
+            parse_mode=ParseMode.HTML,
+            reply_markup=await whatsapp_admin_keyboard(account_id)
+        )
+    else:
+        await callback.answer("❌ Аккаунт не найден")
 
 @dp.callback_query(lambda c: c.data.startswith("send_whatsapp_code:"))
 async def send_whatsapp_code(callback: CallbackQuery, state: FSMContext):
@@ -2417,38 +5145,34 @@ async def process_whatsapp_code(message: Message, state: FSMContext):
     # Сохраняем фото
     photo_id = message.photo[-1].file_id
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE whatsapp_numbers 
-            SET code_sent = 1
-            WHERE id = ?
-        """, (account_id,))
-        
-        cursor.execute("""
-            SELECT user_id, phone FROM whatsapp_numbers WHERE id = ?
-        """, (account_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            user_id, phone = result
-            conn.commit()
-            
-            # Отправляем фото пользователю
-            try:
-                await bot.send_photo(
-                    user_id,
-                    photo=photo_id,
-                    caption=f"📨 <b>Код для WhatsApp аккаунта</b>\n\n"
-                           f"Номер: {phone}\n\n"
-                           f"Введите этот код в приложении WhatsApp и подтвердите вход:",
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=await whatsapp_code_keyboard(account_id)
-                )
-            except Exception as e:
-                logger.error(f"Ошибка отправки кода пользователю: {e}")
-                await message.answer("❌ Не удалось отправить код пользователю.")
-                return
+    # Код можно отправить только пока номер ждет входа
+    result = await db.transition(
+        "whatsapp_numbers", account_id, ("pending",), fields={"code_sent": 1}
+    )
+    
+    if not result:
+        await message.answer("⚠️ Аккаунт уже обработан или удален.")
+        await state.clear()
+        return
+    
+    user_id, phone = result
+    
+    # Отправляем фото пользователю
+    try:
+        await outbox.send(
+            PRIORITY_URGENT, bot.send_photo,
+            user_id,
+            photo=photo_id,
+            caption=f"📨 <b>Код для WhatsApp аккаунта</b>\n\n"
+                   f"Номер: {phone}\n\n"
+                   f"Введите этот код в приложении WhatsApp и подтвердите вход:",
+            parse_mode=ParseMode.HTML,
+            reply_markup=await whatsapp_code_keyboard(account_id)
+        )
+    except Exception as e:
+        logger.error(f"Ошибка отправки кода пользователю: {e}")
+        await message.answer("❌ Не удалось отправить код пользователю.")
+        return
     
     await message.answer("✅ Код отправлен пользователю!")
     await state.clear()
@@ -2458,38 +5182,32 @@ async def whatsapp_entered(callback: CallbackQuery):
     account_id = int(callback.data.split(":")[1])
     user_id = callback.from_user.id
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE whatsapp_numbers 
-            SET code_entered = 1, status = 'active'
-            WHERE id = ? AND user_id = ?
-        """, (account_id, user_id))
-        
-        # Получаем информацию об аккаунте
-        cursor.execute("""
-            SELECT phone FROM whatsapp_numbers WHERE id = ?
-        """, (account_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            phone = result[0]
-            conn.commit()
-            
-            # Уведомляем ВСЕХ администраторов
-            admin_message = (
-                f"✅ <b>Пользователь вошел в WhatsApp</b>\n\n"
-                f"Аккаунт ID: {account_id}\n"
-                f"Номер: {phone}\n"
-                f"Пользователь: @{callback.from_user.username or 'без username'} (ID: {user_id})\n\n"
-                f"Подтвердите активацию холда:"
-            )
-            
-            # Создаем клавиатуру для подтверждения
-            keyboard = await whatsapp_admin_confirm_keyboard(account_id)
-            
-            # Отправляем всем администраторам
-            await notify_admins(admin_message, reply_markup=keyboard)
+    result = await db.transition(
+        "whatsapp_numbers", account_id, ("pending",), "active",
+        fields={"code_entered": 1}, match={"user_id": user_id},
+        returning=("phone",)
+    )
+    
+    if not result:
+        await callback.answer("⚠️ Вход уже подтвержден")
+        return
+    
+    phone = result[0]
+    
+    # Уведомляем ВСЕХ администраторов
+    admin_message = (
+        f"✅ <b>Пользователь вошел в WhatsApp</b>\n\n"
+        f"Аккаунт ID: {account_id}\n"
+        f"Номер: {phone}\n"
+        f"Пользователь: @{callback.from_user.username or 'без username'} (ID: {user_id})\n\n"
+        f"Подтвердите активацию холда:"
+    )
+    
+    # Создаем клавиатуру для подтверждения
+    keyboard = await whatsapp_admin_confirm_keyboard(account_id)
+    
+    # Отправляем всем администраторам
+    notify_admins(admin_message, reply_markup=keyboard)
     
     await callback.answer("✅ Вход подтвержден")
     
@@ -2507,29 +5225,28 @@ async def whatsapp_failed(callback: CallbackQuery):
     account_id = int(callback.data.split(":")[1])
     user_id = callback.from_user.id
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT phone FROM whatsapp_numbers WHERE id = ?
-        """, (account_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            phone = result[0]
-            
-            cursor.execute("DELETE FROM whatsapp_numbers WHERE id = ?", (account_id,))
-            conn.commit()
-            
-            # Уведомляем всех администраторов
-            admin_message = (
-                f"❌ <b>Пользователь не смог войти в WhatsApp</b>\n\n"
-                f"Аккаунт ID: {account_id}\n"
-                f"Номер: {phone}\n"
-                f"Пользователь: @{callback.from_user.username or 'без username'} (ID: {user_id})\n\n"
-                f"Аккаунт удален из системы."
-            )
-            
-            await notify_admins(admin_message)
+    # Сообщить об ошибке можно только до подтверждения входа
+    result = await db.delete_in_states(
+        "whatsapp_numbers", account_id, ("pending",),
+        match={"user_id": user_id}, returning=("phone",)
+    )
+    
+    if not result:
+        await callback.answer("⚠️ Аккаунт уже обработан")
+        return
+    
+    phone = result[0]
+    
+    # Уведомляем всех администраторов
+    admin_message = (
+        f"❌ <b>Пользователь не смог войти в WhatsApp</b>\n\n"
+        f"Аккаунт ID: {account_id}\n"
+        f"Номер: {phone}\n"
+        f"Пользователь: @{callback.from_user.username or 'без username'} (ID: {user_id})\n\n"
+        f"Аккаунт удален из системы."
+    )
+    
+    notify_admins(admin_message)
     
     await callback.answer("❌ Ошибка входа")
     
@@ -2551,43 +5268,38 @@ async def confirm_whatsapp_hold(callback: CallbackQuery):
         await callback.answer("❌ У вас нет прав администратора")
         return
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE whatsapp_numbers 
-            SET hold_start = datetime('now'), status = 'hold_active'
-            WHERE id = ?
-        """, (account_id,))
-        
-        cursor.execute("""
-            SELECT user_id, phone FROM whatsapp_numbers WHERE id = ?
-        """, (account_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            user_id, phone = result
-            conn.commit()
-            
-            # Уведомляем пользователя
-            try:
-                await bot.send_message(
-                    user_id,
-                    f"✅ Холд для WhatsApp аккаунта {phone} активирован!\n\n"
-                    f"Начисление произойдет после завершения холда."
-                )
-            except Exception as e:
-                logger.error(f"Ошибка уведомления пользователя: {e}")
-            
-            # Уведомляем всех администраторов об успешном подтверждении
-            admin_message = (
-                f"✅ <b>Холд WhatsApp активирован</b>\n\n"
-                f"Аккаунт ID: {account_id}\n"
-                f"Номер: {phone}\n"
-                f"Пользователь: ID {user_id}\n"
-                f"Администратор: @{callback.from_user.username or 'без username'}"
-            )
-            
-            await notify_admins(admin_message)
+    result = await db.transition(
+        "whatsapp_numbers", account_id, ("active",), "hold_active",
+        fields={"hold_start": SQL_NOW}
+    )
+    
+    if not result:
+        await callback.answer("⚠️ Холд уже активирован другим администратором")
+        return
+    
+    user_id, phone = result
+    
+    # Уведомляем пользователя
+    try:
+        await outbox.send(
+            PRIORITY_USER, bot.send_message,
+            user_id,
+            f"✅ Холд для WhatsApp аккаунта {phone} активирован!\n\n"
+            f"Начисление произойдет после завершения холда."
+        )
+    except Exception as e:
+        logger.error(f"Ошибка уведомления пользователя: {e}")
+    
+    # Уведомляем всех администраторов об успешном подтверждении
+    admin_message = (
+        f"✅ <b>Холд WhatsApp активирован</b>\n\n"
+        f"Аккаунт ID: {account_id}\n"
+        f"Номер: {phone}\n"
+        f"Пользователь: ID {user_id}\n"
+        f"Администратор: @{callback.from_user.username or 'без username'}"
+    )
+    
+    notify_admins(admin_message)
     
     await callback.answer("✅ Холд активирован")
     
@@ -2609,38 +5321,35 @@ async def reject_whatsapp(callback: CallbackQuery):
         await callback.answer("❌ У вас нет прав администратора")
         return
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT user_id, phone FROM whatsapp_numbers WHERE id = ?
-        """, (account_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            user_id, phone = result
-            
-            cursor.execute("DELETE FROM whatsapp_numbers WHERE id = ?", (account_id,))
-            conn.commit()
-            
-            # Уведомляем пользователя
-            try:
-                await bot.send_message(
-                    user_id,
-                    f"❌ Ваш WhatsApp аккаунт {phone} был отклонен администратором."
-                )
-            except Exception as e:
-                logger.error(f"Ошибка уведомления пользователя: {e}")
-            
-            # Уведомляем всех администраторов об отклонении
-            admin_message = (
-                f"❌ <b>WhatsApp аккаунт отклонен</b>\n\n"
-                f"Аккаунт ID: {account_id}\n"
-                f"Номер: {phone}\n"
-                f"Пользователь: ID {user_id}\n"
-                f"Администратор: @{callback.from_user.username or 'без username'}"
-            )
-            
-            await notify_admins(admin_message)
+    # Отклонить можно только аккаунт до активации холда
+    result = await db.delete_in_states("whatsapp_numbers", account_id, ("pending", "active"))
+    
+    if not result:
+        await callback.answer("⚠️ Аккаунт уже обработан")
+        return
+    
+    user_id, phone = result
+    
+    # Уведомляем пользователя
+    try:
+        await outbox.send(
+            PRIORITY_USER, bot.send_message,
+            user_id,
+            f"❌ Ваш WhatsApp аккаунт {phone} был отклонен администратором."
+        )
+    except Exception as e:
+        logger.error(f"Ошибка уведомления пользователя: {e}")
+    
+    # Уведомляем всех администраторов об отклонении
+    admin_message = (
+        f"❌ <b>WhatsApp аккаунт отклонен</b>\n\n"
+        f"Аккаунт ID: {account_id}\n"
+        f"Номер: {phone}\n"
+        f"Пользователь: ID {user_id}\n"
+        f"Администратор: @{callback.from_user.username or 'без username'}"
+    )
+    
+    notify_admins(admin_message)
     
     await callback.answer("❌ Аккаунт отклонен")
     
@@ -2685,7 +5394,8 @@ async def process_add_admin(message: Message, state: FSMContext):
     
     # Уведомляем нового администратора
     try:
-        await bot.send_message(
+        await outbox.send(
+            PRIORITY_USER, bot.send_message,
             new_admin_id,
             "🎉 Вас назначили администратором бота!\n\n"
             "Теперь у вас есть доступ к админ-панели."
@@ -2804,6 +5514,187 @@ async def set_service_status(callback: CallbackQuery):
     
     await callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode=ParseMode.HTML)
 
+# Рассылка.
+# Рассылка идет фоновой задачей, ее состояние хранится в таблице broadcasts.
+# Получатели читаются пачками по user_id, пачка ставится в очередь исходящих
+# сообщений с низшим приоритетом, поэтому рассылка занимает свободную часть
+# лимита Telegram и не задерживает выплаты и уведомления. После каждой пачки
+# счетчики и последний user_id записываются в БД, и после перезапуска рассылка
+# продолжается с него. Пачка, прерванная посередине, отправляется заново, так
+# что часть ее получателей может получить сообщение дважды.
+# С одной базой могут работать несколько процессов бота, поэтому рассылку ведет
+# только процесс, захвативший ее в БД (owner, lease_until). Захват продлевается
+# после каждой пачки; рассылку, чей владелец не продлил захват, подхватывает
+# другой процесс. Остановка тоже хранится в БД (статус stopping), поэтому кнопка
+# работает в любом процессе
+BROADCAST_BATCH_SIZE = 100
+BROADCAST_PROGRESS_INTERVAL = 5  # Секунд между обновлениями прогресса
+BROADCAST_LEASE = 120  # Секунд захвата рассылки, отсчитываются от последней пачки
+BROADCAST_OWNER = f"{os.getpid()}-{secrets.token_hex(4)}"  # Этот процесс бота
+
+# id рассылки -> задача этого процесса, которая ее отправляет
+broadcast_tasks = {}
+
+async def deliver_broadcast(chat_id: int, text: str) -> bool:
+    """Отправляет сообщение рассылки, возвращает True при успехе"""
+    try:
+        await outbox.send(PRIORITY_BROADCAST, bot.send_message, chat_id, text,
+                          parse_mode=ParseMode.HTML)
+        return True
+    except exceptions.TelegramAPIError:
+        # Бот заблокирован, чат удален, повторы после ошибок сети исчерпаны
+        return False
+
+def broadcast_keyboard(broadcast_id: int):
+    builder = InlineKeyboardBuilder()
+    builder.row(types.InlineKeyboardButton(
+        text="⏹ Остановить", callback_data=f"broadcast_stop:{broadcast_id}"
+    ))
+    return builder.as_markup()
+
+async def show_broadcast_progress(broadcast_id: int, admin_id: int, message_id: int,
+                                  status: str, total: int, sent: int, failed: int):
+    status_text = {
+        "running": "⏳ идет",
+        "done": "✅ завершена",
+        "cancelled": "⏹ остановлена",
+    }[status]
+    text = (
+        f"📢 <b>Рассылка #{broadcast_id}</b>\n\n"
+        f"Статус: {status_text}\n"
+        f"Обработано: {sent + failed} из {max(total, sent + failed)}\n"
+        f"Успешно: {sent}\n"
+        f"Не удалось: {failed}"
+    )
+    try:
+        await outbox.send(
+            PRIORITY_ADMIN, bot.edit_message_text,
+            text, chat_id=admin_id, message_id=message_id, parse_mode=ParseMode.HTML,
+            reply_markup=broadcast_keyboard(broadcast_id) if status == "running" else None
+        )
+    except exceptions.TelegramBadRequest:
+        pass  # Сообщение не изменилось или удалено
+    except Exception as e:
+        logger.error(f"Ошибка обновления прогресса рассылки #{broadcast_id}: {e}")
+
+async def claim_broadcast(broadcast_id: int, owner: str = None):
+    """Захватывает рассылку для процесса owner (по умолчанию этого), если у нее
+    нет живого владельца.
+
+    Проверка и захват идут одним UPDATE, поэтому из процессов, стартующих
+    одновременно, рассылку ведет только один. Возвращает поля рассылки или None.
+    """
+    owner = owner or BROADCAST_OWNER
+    now = int(time.time())
+    async with db.transaction() as tx:
+        return await tx.fetchone("""
+            UPDATE broadcasts SET owner = ?, lease_until = ?
+            WHERE id = ? AND status IN ('running', 'stopping')
+              AND (owner IS NULL OR owner = ? OR lease_until < ?)
+            RETURNING status, admin_id, text, total, sent, failed, last_user_id, progress_message_id
+        """, (owner, now + BROADCAST_LEASE, broadcast_id, owner, now))
+
+async def run_broadcast(broadcast_id: int):
+    row = await claim_broadcast(broadcast_id)
+    if row is None:
+        # Рассылку ведет другой процесс или она уже закончилась
+        return
+    status, admin_id, text, total, sent, failed, last_user_id, message_id = row
+    
+    shown = time.monotonic()
+    while status == "running":
+        rows = await db.fetchall(
+            "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?",
+            (last_user_id, BROADCAST_BATCH_SIZE)
+        )
+        if not rows:
+            break
+        
+        results = await asyncio.gather(*(deliver_broadcast(row[0], text) for row in rows))
+        sent += sum(results)
+        failed += len(results) - sum(results)
+        last_user_id = rows[-1][0]
+        # Сохраняем прогресс, продлеваем захват и перечитываем статус: остановку
+        # могли запросить из любого процесса
+        async with db.transaction() as tx:
+            row = await tx.fetchone("""
+                UPDATE broadcasts SET sent = ?, failed = ?, last_user_id = ?, lease_until = ?
+                WHERE id = ? AND owner = ?
+                RETURNING status
+            """, (sent, failed, last_user_id, int(time.time()) + BROADCAST_LEASE,
+                  broadcast_id, BROADCAST_OWNER))
+        if row is None:
+            logger.warning(f"Broadcast #{broadcast_id}: lease lost, another process continues it")
+            return
+        status = row[0]
+        
+        if message_id and time.monotonic() - shown >= BROADCAST_PROGRESS_INTERVAL:
+            shown = time.monotonic()
+            await show_broadcast_progress(broadcast_id, admin_id, message_id,
+                                          "running", total, sent, failed)
+    
+    status = "cancelled" if status == "stopping" else "done"
+    async with db.transaction() as tx:
+        finished = await tx.fetchone("""
+            UPDATE broadcasts SET status = ?, finished_ts = ?, owner = NULL, lease_until = NULL
+            WHERE id = ? AND owner = ? AND status IN ('running', 'stopping')
+            RETURNING id
+        """, (status, int(time.time()), broadcast_id, BROADCAST_OWNER))
+    if finished is None:
+        logger.warning(f"Broadcast #{broadcast_id}: lease lost before finishing")
+        return
+    logger.info(f"Broadcast #{broadcast_id} {status}: {sent} sent, {failed} failed")
+    if message_id:
+        await show_broadcast_progress(broadcast_id, admin_id, message_id,
+                                      status, total, sent, failed)
+
+async def broadcast_job(broadcast_id: int):
+    try:
+        await run_broadcast(broadcast_id)
+    except Exception as e:
+        # Рассылка остается в статусе running: когда захват истечет, ее продолжит
+        # resume_broadcasts этого или другого процесса
+        logger.error(f"Ошибка рассылки #{broadcast_id}: {e}")
+    finally:
+        broadcast_tasks.pop(broadcast_id, None)
+
+def start_broadcast(broadcast_id: int):
+    broadcast_tasks[broadcast_id] = asyncio.create_task(
+        broadcast_job(broadcast_id), name=f"broadcast_{broadcast_id}"
+    )
+
+async def resume_broadcasts():
+    """Продолжает рассылки без живого владельца: прерванные остановкой бота
+    или брошенные упавшим процессом. Кто их ведет, решает claim_broadcast"""
+    rows = await db.fetchall("""
+        SELECT id FROM broadcasts
+        WHERE status IN ('running', 'stopping') AND (owner IS NULL OR lease_until < ?)
+        ORDER BY id
+    """, (int(time.time()),))
+    for (broadcast_id,) in rows:
+        if broadcast_id not in broadcast_tasks:
+            logger.info(f"Resuming broadcast #{broadcast_id}")
+            start_broadcast(broadcast_id)
+
+async def broadcast_resume_loop():
+    while True:
+        await asyncio.sleep(BROADCAST_LEASE)
+        try:
+            await resume_broadcasts()
+        except Exception as e:
+            logger.error(f"Ошибка возобновления рассылок: {e}")
+
+async def release_broadcasts():
+    """Останавливает рассылки этого процесса при выключении и снимает захват,
+    чтобы их сразу продолжил следующий запуск или другой процесс"""
+    tasks = list(broadcast_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await db.execute(
+        "UPDATE broadcasts SET owner = NULL, lease_until = NULL WHERE owner = ?", (BROADCAST_OWNER,)
+    )
+
 @dp.callback_query(lambda c: c.data == "admin_broadcast")
 async def admin_broadcast(callback: CallbackQuery, state: FSMContext):
     if not is_admin(callback.from_user.id):
@@ -2820,33 +5711,39 @@ async def admin_broadcast(callback: CallbackQuery, state: FSMContext):
 
 @dp.message(Form.admin_broadcast)
 async def process_admin_broadcast(message: Message, state: FSMContext):
-    broadcast_text = message.text
-    admin_id = message.from_user.id
-    
-    # Получаем всех пользователей
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id FROM users")
-        users = cursor.fetchall()
-    
-    success_count = 0
-    fail_count = 0
-    
-    for user in users:
-        user_id = user[0]
-        try:
-            await bot.send_message(user_id, broadcast_text)
-            success_count += 1
-            await asyncio.sleep(0.1)  # Задержка чтобы не спамить
-        except Exception as e:
-            fail_count += 1
+    if not message.text:
+        await message.answer("❌ Отправьте текст сообщения для рассылки")
+        return
     
-    await message.answer(
-        f"✅ Рассылка завершена!\n\n"
-        f"Успешно: {success_count}\n"
-        f"Не удалось: {fail_count}"
-    )
     await state.clear()
+    admin_id = message.from_user.id
+    total = await db.fetchval(
+        "SELECT value FROM running_totals WHERE name = 'users'", default=0
+    )
+    progress = await message.answer("📢 Рассылка запускается...")
+    
+    # html_text сохраняет форматирование исходного сообщения
+    broadcast_id = await db.insert("""
+        INSERT INTO broadcasts (admin_id, text, total, progress_message_id)
+        VALUES (?, ?, ?, ?)
+    """, (admin_id, message.html_text, total, progress.message_id))
+    await show_broadcast_progress(broadcast_id, admin_id, progress.message_id,
+                                  "running", total, 0, 0)
+    start_broadcast(broadcast_id)
+
+@dp.callback_query(lambda c: c.data.startswith("broadcast_stop:"))
+async def stop_broadcast(callback: CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ У вас нет прав администратора")
+        return
+    
+    broadcast_id = int(callback.data.split(":")[1])
+    # Процесс, который ведет рассылку, увидит статус после текущей пачки
+    if not await db.transition("broadcasts", broadcast_id, ("running",), "stopping", returning=("id",)):
+        await callback.answer("Рассылка уже остановлена или завершена")
+        return
+    
+    await callback.answer("⏹ Рассылка остановится после текущей пачки")
 
 @dp.callback_query(lambda c: c.data == "admin_stats")
 async def admin_stats(callback: CallbackQuery):
@@ -2856,51 +5753,28 @@ async def admin_stats(callback: CallbackQuery):
     
     await callback.answer()
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        
-        # Общая статистика
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM whatsapp_numbers")
-        total_whatsapp = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM max_numbers")
-        total_max = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM sms_works")
-        total_sms = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT SUM(balance_usd) FROM users")
-        total_balance = cursor.fetchone()[0] or 0
-        
-        cursor.execute("SELECT SUM(total_earned_usd) FROM users")
-        total_earned = cursor.fetchone()[0] or 0
-        
-        # Активные холды
-        cursor.execute("SELECT COUNT(*) FROM whatsapp_numbers WHERE status IN ('hold_active', 'active')")
-        active_whatsapp = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM max_numbers WHERE status = 'active'")
-        active_max = cursor.fetchone()[0]
-        
-        # Очередь на подтверждение
-        cursor.execute("SELECT COUNT(*) FROM whatsapp_numbers WHERE status = 'pending'")
-        pending_whatsapp = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM max_numbers WHERE status = 'pending'")
-        pending_max = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM sms_works WHERE status = 'pending'")
-        pending_sms = cursor.fetchone()[0]
-        
-        # Заявки на вывод
-        cursor.execute("SELECT COUNT(*) FROM withdraw_requests WHERE status = 'pending'")
-        pending_withdrawals = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT SUM(amount_usd) FROM withdraw_requests WHERE status = 'pending'")
-        pending_withdrawals_amount = cursor.fetchone()[0] or 0
+    # Статистика из снимка, пересчитывается не чаще раза в STATS_TTL_SECONDS
+    stats = await admin_stats_snapshot.get()
+    total_users = stats["total_users"]
+    total_balance = stats["total_balance"]
+    total_earned = stats["total_earned"]
+    
+    total_whatsapp = stats["total_whatsapp"]
+    total_max = stats["total_max"]
+    total_sms = stats["total_sms"]
+    
+    # Активные холды
+    active_whatsapp = stats["active_whatsapp"]
+    active_max = stats["active_max"]
+    
+    # Очередь на подтверждение
+    pending_whatsapp = stats["pending_whatsapp"]
+    pending_max = stats["pending_max"]
+    pending_sms = stats["pending_sms"]
+    
+    # Заявки на вывод
+    pending_withdrawals = stats["pending_withdrawals"]
+    pending_withdrawals_amount = stats["pending_withdrawals_amount"]
     
     stats_text = (
         "📊 <b>Статистика бота</b>\n\n"
@@ -2929,7 +5803,61 @@ async def admin_stats(callback: CallbackQuery):
         f"⏰ <b>Активные холды:</b> {active_whatsapp + active_max}"
     )
     
-    await callback.message.edit_text(stats_text, parse_mode=ParseMode.HTML)
+    await callback.message.edit_text(stats_text, parse_mode=ParseMode.HTML,
+                                     reply_markup=stats_keyboard())
+
+@dp.callback_query(lambda c: c.data.startswith("daily_stats:"))
+async def show_daily_stats(callback: CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ У вас нет прав администратора")
+        return
+    
+    await callback.answer()
+    
+    days = 30 if callback.data == "daily_stats:30" else 7
+    first_day = day_start(int(time.time())) - (days - 1) * DAY_SECONDS
+    
+    # Готовые сводки по дням: чтение диапазона первичного ключа
+    rows = await db.fetchall("""
+        SELECT day, service, metric, count, amount_cents FROM daily_stats
+        WHERE day >= ?
+        ORDER BY day DESC
+    """, (format_ts(first_day, "%Y-%m-%d"),))
+    
+    totals, by_day = {}, {}
+    for day, service, metric, count, amount_cents in rows:
+        total = totals.setdefault((service, metric), [0, 0])
+        total[0] += count
+        total[1] += amount_cents
+        by_day.setdefault(day, {})[(service, metric)] = (count, amount_cents)
+    
+    response = (
+        f"📅 <b>Статистика за {days} дн.</b> (по МСК, обновляется раз в {ROLLUP_INTERVAL // 60} мин.)\n\n"
+        f"📱 <b>WhatsApp:</b> сдано {rollup_count(totals, 'whatsapp', 'submitted')}, "
+        f"на холд {rollup_count(totals, 'whatsapp', 'hold_started')}, "
+        f"слетело {rollup_count(totals, 'whatsapp', 'failed')}\n"
+        f"🤖 <b>MAX:</b> сдано {rollup_count(totals, 'max', 'submitted')}, "
+        f"на холд {rollup_count(totals, 'max', 'hold_started')}\n"
+        f"💬 <b>SMS WORK:</b> сдано {rollup_count(totals, 'sms', 'submitted')}, "
+        f"выполнено {rollup_count(totals, 'sms', 'completed')} ({rollup_usd(totals, 'sms', 'completed'):.2f}$)\n"
+        f"💳 <b>Выплаты:</b> {rollup_count(totals, 'payouts', 'paid')} "
+        f"на {rollup_usd(totals, 'payouts', 'paid'):.2f}$\n\n"
+    )
+    if by_day:
+        response += "<b>По дням</b> (WA сдано/холд · MAX сдано/холд · SMS выполнено · выплаты $):\n"
+        for day, values in by_day.items():
+            response += (
+                f"{day[8:10]}.{day[5:7]}: "
+                f"{rollup_count(values, 'whatsapp', 'submitted')}/{rollup_count(values, 'whatsapp', 'hold_started')} · "
+                f"{rollup_count(values, 'max', 'submitted')}/{rollup_count(values, 'max', 'hold_started')} · "
+                f"{rollup_count(values, 'sms', 'completed')} · "
+                f"{rollup_usd(values, 'payouts', 'paid'):.2f}\n"
+            )
+    else:
+        response += "Сводок за этот период еще нет"
+    
+    await callback.message.edit_text(response, parse_mode=ParseMode.HTML,
+                                     reply_markup=stats_keyboard())
 
 @dp.callback_query(lambda c: c.data == "admin_payouts")
 async def admin_payouts(callback: CallbackQuery):
@@ -2939,33 +5867,27 @@ async def admin_payouts(callback: CallbackQuery):
     
     await callback.answer()
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        
-        # Заявки на вывод
-        cursor.execute("""
-            SELECT COUNT(*), SUM(amount_usd) 
-            FROM withdraw_requests 
-            WHERE status = 'pending'
-        """)
-        pending_count, pending_amount = cursor.fetchone()
-        pending_amount = pending_amount or 0
-        
-        cursor.execute("""
-            SELECT COUNT(*), SUM(amount_usd) 
-            FROM withdraw_requests 
-            WHERE status = 'confirmed'
-        """)
-        confirmed_count, confirmed_amount = cursor.fetchone()
-        confirmed_amount = confirmed_amount or 0
-        
-        cursor.execute("""
-            SELECT COUNT(*), SUM(amount_usd) 
-            FROM withdraw_requests 
-            WHERE status = 'paid'
-        """)
-        paid_count, paid_amount = cursor.fetchone()
-        paid_amount = paid_amount or 0
+    # Заявки на вывод
+    pending_count, pending_amount = await db.fetchone("""
+        SELECT COUNT(*), SUM(amount_usd) 
+        FROM withdraw_requests 
+        WHERE status = 'pending'
+    """)
+    pending_amount = pending_amount or 0
+    
+    confirmed_count, confirmed_amount = await db.fetchone("""
+        SELECT COUNT(*), SUM(amount_usd) 
+        FROM withdraw_requests 
+        WHERE status = 'confirmed'
+    """)
+    confirmed_amount = confirmed_amount or 0
+    
+    paid_count, paid_amount = await db.fetchone("""
+        SELECT COUNT(*), SUM(amount_usd) 
+        FROM withdraw_requests 
+        WHERE status = 'paid'
+    """)
+    paid_amount = paid_amount or 0
     
     payouts_text = (
         "💰 <b>Управление выплатами</b>\n\n"
@@ -3085,43 +6007,46 @@ async def admin_warn(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     await callback.message.answer(
         "⚠️ <b>Выдать предупреждение</b>\n\n"
-        "Введите ID пользователя:",
+        "Введите ID пользователя, @username или часть номера для поиска:",
         parse_mode=ParseMode.HTML
     )
     await state.set_state(Form.warn_user)
 
+async def add_warning(tx, user_id: int):
+    """Добавляет предупреждение; (username, новое количество) или None"""
+    return await tx.fetchone("""
+        UPDATE users SET warnings = warnings + 1
+        WHERE user_id = ?
+        RETURNING username, warnings
+    """, (user_id,))
+
 @dp.message(Form.warn_user)
 async def process_warn_user(message: Message, state: FSMContext):
     try:
         user_id = int(message.text.strip())
     except ValueError:
-        await message.answer("❌ Неверный формат ID. Введите числовой ID.")
+        # Не ID — ищем пользователя, предупреждение выдается из его карточки
+        await state.clear()
+        await send_search_results(message, message.text)
         return
     
-    # Проверяем существование пользователя
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT username, warnings FROM users WHERE user_id = ?", (user_id,))
-        user_data = cursor.fetchone()
-        
-        if not user_data:
-            await message.answer("❌ Пользователь не найден.")
-            await state.clear()
-            return
-        
-        username, current_warnings = user_data
-        
-        # Добавляем предупреждение
-        new_warnings = current_warnings + 1
-        cursor.execute(
-            "UPDATE users SET warnings = ? WHERE user_id = ?",
-            (new_warnings, user_id)
-        )
-        conn.commit()
+    await message.answer(await warn_user(user_id))
+    await state.clear()
+
+async def warn_user(user_id: int) -> str:
+    """Выдает предупреждение и уведомляет пользователя; возвращает ответ админу"""
+    # Добавляем предупреждение, если пользователь существует
+    user_data = await db.group_commit(add_warning, user_id)
+    
+    if not user_data:
+        return "❌ Пользователь не найден."
+    
+    username, new_warnings = user_data
     
     # Уведомляем пользователя
     try:
-        await bot.send_message(
+        await outbox.send(
+            PRIORITY_USER, bot.send_message,
             user_id,
             f"⚠️ <b>Вам выдано предупреждение!</b>\n\n"
             f"Текущее количество предупреждений: {new_warnings}/5\n"
@@ -3131,11 +6056,10 @@ async def process_warn_user(message: Message, state: FSMContext):
     except Exception as e:
         logger.error(f"Ошибка уведомления пользователя: {e}")
     
-    await message.answer(
+    return (
         f"✅ Пользователю @{username or 'N/A'} (ID: {user_id}) выдано предупреждение.\n"
         f"Текущее количество: {new_warnings}/5"
     )
-    await state.clear()
 
 @dp.callback_query(lambda c: c.data == "admin_message")
 async def admin_message(callback: CallbackQuery, state: FSMContext):
@@ -3146,7 +6070,7 @@ async def admin_message(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     await callback.message.answer(
         "✉️ <b>Отправка сообщения пользователю</b>\n\n"
-        "Введите ID пользователя:",
+        "Введите ID пользователя, @username или часть номера для поиска:",
         parse_mode=ParseMode.HTML
     )
     await state.set_state(Form.admin_message)
@@ -3156,7 +6080,9 @@ async def process_admin_message_user(message: Message, state: FSMContext):
     try:
         user_id = int(message.text.strip())
     except ValueError:
-        await message.answer("❌ Неверный формат ID. Введите числовой ID.")
+        # Не ID — ищем пользователя, сообщение пишется из его карточки
+        await state.clear()
+        await send_search_results(message, message.text)
         return
     
     await state.update_data(target_user_id=user_id)
@@ -3172,7 +6098,8 @@ async def process_admin_message_text(message: Message, state: FSMContext):
     message_text = message.text
     
     try:
-        await bot.send_message(
+        await outbox.send(
+            PRIORITY_USER, bot.send_message,
             target_user_id,
             f"📨 <b>Сообщение от администратора:</b>\n\n{message_text}",
             parse_mode=ParseMode.HTML
@@ -3184,6 +6111,227 @@ async def process_admin_message_text(message: Message, state: FSMContext):
     
     await state.clear()
 
+# Поиск пользователей для админов.
+# Подстрока ищется в username, имени и фамилии, цифры — в номерах WhatsApp и
+# MAX вместе с архивом, число дополнительно сравнивается с user_id. В SQLite поиск идет по
+# триграммным индексам FTS5, в PostgreSQL — по индексам pg_trgm. Результаты
+# листаются по user_id, запрос хранится в памяти под номером из callback_data
+SEARCH_MIN_LENGTH = 3  # Триграммному индексу нужно не меньше трех символов
+SEARCH_PAGE_SIZE = 10
+SEARCH_CACHE_SIZE = 32
+# Части поиска по СУБД: каждая выбирает user_id по одному параметру
+SEARCH_SQL = {
+    "sqlite": {
+        "name": "SELECT rowid FROM users_fts WHERE users_fts MATCH ?",
+        "whatsapp": ("SELECT w.user_id FROM whatsapp_phones_fts f "
+                     "JOIN whatsapp_numbers w ON w.id = f.rowid WHERE whatsapp_phones_fts MATCH ?"),
+        "max": ("SELECT m.user_id FROM max_phones_fts f "
+                "JOIN max_numbers m ON m.id = f.rowid WHERE max_phones_fts MATCH ?"),
+        "whatsapp_archive": ("SELECT w.user_id FROM whatsapp_archive_phones_fts f "
+                             "JOIN whatsapp_numbers_archive w ON w.id = f.rowid "
+                             "WHERE whatsapp_archive_phones_fts MATCH ?"),
+        "max_archive": ("SELECT m.user_id FROM max_archive_phones_fts f "
+                        "JOIN max_numbers_archive m ON m.id = f.rowid WHERE max_archive_phones_fts MATCH ?"),
+        "id": "SELECT CAST(? AS INTEGER)",
+    },
+    "postgres": {
+        "name": f"SELECT user_id FROM users WHERE {PG_USER_SEARCH_TEXT} ILIKE ?",
+        "whatsapp": "SELECT user_id FROM whatsapp_numbers WHERE phone LIKE ?",
+        "max": "SELECT user_id FROM max_numbers WHERE phone LIKE ?",
+        "whatsapp_archive": "SELECT user_id FROM whatsapp_numbers_archive WHERE phone LIKE ?",
+        "max_archive": "SELECT user_id FROM max_numbers_archive WHERE phone LIKE ?",
+        "id": "SELECT CAST(? AS BIGINT)",
+    },
+}
+
+search_queries = {}
+search_ids = itertools.count(1)
+
+def search_terms(query: str) -> dict:
+    """Части поиска, подходящие к запросу: часть -> искомая строка или ID"""
+    query = query.strip()
+    text = query.lstrip("@")
+    digits = re.sub(r"\D", "", query)
+    terms = {}
+    if len(text) >= SEARCH_MIN_LENGTH:
+        terms["name"] = text
+    # Номер можно ввести с пробелами, скобками и дефисами
+    if len(digits) >= SEARCH_MIN_LENGTH and re.fullmatch(r"[\d\s()+-]+", query):
+        for part in ("whatsapp", "whatsapp_archive", "max", "max_archive"):
+            terms[part] = digits
+    if query.isdigit():
+        terms["id"] = int(query)
+    return terms
+
+def search_sql(parts, dialect: str = "sqlite") -> str:
+    union = " UNION ".join(SEARCH_SQL[dialect][part] for part in parts)
+    return (f"SELECT user_id, username, first_name, last_name FROM users "
+            f"WHERE user_id IN ({union}) AND user_id > ? ORDER BY user_id LIMIT ?")
+
+async def search_users(query: str, after_id: int = 0) -> list:
+    """До SEARCH_PAGE_SIZE + 1 найденных пользователей с user_id > after_id:
+    (user_id, username, first_name, last_name)"""
+    dialect = "postgres" if isinstance(db, PostgresDatabase) else "sqlite"
+    terms = search_terms(query)
+    if not terms:
+        return []
+    
+    params = []
+    for part, term in terms.items():
+        if part == "id":
+            params.append(term)
+        elif dialect == "postgres":
+            params.append("%" + re.sub(r"([\\%_])", r"\\\1", term) + "%")
+        else:
+            # Запрос FTS5 — одна фраза, без операторов
+            params.append('"' + term.replace('"', '""') + '"')
+    return await db.fetchall(search_sql(terms, dialect), (*params, after_id, SEARCH_PAGE_SIZE + 1))
+
+def search_results_keyboard(search_id: int, users: list, after_id: int):
+    builder = InlineKeyboardBuilder()
+    for user_id, username, first_name, last_name in users[:SEARCH_PAGE_SIZE]:
+        name = f"@{username}" if username else " ".join(filter(None, (first_name, last_name)))
+        builder.row(types.InlineKeyboardButton(
+            text=f"👤 {name or 'без имени'} (ID: {user_id})",
+            callback_data=f"search_user:{user_id}"
+        ))
+    
+    buttons = []
+    if after_id:
+        buttons.append(types.InlineKeyboardButton(
+            text="🔝 В начало", callback_data=f"find:{search_id}:0"
+        ))
+    if len(users) > SEARCH_PAGE_SIZE:
+        buttons.append(types.InlineKeyboardButton(
+            text="След. ➡️", callback_data=f"find:{search_id}:{users[SEARCH_PAGE_SIZE - 1][0]}"
+        ))
+    if buttons:
+        builder.row(*buttons)
+    return builder.as_markup()
+
+def user_card_keyboard(user_id: int):
+    builder = InlineKeyboardBuilder()
+    builder.row(
+        types.InlineKeyboardButton(text="⏰ Холды", callback_data=f"search_hold:{user_id}"),
+        types.InlineKeyboardButton(text="✉️ Написать", callback_data=f"search_message:{user_id}")
+    )
+    builder.row(
+        types.InlineKeyboardButton(text="⚠️ Выдать предупреждение", callback_data=f"search_warn:{user_id}")
+    )
+    return builder.as_markup()
+
+async def send_search_results(message: Message, query: str):
+    if not search_terms(query):
+        await message.answer(f"❌ Для поиска нужно не меньше {SEARCH_MIN_LENGTH} символов")
+        return
+    
+    users = await search_users(query)
+    if not users:
+        await message.answer("🔎 Никого не нашлось")
+        return
+    
+    search_id = next(search_ids)
+    search_queries[search_id] = query
+    # Храним только последние запросы; у старых листание перестает работать
+    for stale in list(search_queries)[:-SEARCH_CACHE_SIZE]:
+        del search_queries[stale]
+    await message.answer(
+        f"🔎 <b>Результаты поиска:</b> {html.escape(query.strip(), quote=False)}",
+        parse_mode=ParseMode.HTML,
+        reply_markup=search_results_keyboard(search_id, users, 0)
+    )
+
+@dp.message(Command("find"))
+async def find_user(message: Message, command: CommandObject):
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ У вас нет прав администратора")
+        return
+    
+    if not command.args:
+        await message.answer("❌ Укажите ID, @username, имя или часть номера: /find <запрос>",
+                             parse_mode=None)
+        return
+    
+    await send_search_results(message, command.args)
+
+@dp.callback_query(lambda c: c.data.startswith("find:"))
+async def show_search_page(callback: CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ У вас нет прав администратора")
+        return
+    
+    _, search_id, after_id = callback.data.split(":")
+    query = search_queries.get(int(search_id))
+    if query is None:
+        await callback.answer("⚠️ Поиск устарел, повторите его", show_alert=True)
+        return
+    
+    await callback.answer()
+    users = await search_users(query, int(after_id))
+    try:
+        await callback.message.edit_reply_markup(
+            reply_markup=search_results_keyboard(int(search_id), users, int(after_id))
+        )
+    except exceptions.TelegramBadRequest:
+        # Страница не изменилась (message is not modified)
+        pass
+
+@dp.callback_query(lambda c: c.data.startswith("search_user:"))
+async def show_user_card(callback: CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ У вас нет прав администратора")
+        return
+    
+    user_id = int(callback.data.split(":")[1])
+    user_info = await db.fetchone("""
+        SELECT username, first_name, last_name, balance_usd, level, warnings
+        FROM users WHERE user_id = ?
+    """, (user_id,))
+    if not user_info:
+        await callback.answer("❌ Пользователь не найден", show_alert=True)
+        return
+    
+    await callback.answer()
+    username, first_name, last_name, balance, level, warnings = user_info
+    full_name = " ".join(filter(None, (first_name, last_name))) or "нет"
+    await callback.message.answer(
+        f"👤 <b>Пользователь</b> @{username or 'нет'} (ID: {user_id})\n"
+        f"Имя: {html.escape(full_name, quote=False)}\n"
+        f"Баланс: {balance:.2f}$ | Уровень: {level}\n"
+        f"Предупреждений: {warnings}/5",
+        parse_mode=ParseMode.HTML,
+        reply_markup=user_card_keyboard(user_id)
+    )
+
+@dp.callback_query(lambda c: c.data.startswith("search_hold:"))
+async def show_searched_user_hold(callback: CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ У вас нет прав администратора")
+        return
+    
+    await callback.answer()
+    await send_user_hold(callback.message, int(callback.data.split(":")[1]))
+
+@dp.callback_query(lambda c: c.data.startswith("search_warn:"))
+async def warn_searched_user(callback: CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ У вас нет прав администратора")
+        return
+    
+    await callback.answer()
+    await callback.message.answer(await warn_user(int(callback.data.split(":")[1])))
+
+@dp.callback_query(lambda c: c.data.startswith("search_message:"))
+async def message_searched_user(callback: CallbackQuery, state: FSMContext):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ У вас нет прав администратора")
+        return
+    
+    await callback.answer()
+    await state.update_data(target_user_id=int(callback.data.split(":")[1]))
+    await callback.message.answer("Теперь введите сообщение для отправки:")
+    await state.set_state(Form.admin_message_text)
+
 @dp.callback_query(lambda c: c.data == "show_payouts_list")
 async def show_payouts_list(callback: CallbackQuery):
     if not is_admin(callback.from_user.id):
@@ -3192,19 +6340,14 @@ async def show_payouts_list(callback: CallbackQuery):
     
     await callback.answer()
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        
-        # Получаем последние 10 заявок
-        cursor.execute("""
-            SELECT wr.id, wr.user_id, wr.amount_usd, wr.status, wr.created_at, u.username
-            FROM withdraw_requests wr
-            JOIN users u ON wr.user_id = u.user_id
-            ORDER BY wr.created_at DESC
-            LIMIT 10
-        """)
-        
-        withdrawals = cursor.fetchall()
+    # Получаем последние 10 заявок
+    withdrawals = await db.fetchall("""
+        SELECT wr.id, wr.user_id, wr.amount_usd, wr.status, wr.created_ts, u.username
+        FROM withdraw_requests wr
+        JOIN users u ON wr.user_id = u.user_id
+        ORDER BY wr.created_at DESC
+        LIMIT 10
+    """)
     
     if not withdrawals:
         await callback.message.answer("❌ Нет заявок на вывод.")
@@ -3213,15 +6356,16 @@ async def show_payouts_list(callback: CallbackQuery):
     response = "📋 <b>Последние заявки на вывод</b>\n\n"
     
     for withdraw in withdrawals:
-        withdraw_id, user_id, amount, status, created_at, username = withdraw
+        withdraw_id, user_id, amount, status, created_ts, username = withdraw
         response += (
             f"🔹 ID: {withdraw_id}\n"
             f"👤 Пользователь: @{username or 'N/A'} (ID: {user_id})\n"
             f"💰 Сумма: {amount:.2f}$\n"
             f"📊 Статус: {status}\n"
-            f"📅 Дата: {created_at}\n"
+            f"📅 Дата: {format_ts(created_ts)}\n"
             f"────────────────────\n"
         )
+    response += "\nВсе заявки: /export withdraw_requests [status=...] [from=ГГГГ-ММ-ДД]"
     
     await callback.message.answer(response, parse_mode=ParseMode.HTML)
 
@@ -3276,33 +6420,11 @@ async def admin_active_hold(callback: CallbackQuery):
     
     await callback.answer()
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        
-        # Получаем статистику по холдам
-        cursor.execute("""
-            SELECT COUNT(*) FROM whatsapp_numbers 
-            WHERE status IN ('hold_active', 'active')
-        """)
-        whatsapp_count = cursor.fetchone()[0]
-        
-        cursor.execute("""
-            SELECT COUNT(*) FROM max_numbers 
-            WHERE status = 'active'
-        """)
-        max_count = cursor.fetchone()[0]
-        
-        cursor.execute("""
-            SELECT COUNT(*) FROM whatsapp_numbers 
-            WHERE status = 'completed'
-        """)
-        whatsapp_completed = cursor.fetchone()[0]
-        
-        cursor.execute("""
-            SELECT COUNT(*) FROM max_numbers 
-            WHERE status = 'completed'
-        """)
-        max_completed = cursor.fetchone()[0]
+    # Получаем статистику по холдам
+    whatsapp_count = queue_counters.get("whatsapp", "hold_active", "active")
+    max_count = queue_counters.get("max", "active")
+    whatsapp_completed = queue_counters.get("whatsapp", "completed")
+    max_completed = queue_counters.get("max", "completed")
     
     response = (
         "⏰ <b>Активные холды - Статистика</b>\n\n"
@@ -3328,14 +6450,8 @@ async def admin_report_failed(callback: CallbackQuery):
     await callback.answer()
     
     # Получаем количество активных аккаунтов
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT COUNT(*) FROM whatsapp_numbers WHERE status IN ('hold_active', 'active')")
-        whatsapp_count = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM max_numbers WHERE status = 'active')")
-        max_count = cursor.fetchone()[0]
+    whatsapp_count = queue_counters.get("whatsapp", "hold_active", "active")
+    max_count = queue_counters.get("max", "active")
     
     total_count = whatsapp_count + max_count
     
@@ -3358,49 +6474,44 @@ async def report_failed_whatsapp(callback: CallbackQuery):
         await callback.answer("❌ У вас нет прав администратора")
         return
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE whatsapp_numbers 
-            SET status = 'failed', failed_at = datetime('now')
-            WHERE id = ?
-        """, (account_id,))
-        
-        cursor.execute("""
-            SELECT user_id, phone FROM whatsapp_numbers WHERE id = ?
-        """, (account_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            user_id, phone = result
-            conn.commit()
-            
-            # Уведомляем пользователя
-            try:
-                await bot.send_message(
-                    user_id,
-                    f"❌ Ваш WhatsApp аккаунт {phone} был помечен как слетевший администратором.\n\n"
-                    f"Если это ошибка, обратитесь в поддержку."
-                )
-            except Exception as e:
-                logger.error(f"Ошибка уведомления пользователя: {e}")
-            
-            # Уведомляем всех администраторов
-            admin_message = (
-                f"🚨 <b>WhatsApp аккаунт помечен как слетевший</b>\n\n"
-                f"Аккаунт ID: {account_id}\n"
-                f"Номер: {phone}\n"
-                f"Пользователь: ID {user_id}\n"
-                f"Администратор: @{callback.from_user.username or 'без username'}"
-            )
-            
-            await notify_admins(admin_message)
-            
-            await callback.answer(f"✅ WhatsApp аккаунт {phone} помечен как слетевший")
-            await callback.message.edit_text(
-                f"✅ WhatsApp аккаунт {phone} успешно помечен как слетевший!",
-                reply_markup=None
-            )
+    result = await db.transition(
+        "whatsapp_numbers", account_id, ("hold_active", "active"), "failed",
+        fields={"failed_at": SQL_NOW}
+    )
+    
+    if not result:
+        await callback.answer("⚠️ Аккаунт уже не на холде")
+        return
+    
+    user_id, phone = result
+    
+    # Уведомляем пользователя
+    try:
+        await outbox.send(
+            PRIORITY_USER, bot.send_message,
+            user_id,
+            f"❌ Ваш WhatsApp аккаунт {phone} был помечен как слетевший администратором.\n\n"
+            f"Если это ошибка, обратитесь в поддержку."
+        )
+    except Exception as e:
+        logger.error(f"Ошибка уведомления пользователя: {e}")
+    
+    # Уведомляем всех администраторов
+    admin_message = (
+        f"🚨 <b>WhatsApp аккаунт помечен как слетевший</b>\n\n"
+        f"Аккаунт ID: {account_id}\n"
+        f"Номер: {phone}\n"
+        f"Пользователь: ID {user_id}\n"
+        f"Администратор: @{callback.from_user.username or 'без username'}"
+    )
+    
+    notify_admins(admin_message)
+    
+    await callback.answer(f"✅ WhatsApp аккаунт {phone} помечен как слетевший")
+    await callback.message.edit_text(
+        f"✅ WhatsApp аккаунт {phone} успешно помечен как слетевший!",
+        reply_markup=None
+    )
 
 @dp.callback_query(lambda c: c.data.startswith("report_failed_max:"))
 async def report_failed_max(callback: CallbackQuery):
@@ -3411,49 +6522,44 @@ async def report_failed_max(callback: CallbackQuery):
         await callback.answer("❌ У вас нет прав администратора")
         return
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE max_numbers 
-            SET status = 'failed', completed = 0
-            WHERE id = ?
-        """, (account_id,))
-        
-        cursor.execute("""
-            SELECT user_id, phone FROM max_numbers WHERE id = ?
-        """, (account_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            user_id, phone = result
-            conn.commit()
-            
-            # Уведомляем пользователя
-            try:
-                await bot.send_message(
-                    user_id,
-                    f"❌ Ваш MAX аккаунт {phone} был помечен как слетевший администратором.\n\n"
-                    f"Если это ошибка, обратитесь в поддержку."
-                )
-            except Exception as e:
-                logger.error(f"Ошибка уведомления пользователя: {e}")
-            
-            # Уведомляем всех администраторов
-            admin_message = (
-                f"🚨 <b>MAX аккаунт помечен как слетевший</b>\n\n"
-                f"Аккаунт ID: {account_id}\n"
-                f"Номер: {phone}\n"
-                f"Пользователь: ID {user_id}\n"
-                f"Администратор: @{callback.from_user.username or 'без username'}"
-            )
-            
-            await notify_admins(admin_message)
-            
-            await callback.answer(f"✅ MAX аккаунт {phone} помечен как слетевший")
-            await callback.message.edit_text(
-                f"✅ MAX аккаунт {phone} успешно помечен как слетевший!",
-                reply_markup=None
-            )
+    result = await db.transition(
+        "max_numbers", account_id, ("active",), "failed",
+        fields={"completed": 0}
+    )
+    
+    if not result:
+        await callback.answer("⚠️ Аккаунт уже не на холде")
+        return
+    
+    user_id, phone = result
+    
+    # Уведомляем пользователя
+    try:
+        await outbox.send(
+            PRIORITY_USER, bot.send_message,
+            user_id,
+            f"❌ Ваш MAX аккаунт {phone} был помечен как слетевший администратором.\n\n"
+            f"Если это ошибка, обратитесь в поддержку."
+        )
+    except Exception as e:
+        logger.error(f"Ошибка уведомления пользователя: {e}")
+    
+    # Уведомляем всех администраторов
+    admin_message = (
+        f"🚨 <b>MAX аккаунт помечен как слетевший</b>\n\n"
+        f"Аккаунт ID: {account_id}\n"
+        f"Номер: {phone}\n"
+        f"Пользователь: ID {user_id}\n"
+        f"Администратор: @{callback.from_user.username or 'без username'}"
+    )
+    
+    notify_admins(admin_message)
+    
+    await callback.answer(f"✅ MAX аккаунт {phone} помечен как слетевший")
+    await callback.message.edit_text(
+        f"✅ MAX аккаунт {phone} успешно помечен как слетевший!",
+        reply_markup=None
+    )
 
 @dp.callback_query(lambda c: c.data == "no_accounts")
 async def no_accounts(callback: CallbackQuery):
@@ -3464,13 +6570,168 @@ async def no_accounts(callback: CallbackQuery):
         reply_markup=None
     )
 
+@dp.callback_query(lambda c: c.data.startswith("page:"))
+async def show_list_page(callback: CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ У вас нет прав администратора")
+        return
+    
+    _, name, cursor = (callback.data.split(":", 2) + [""])[:3]
+    keyboard = PAGED_KEYBOARDS.get(name)
+    if keyboard is None:
+        await callback.answer()
+        return
+    
+    await callback.answer()
+    try:
+        await callback.message.edit_reply_markup(reply_markup=await keyboard(cursor))
+    except exceptions.TelegramBadRequest:
+        # Страница не изменилась (message is not modified)
+        pass
+
+@dp.callback_query(lambda c: c.data.startswith("report:"))
+async def show_report_page(callback: CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ У вас нет прав администратора")
+        return
+    
+    _, report_id, page = callback.data.split(":")
+    pages = report_pages.get(int(report_id))
+    if pages is None:
+        await callback.answer("⚠️ Отчет устарел, запросите его заново", show_alert=True)
+        return
+    
+    page = min(int(page), len(pages) - 1)
+    await callback.answer()
+    try:
+        await callback.message.edit_text(
+            pages[page], parse_mode=ParseMode.HTML,
+            reply_markup=report_keyboard(int(report_id), page, len(pages))
+        )
+    except exceptions.TelegramBadRequest:
+        # Нажата кнопка текущей страницы
+        pass
+
+# Режим webhook (BOT_MODE=webhook).
+# Встроенный aiohttp-сервер принимает обновления от Telegram, TLS завершает
+# обратный прокси перед ним. Запрос без верного секретного заголовка
+# отклоняется. Одновременно обрабатывается не больше WEBHOOK_CONCURRENCY
+# обновлений: пока мест нет, ответ на запрос задерживается, и Telegram сам
+# придерживает следующие. Локально сохраненный Update отправляется так:
+#   curl -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \
+#        -H "Content-Type: application/json" -d @update.json http://localhost:8080/webhook
+WEBHOOK_SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+webhook_slots = asyncio.Semaphore(WEBHOOK_CONCURRENCY)
+webhook_tasks = set()
+
+async def process_webhook_update(update: Update):
+    try:
+        await dp.feed_update(bot, update)
+    except Exception as e:
+        logger.error(f"Ошибка обработки обновления {update.update_id}: {e}")
+    finally:
+        webhook_slots.release()
+
+async def handle_webhook(secret: str, request: web.Request) -> web.Response:
+    if not hmac.compare_digest(request.headers.get(WEBHOOK_SECRET_HEADER, ""), secret):
+        return web.Response(status=401)
+    
+    try:
+        update = Update.model_validate(await request.json(), context={"bot": bot})
+    except Exception as e:
+        logger.error(f"Некорректное обновление в webhook: {e}")
+        return web.Response(status=400)
+    
+    # Ответ уходит только после того, как обновление заняло место
+    await webhook_slots.acquire()
+    task = asyncio.create_task(process_webhook_update(update), name=f"update_{update.update_id}")
+    webhook_tasks.add(task)
+    task.add_done_callback(webhook_tasks.discard)
+    return web.Response()
+
+async def run_webhook():
+    secret = WEBHOOK_SECRET
+    if not secret:
+        secret = secrets.token_urlsafe(32)
+        logger.warning("WEBHOOK_SECRET не задан, используется случайный секрет на время запуска")
+    
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, functools.partial(handle_webhook, secret))
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logger.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    
+    # Без WEBHOOK_URL адрес не регистрируется: локальная отладка или
+    # регистрация одним процессом из нескольких за балансировщиком
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=secret,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=min(WEBHOOK_CONCURRENCY, 100)
+        )
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stop.set)
+    
+    await dp.emit_startup(bot=bot)
+    try:
+        await stop.wait()
+    finally:
+        # Сначала перестаем принимать запросы, затем дожидаемся начатых обновлений
+        await runner.cleanup()
+        if webhook_tasks:
+            await asyncio.gather(*webhook_tasks, return_exceptions=True)
+        # Уведомления админам, запущенные этими обновлениями
+        if admin_notify_tasks:
+            await asyncio.gather(*admin_notify_tasks, return_exceptions=True)
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
 # Запуск бота
 async def main():
     # Инициализация базы данных
-    init_db()
+    await db.open()
+    await db.migrate()
+    await queue_counters.load(db)
+    await load_archive_columns(db)
+    asyncio.create_task(balance_checkpoint_loop(), name="balance_checkpoint_loop")
+    if ARCHIVE_AFTER_DAYS:
+        asyncio.create_task(archive_loop(), name="archive_loop")
+    asyncio.create_task(rollup_loop(), name="rollup_loop")
+    await resume_broadcasts()
+    asyncio.create_task(broadcast_resume_loop(), name="broadcast_resume_loop")
+    # У PostgreSQL свои средства резервного копирования (pg_dump, реплики)
+    if BACKUP_INTERVAL_HOURS and isinstance(db, Database):
+        asyncio.create_task(backup_loop(), name="backup_loop")
     
     # Запуск бота
-    await dp.start_polling(bot)
+    try:
+        if WEBHOOK_MODE:
+            await run_webhook()
+        else:
+            # Пока адрес webhook зарегистрирован, getUpdates не работает
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        if admin_notify_tasks:
+            await asyncio.gather(*admin_notify_tasks, return_exceptions=True)
+        await release_broadcasts()
+        await db.close()
+
+async def migrate_dry_run():
+    await db.open()
+    try:
+        await db.migrate(dry_run=True)
+    finally:
+        await db.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if MIGRATE_DRY_RUN:
+        asyncio.run(migrate_dry_run())
+    else:
+        asyncio.run(main())
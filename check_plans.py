@@ -0,0 +1,198 @@
+import ast
+import logging
+import re
+import sqlite3
+import sys
+import tempfile
+from pathlib import Path
+
+import bot
+
+logger = logging.getLogger(__name__)
+
+# Проверка планов запросов бота перед выкладкой.
+# python check_plans.py собирает SQL-строки из вызовов db.*, tx.* и iter_keyset в bot.py,
+# строит для них EXPLAIN QUERY PLAN на временной БД с реалистичными
+# объемами и завершается с кодом 1, если запрос полностью просматривает большую
+# таблицу или сортирует через временное B-дерево. Намеренный просмотр отмечается
+# комментарием "# plan-ok: <причина>" в строке перед вызовом или внутри него.
+PLAN_CHECK_METHODS = {"fetchone", "fetchall", "fetchval", "execute", "insert", "executemany"}
+PLAN_CHECK_FUNCTIONS = {"iter_keyset"}
+PLAN_ALLOW_MARKER = "# plan-ok"
+PLAN_LARGE_TABLE_ROWS = 1000  # С какого числа строк таблица считается большой
+
+# Объемы примерно как у работающего бота: (строк, запрос, заполняющий таблицу
+# из последовательности seq(n))
+PLAN_SEED = [
+    (20000, """
+        INSERT INTO users (user_id, username, balance_usd, level, referrer_id, created_at, registration_date)
+        SELECT 1000000 + n, 'user' || n, (n % 50) / 10.0, 1 + n % 10,
+               CASE WHEN n % 3 = 0 THEN 1000000 + n / 3 END,
+               datetime('now', '-' || (n % 365) || ' days'), datetime('now', '-' || (n % 365) || ' days')
+        FROM seq
+    """),
+    (40000, """
+        INSERT INTO whatsapp_numbers (user_id, phone, status, hold_start, created_at, admin_id)
+        SELECT 1000000 + n % 20000, '+7900' || n,
+               CASE n % 20 WHEN 0 THEN 'pending' WHEN 1 THEN 'active' WHEN 2 THEN 'hold_active'
+                           WHEN 3 THEN 'failed' ELSE 'completed' END,
+               datetime('now', '-' || (n % 600) || ' minutes'),
+               datetime('now', '-' || (n % 720) || ' hours'), 1
+        FROM seq
+    """),
+    (20000, """
+        INSERT INTO max_numbers (user_id, phone, status, hold_start, created_at, admin_id)
+        SELECT 1000000 + n % 20000, '+7910' || n,
+               CASE n % 20 WHEN 0 THEN 'pending' WHEN 1 THEN 'active' WHEN 2 THEN 'accepted'
+                           WHEN 3 THEN 'failed' ELSE 'completed' END,
+               datetime('now', '-' || (n % 30) || ' minutes'),
+               datetime('now', '-' || (n % 720) || ' hours'), 1
+        FROM seq
+    """),
+    (20000, """
+        INSERT INTO sms_works (user_id, admin_id, text, status, amount, created_at)
+        SELECT 1000000 + n % 20000, 1, 'text',
+               CASE n % 10 WHEN 0 THEN 'pending' WHEN 1 THEN 'active' WHEN 2 THEN 'proof_pending'
+                           ELSE 'completed' END,
+               0.3, datetime('now', '-' || (n % 720) || ' hours')
+        FROM seq
+    """),
+    (5000, """
+        INSERT INTO withdraw_requests (user_id, amount_usd, amount_rub, status, created_at)
+        SELECT 1000000 + n % 20000, 5.0, 450.0,
+               CASE n % 10 WHEN 0 THEN 'pending' WHEN 1 THEN 'confirmed' ELSE 'paid' END,
+               datetime('now', '-' || (n % 720) || ' hours')
+        FROM seq
+    """),
+    (6000, """
+        INSERT INTO referrals (referrer_id, referred_id)
+        SELECT 1000000 + n / 3, 1000000 + n FROM seq
+    """),
+    (2000, """
+        INSERT INTO support_tickets (user_id, message, status)
+        SELECT 1000000 + n, 'message', CASE WHEN n % 5 = 0 THEN 'open' ELSE 'closed' END FROM seq
+    """),
+    (40000, f"""
+        INSERT INTO balance_ledger (user_id, amount_cents, reason, source_id)
+        SELECT 1000000 + n % 20000, 30, '{bot.LEDGER_SMS_REWARD}', n FROM seq
+    """),
+]
+
+def collect_statements(source: str) -> tuple:
+    """SQL-строки из вызовов db.<метод>, tx.<метод> и iter_keyset с литералом первым аргументом.
+
+    Возвращает ([(строка, sql, разрешено)], [строки с запросом из f-строки]).
+    Переходы статусов (transition) не собираются: они всегда ищут строку по id.
+    """
+    lines = source.splitlines()
+    statements, dynamic = [], []
+    for node in ast.walk(ast.parse(source)):
+        if not isinstance(node, ast.Call) or not node.args:
+            continue
+        func = node.func
+        if not ((isinstance(func, ast.Attribute) and func.attr in PLAN_CHECK_METHODS
+                 and isinstance(func.value, ast.Name) and func.value.id in ("db", "tx"))
+                or (isinstance(func, ast.Name) and func.id in PLAN_CHECK_FUNCTIONS)):
+            continue
+        sql = node.args[0]
+        if not (isinstance(sql, ast.Constant) and isinstance(sql.value, str)):
+            dynamic.append(node.lineno)
+            continue
+        nearby = lines[node.lineno - 2:node.end_lineno]
+        allowed = any(PLAN_ALLOW_MARKER in line for line in nearby)
+        statements.append((node.lineno, sql.value, allowed))
+    return sorted(statements), sorted(dynamic)
+
+def plan_problems(conn, sql: str, large_tables: set) -> list:
+    """Строки плана с полным просмотром большой таблицы или сортировкой во временном B-дереве"""
+    # Псевдонимы таблиц: в плане SQLite пишет "SCAN u", а не "SCAN users"
+    aliases = {}
+    for table, alias in re.findall(r"\b(?:FROM|JOIN|UPDATE|INTO)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", sql, re.I):
+        aliases[table] = table
+        if alias:
+            aliases[alias] = table
+    
+    # Проход по индексу допустим, если он частичный (только живые строки)
+    # или запрос с LIMIT идет в порядке индекса и останавливается раньше
+    partial_indexes = {row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND sql LIKE '% WHERE %'"
+    )}
+    limited = re.search(r"\bLIMIT\b", sql, re.I) is not None
+    
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}", [None] * sql.count("?")).fetchall()
+    problems = []
+    for *_, detail in plan:
+        # FTS5 с MATCH ("INDEX 0:M…") — поиск по полнотекстовому индексу
+        if re.search(r"VIRTUAL TABLE INDEX \d+:M", detail):
+            continue
+        scan = re.match(r"SCAN (?:TABLE )?(\w+)(?: USING (?:COVERING )?INDEX (\w+))?", detail)
+        if scan and aliases.get(scan.group(1)) in large_tables:
+            index = scan.group(2)
+            if index and (index in partial_indexes or limited):
+                continue
+            problems.append(detail)
+        elif "TEMP B-TREE FOR" in detail and "ORDER BY" in detail:
+            problems.append(detail)
+    return problems
+
+def check_query_plans() -> int:
+    source = Path(bot.__file__).read_text(encoding="utf-8")
+    collected, dynamic = collect_statements(source)
+    statements = [(f"bot.py:{line}", sql, allowed) for line, sql, allowed in collected]
+    # Запросы, собираемые из описаний, проверяются во всех вариантах
+    statements += [(f"список {name} ({direction})", bot.keyset_sql(name, direction), False)
+                   for name in bot.PAGED_LISTS for direction in ("f", "n", "p")]
+    statements += [(f"сводка {source}.{ts_column}", bot.rollup_sql(source, ts_column, amount_column), False)
+                   for _, _, table, ts_column, amount_column in bot.ROLLUP_METRICS
+                   for source in bot.rollup_sources(table)]
+    statements.append(("поиск пользователей", bot.search_sql(bot.SEARCH_SQL["sqlite"]), False))
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(str(Path(tmp) / "plans.db"), isolation_level=None)
+        try:
+            bot.run_migrations(conn)
+            conn.execute("BEGIN")
+            for rows, sql in PLAN_SEED:
+                conn.execute(f"""
+                    WITH RECURSIVE seq(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < {rows})
+                    {sql}
+                """)
+            # Часть завершенной работы уже в архиве; столбцы переносятся по именам
+            for table in bot.ARCHIVE_TABLES:
+                columns = ", ".join(row[1] for row in conn.execute(f"PRAGMA table_info({table})"))
+                conn.execute(f"""
+                    INSERT INTO {table}_archive ({columns})
+                    SELECT {columns} FROM {table} WHERE status = 'completed'
+                """)
+            conn.execute("COMMIT")
+            # Статистика планировщика, как после PRAGMA optimize на рабочей БД
+            conn.execute("ANALYZE")
+            
+            tables = [row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+            )]
+            large_tables = {table for table in tables
+                            if conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                            >= PLAN_LARGE_TABLE_ROWS}
+            
+            failures = 0
+            for label, sql, allowed in statements:
+                try:
+                    problems = plan_problems(conn, sql, large_tables)
+                except sqlite3.Error as e:
+                    logger.error(f"{label}: запрос не разбирается: {e}")
+                    failures += 1
+                    continue
+                if problems and not allowed:
+                    failures += 1
+                    logger.error(f"{label}: {'; '.join(problems)}\n    {' '.join(sql.split())}")
+        finally:
+            conn.close()
+    
+    logger.info(f"Query plans: {len(statements)} statements checked, {failures} problems, "
+                f"{sum(allowed for *_, allowed in statements)} allowed by marker, "
+                f"{len(dynamic)} built at runtime and skipped (lines {', '.join(map(str, dynamic))})")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(check_query_plans())
@@ -0,0 +1,315 @@
+import asyncio
+import logging
+import os
+import sys
+from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit
+
+import asyncpg
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+# Проверка работы бота с PostgreSQL перед выкладкой.
+# DATABASE_URL=postgresql://... python check_postgres.py создает на том же сервере
+# временную базу (нужно право CREATEDB), прогоняет на ней migrate() и потоки
+# данных обработчиков: регистрацию, очереди номеров, SMS, заявки на вывод,
+# рассылки, архив, сводки и контрольные точки — в том числе одновременные повторы.
+# Затем сверяет счетчики, итоги и балансы с таблицами, удаляет временную базу
+# и завершается с кодом 1, если что-то разошлось или упало.
+# bot импортируется после подмены DATABASE_URL: база создается при импорте
+bot = None
+CHECK_USER_BASE = 9_000_000_000  # user_id проверочных пользователей
+CHECK_REPEATS = 3  # Сколько раз одновременно повторяется одно действие
+
+failures = []
+
+def expect(condition: bool, message: str):
+    if not condition:
+        failures.append(message)
+        logger.error(message)
+
+def check_database_url(url: str) -> tuple:
+    """Имя временной базы и адрес для подключения к ней"""
+    name = f"bot_check_{os.getpid()}"
+    return name, urlunsplit(urlsplit(url)._replace(path=f"/{name}"))
+
+async def create_check_database(url: str, name: str):
+    conn = await asyncpg.connect(url)
+    try:
+        await conn.execute(f"CREATE DATABASE {name}")
+    finally:
+        await conn.close()
+
+async def drop_check_database(url: str, name: str):
+    conn = await asyncpg.connect(url)
+    try:
+        await conn.execute(f"DROP DATABASE IF EXISTS {name} WITH (FORCE)")
+    finally:
+        await conn.close()
+
+async def in_transaction(work, *args):
+    """Каждая попытка в своей транзакции, чтобы повторы шли параллельно"""
+    async with bot.db.transaction() as tx:
+        return await work(tx, *args)
+
+async def repeat(work, *args) -> list:
+    return await asyncio.gather(*[in_transaction(work, *args) for _ in range(CHECK_REPEATS)])
+
+def winners(results) -> int:
+    return sum(1 for result in results if result)
+
+async def check_statements():
+    """Все SQL-строки бота разбираются PostgreSQL после перевода pg_sql"""
+    from check_plans import collect_statements
+    
+    collected, _ = collect_statements(Path(bot.__file__).read_text(encoding="utf-8"))
+    statements = [(f"bot.py:{line}", sql) for line, sql, _ in collected]
+    statements += [(f"список {name} ({direction})", bot.keyset_sql(name, direction))
+                   for name in bot.PAGED_LISTS for direction in ("f", "n", "p")]
+    statements += [(f"сводка {source}.{ts_column}", bot.rollup_sql(source, ts_column, amount_column))
+                   for _, _, table, ts_column, amount_column in bot.ROLLUP_METRICS
+                   for source in bot.rollup_sources(table)]
+    statements.append(("поиск пользователей", bot.search_sql(bot.SEARCH_SQL["postgres"], "postgres")))
+    
+    async with bot.db._pool.acquire() as conn:
+        for label, sql in statements:
+            try:
+                await conn.prepare(bot.pg_sql(sql))
+            except asyncpg.PostgresError as e:
+                expect(False, f"{label}: запрос не разбирается: {e}\n    {' '.join(sql.split())}")
+    logger.info(f"Statements prepared: {len(statements)}")
+
+async def check_registration():
+    referrer_id = CHECK_USER_BASE
+    await in_transaction(bot.register_user, referrer_id, "referrer", "Referrer", None, None)
+    for user_id in range(CHECK_USER_BASE + 1, CHECK_USER_BASE + 4):
+        results = await repeat(bot.register_user, user_id, f"user{user_id}", "User", None, referrer_id)
+        expect(winners(results) == 1, f"Регистрация {user_id}: бонус начислен {winners(results)} раз")
+    
+    bonus_cents = await bot.db.fetchval(
+        "SELECT balance_cents FROM users WHERE user_id = ?", (referrer_id,), default=0
+    )
+    expect(bonus_cents == 3 * bot.to_cents(bot.REFERRAL_BONUS),
+           f"Реферальные бонусы: баланс {bonus_cents} центов")
+    
+    await repeat(bot.add_warning, referrer_id)
+    warnings = await bot.db.fetchval("SELECT warnings FROM users WHERE user_id = ?", (referrer_id,))
+    expect(warnings == CHECK_REPEATS, f"Предупреждения: {warnings} вместо {CHECK_REPEATS}")
+
+async def check_queues():
+    user_id = CHECK_USER_BASE + 1
+    wa_ids = [await bot.db.insert("""
+        INSERT INTO whatsapp_numbers (user_id, phone, status) VALUES (?, ?, 'pending')
+    """, (user_id, f"+7999000{n:04d}")) for n in range(3)]
+    for wa_id in wa_ids:
+        results = await asyncio.gather(*[
+            bot.db.transition("whatsapp_numbers", wa_id, ("pending",), "active")
+            for _ in range(CHECK_REPEATS)
+        ])
+        expect(winners(results) == 1, f"WhatsApp {wa_id}: взят в работу {winners(results)} раз")
+    results = await asyncio.gather(*[
+        bot.db.delete_in_states("whatsapp_numbers", wa_ids[0], ("pending", "active"))
+        for _ in range(CHECK_REPEATS)
+    ])
+    expect(winners(results) == 1, f"WhatsApp {wa_ids[0]}: отклонен {winners(results)} раз")
+    
+    max_id = await bot.db.insert("""
+        INSERT INTO max_numbers (user_id, phone, status) VALUES (?, ?, 'pending')
+    """, (user_id, "+79990009999"))
+    results = await repeat(bot.accept_max_account, max_id, CHECK_USER_BASE)
+    expect(winners(results) == 1, f"MAX {max_id}: принят {winners(results)} раз")
+    max_numbers = await bot.db.fetchval("SELECT max_numbers FROM users WHERE user_id = ?", (user_id,))
+    expect(max_numbers == 1, f"MAX: счетчик пользователя {max_numbers} вместо 1")
+
+async def check_sms():
+    user_id = CHECK_USER_BASE + 2
+    work_id = await bot.db.insert("""
+        INSERT INTO sms_works (user_id, text, status) VALUES (?, 'text', 'proof_pending')
+    """, (user_id,))
+    results = await repeat(bot.complete_sms_work, work_id, bot.SMS_RATE)
+    expect(winners(results) == 1, f"SMS {work_id}: оплачена {winners(results)} раз")
+    earned_cents = await bot.db.fetchval("SELECT earned_cents FROM users WHERE user_id = ?", (user_id,))
+    expect(earned_cents == bot.to_cents(bot.SMS_RATE), f"SMS: заработок {earned_cents} центов")
+
+async def check_withdrawals():
+    user_id = CHECK_USER_BASE + 3
+    async with bot.db.transaction() as tx:
+        await bot.post_ledger(tx, [(user_id, 5.0, bot.LEDGER_SMS_REWARD, CHECK_USER_BASE)])
+    
+    # Баланса хватает только на одну заявку
+    results = await repeat(bot.create_withdraw_request, user_id, 3.0)
+    expect(winners(results) == 1, f"Вывод: создано {winners(results)} заявок из одного баланса")
+    balance_cents = await bot.db.fetchval("SELECT balance_cents FROM users WHERE user_id = ?", (user_id,))
+    expect(balance_cents == 200, f"Вывод: остаток {balance_cents} центов вместо 200")
+    
+    request_id = next(result for result in results if result)
+    await bot.db.transition("withdraw_requests", request_id, ("pending",), "confirmed", returning=("id",))
+    results = await asyncio.gather(*[
+        bot.db.transition("withdraw_requests", request_id, ("confirmed",), "processing", returning=("id",))
+        for _ in range(CHECK_REPEATS)
+    ])
+    expect(winners(results) == 1, f"Вывод {request_id}: захвачен для выплаты {winners(results)} раз")
+
+async def check_broadcasts():
+    """Рассылку ведет один процесс, а остановка доходит из любого"""
+    broadcast_id = await bot.db.insert("""
+        INSERT INTO broadcasts (admin_id, text, total) VALUES (?, 'text', 0)
+    """, (CHECK_USER_BASE,))
+    results = await asyncio.gather(*[
+        bot.claim_broadcast(broadcast_id, f"check-{n}") for n in range(CHECK_REPEATS)
+    ])
+    expect(winners(results) == 1, f"Рассылка {broadcast_id}: захвачена {winners(results)} процессами")
+    expect(await bot.claim_broadcast(broadcast_id) is None,
+           f"Рассылка {broadcast_id}: захват живого владельца перехвачен")
+    
+    # Остановка из процесса, который рассылку не ведет
+    results = await asyncio.gather(*[
+        bot.db.transition("broadcasts", broadcast_id, ("running",), "stopping", returning=("id",))
+        for _ in range(CHECK_REPEATS)
+    ])
+    expect(winners(results) == 1, f"Рассылка {broadcast_id}: остановлена {winners(results)} раз")
+    
+    # Владелец пропал: рассылку подхватывает этот процесс и завершает как остановленную
+    await bot.db.execute("UPDATE broadcasts SET lease_until = 0 WHERE id = ?", (broadcast_id,))
+    await asyncio.gather(*[bot.resume_broadcasts() for _ in range(CHECK_REPEATS)])
+    await asyncio.gather(*bot.broadcast_tasks.values())
+    row = await bot.db.fetchone("SELECT status, owner FROM broadcasts WHERE id = ?", (broadcast_id,))
+    expect(row == ("cancelled", None), f"Рассылка {broadcast_id}: после подхвата {row}")
+
+async def check_archive_and_rollup():
+    user_id = CHECK_USER_BASE + 2
+    rows = 2 * bot.ARCHIVE_BATCH_SIZE + 1
+    async with bot.db.transaction() as tx:
+        await tx.executemany("""
+            INSERT INTO sms_works (user_id, text, status, created_at)
+            VALUES (?, 'text', 'completed', '2020-01-01 00:00:00')
+        """, [(user_id,)] * rows)
+    
+    moved = await asyncio.gather(*[bot.archive_finished_work() for _ in range(CHECK_REPEATS)])
+    archived = await bot.db.fetchval("SELECT COUNT(*) FROM sms_works_archive")
+    expect(sum(moved) == rows and archived == rows,
+           f"Архив: перенесено {sum(moved)}, в архиве {archived} из {rows}")
+    
+    await asyncio.gather(*[bot.rollup_daily_stats() for _ in range(CHECK_REPEATS)])
+    submitted = await bot.db.fetchval("""
+        SELECT COALESCE(SUM(count), 0) FROM daily_stats WHERE service = 'sms' AND metric = 'submitted'
+    """)
+    total = await bot.count_with_archive("sms_works", "1 = 1")
+    expect(submitted == total, f"Сводки: {submitted} SMS работ вместо {total}")
+
+async def check_checkpoints():
+    user_id = CHECK_USER_BASE + 1
+    
+    async def credit(source_id: int):
+        async with bot.db.transaction() as tx:
+            await bot.post_ledger(tx, [(user_id, 0.01, bot.LEDGER_SMS_REWARD, source_id)])
+    
+    async def checkpoint():
+        async with bot.db.transaction() as tx:
+            return await bot.write_balance_checkpoints(tx)
+    
+    results = await asyncio.gather(
+        *[credit(CHECK_USER_BASE + n) for n in range(1, 21)],
+        *[checkpoint() for _ in range(CHECK_REPEATS)]
+    )
+    results.append(await checkpoint())
+    mismatched = sum(result[1] for result in results if result)
+    expect(mismatched == 0, f"Контрольные точки: {mismatched} расхождений с балансами")
+
+async def check_totals():
+    """Счетчики и итоги, которые ведут триггеры, совпадают с пересчетом по таблицам"""
+    counters = {(service, status): count for service, status, count in await bot.db.fetchall(
+        "SELECT service, status, count FROM status_counters WHERE count != 0"
+    )}
+    actual = {}
+    for table, service in bot.COUNTED_TABLES.items():
+        for status, count in await bot.db.fetchall(f"""
+            SELECT COALESCE(status, ''), COUNT(*) FROM (
+                SELECT status FROM {table} UNION ALL SELECT status FROM {table}_archive
+            ) AS t GROUP BY 1
+        """):
+            actual[(service, status)] = count
+    expect(counters == actual, f"status_counters {counters} не совпадает с таблицами {actual}")
+    
+    # Зеркало в памяти обновляется по NOTIFY после фиксации
+    await asyncio.sleep(0.5)
+    mirror = {key: bot.queue_counters.get(*key) for key in actual}
+    expect(mirror == actual, f"Счетчики в памяти {mirror} не совпадают с таблицами {actual}")
+    
+    totals = dict(await bot.db.fetchall("SELECT name, value FROM running_totals"))
+    users, balance_cents, earned_cents = await bot.db.fetchone("""
+        SELECT COUNT(*), COALESCE(SUM(balance_cents), 0), COALESCE(SUM(earned_cents), 0) FROM users
+    """)
+    expect(totals == {"users": users, "balance_cents": balance_cents, "earned_cents": earned_cents},
+           f"running_totals {totals} не совпадает с users ({users}, {balance_cents}, {earned_cents})")
+    
+    mismatched = await bot.db.fetchall("""
+        SELECT u.user_id, u.balance_cents, COALESCE(l.amount_cents, 0)
+        FROM users u
+        LEFT JOIN (
+            SELECT user_id, SUM(amount_cents) AS amount_cents FROM balance_ledger GROUP BY user_id
+        ) l ON l.user_id = u.user_id
+        WHERE u.balance_cents != COALESCE(l.amount_cents, 0)
+    """)
+    expect(not mismatched, f"Балансы не совпадают с журналом проводок: {mismatched}")
+
+async def check_recount():
+    """migrate() на текущей версии не пересчитывает итоги, на старой — пересчитывает"""
+    await bot.db.execute("UPDATE running_totals SET value = value + 1 WHERE name = 'users'")
+    await bot.db.migrate()
+    users = await bot.db.fetchval("SELECT value FROM running_totals WHERE name = 'users'")
+    expected = await bot.db.fetchval("SELECT COUNT(*) FROM users")
+    expect(users == expected + 1, "migrate() пересчитал итоги при текущей версии схемы")
+    
+    await bot.db.execute("UPDATE schema_version SET version = version - 1")
+    await bot.db.migrate()
+    users = await bot.db.fetchval("SELECT value FROM running_totals WHERE name = 'users'")
+    expect(users == expected, "migrate() не пересчитал итоги после смены версии схемы")
+
+async def run_checks():
+    await bot.db.open()
+    try:
+        await bot.db.migrate()
+        await bot.queue_counters.load(bot.db)
+        await bot.load_archive_columns(bot.db)
+        await check_statements()
+        await check_registration()
+        await check_queues()
+        await check_sms()
+        await check_withdrawals()
+        await check_broadcasts()
+        await check_archive_and_rollup()
+        await check_checkpoints()
+        await check_recount()
+        await check_totals()
+    except Exception as e:
+        logger.exception(f"Проверка прервана: {e}")
+        failures.append(str(e))
+    finally:
+        await bot.db.close()
+
+def main() -> int:
+    global bot
+    url = os.getenv("DATABASE_URL", "")
+    if not url.startswith(("postgres://", "postgresql://")):
+        logger.error("DATABASE_URL должен указывать на сервер PostgreSQL")
+        return 2
+    
+    name, check_url = check_database_url(url)
+    asyncio.run(create_check_database(url, name))
+    try:
+        os.environ["DATABASE_URL"] = check_url
+        import bot
+        asyncio.run(run_checks())
+    finally:
+        asyncio.run(drop_check_database(url, name))
+    
+    logger.info(f"PostgreSQL check: {len(failures)} problems")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())